@@ -124,6 +124,7 @@ Arguments:   -i, --fastq,--bam   Input BAM or FASTQ file (Required)
              --full_length       Keep only full length sequences.
              --barcode_fasta     FASTA file containing barcodes. Default: pgm_barcodes.fa
              --primer_mismatch   Number of mismatches in primers to allow. Default: 2
+             --barcode_mismatch  Number of mismatches in barcodes to allow. Default: 0 [0,1,2]
              --cpus              Number of CPUs to use. Default: all
              --mult_samples      Combine multiple chip runs, name prefix for chip
         """ % (sys.argv[1], version)
@@ -152,7 +153,7 @@ Description: Script takes Illumina MiSeq data that is not de-multiplexed and has
              (3' barcodes using the --reverse_barcode option). 
     
 Arguments:   -i, --fastq         Input FASTQ file (Required)
-             --reverse           Illumina PE reverse reads.
+             --reverse           Illumina PE reverse reads, R1 is used unmerged without it.
              -o, --out           Output base name. Default: out
              -m, --mapping_file  QIIME-like mapping file
              -f, --fwd_primer    Forward primer sequence. Default: fITS7
@@ -165,6 +166,7 @@ Arguments:   -i, --fastq         Input FASTQ file (Required)
              --reverse_barcode   FASTA file containing 3' barcodes. Default: none
              --full_length       Keep only full length sequences.
              --primer_mismatch   Number of mismatches in primers to allow. Default: 2
+             --barcode_mismatch  Number of mismatches in barcodes to allow. Default: 0 [0,1,2]
              --cpus              Number of CPUs to use. Default: all
              -u, --usearch       USEARCH executable. Default: usearch9
         """ % (sys.argv[1], version)
@@ -242,6 +244,7 @@ Arguments:   -i, --sff, --fasta  Input file (SFF, FASTA, or FASTQ) (Required)
              --barcode_fasta     FASTA file containing barcodes. (Required)
              --reverse_barcode   FASTA file containing 3' barcodes. Default: none
              --primer_mismatch   Number of mismatches in primers to allow. Default: 2
+             --barcode_mismatch  Number of mismatches in barcodes to allow. Default: 0 [0,1,2]
              --cpus              Number of CPUs to use. Default: all
         """ % (sys.argv[1], version)
         
@@ -578,6 +581,8 @@ Required:    -i, --input     Input FASTQ file (.demux.fq)
              -e, --maxee     maxEE threshold for quality. Default: 1.0
              -l, --length    truncation length for trimming: Default: 250
              -o, --out       Output FASTQ file name (--quality_trim only)     
+             --ee_scan       Count reads passing maxEE:trunclen pairs in one pass, e.g. 1.0:250,0.5:200
+             --ee_reads      Write longest passing prefix of each read (--ee_scan only)
         """ % (sys.argv[1], version)
         
         arguments = sys.argv[2:]
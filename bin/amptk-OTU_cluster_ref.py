@@ -9,6 +9,7 @@ currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentfram
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0,parentdir)
 import lib.amptklib as amptklib
+import lib.fasta as fasta
 import pandas as pd
 
 #get script path for directory
@@ -138,10 +139,8 @@ filter_out = os.path.join(tmp, args.out + '.EE' + args.maxee + '.filter.fq')
 filter_fasta = os.path.join(tmp, args.out + '.EE' + args.maxee + '.filter.fa')
 orig_fasta = os.path.join(tmp, args.out+'.orig.fa')
 amptklib.log.info("Quality Filtering, expected errors < %s" % args.maxee)
-cmd = ['vsearch', '--fastq_filter', args.FASTQ, '--fastq_maxee', str(args.maxee), '--fastqout', filter_out, '--fastaout', filter_fasta, '--fastq_qmax', '55']
-amptklib.runSubprocess(cmd, amptklib.log)
-cmd = ['vsearch', '--fastq_filter', args.FASTQ, '--fastaout', orig_fasta, '--fastq_qmax', '55']
-amptklib.runSubprocess(cmd, amptklib.log)
+#binary .reads input is filtered without exporting it, all reads are then mapped from it directly
+orig_fasta = amptklib.qualityFilter(args.FASTQ, args.maxee, filter_out, filter_fasta, orig_fasta)
 qtrimtotal = amptklib.countfastq(filter_out)
 amptklib.log.info('{0:,}'.format(qtrimtotal) + ' reads passed')
 
@@ -263,7 +262,7 @@ if not args.closed_ref_only:
     filt_tax_values = [s + ':' for s in tax_values[filter_index:]]
     #get results from utax
     with open(ref_clustered, 'a') as output:
-        seqDict = SeqIO.index(otu_out, 'fasta')
+        seqDict = fasta.FastaIndex(otu_out, Save=False)
         utaxresults = []
         with open(os.path.join(tmp, args.out+'.utax.out'), 'ru') as utax:
             for line in utax:
@@ -272,11 +271,7 @@ if not args.closed_ref_only:
                 ID = col[0]
                 tax = col[2]
                 if any(x in tax for x in filt_tax_values):
-                    record = seqDict[ID]
-                    record.id = 'OTU'+str(otu_counter)+';UTAX;tax='+tax
-                    record.name = ''
-                    record.description = ''
-                    SeqIO.write(record, output, 'fasta')
+                    output.write('>OTU%i;UTAX;tax=%s\n%s\n' % (otu_counter, tax, seqDict[ID]))
                     otu_counter += 1
     total = amptklib.countfasta(ref_clustered) - num_refcluster
     amptklib.log.info('{0:,}'.format(total) + ' classified to %s' % taxonomyLookup.get(args.utax_level))
@@ -297,11 +292,11 @@ if args.map_filtered:
 else:
     reads = orig_fasta
 amptklib.log.info("Mapping Reads to OTUs and Building OTU table")
-cmd = ['vsearch', '--usearch_global', reads, '--strand', 'plus', '--id', '0.97', '--db', otu_clean, '--uc', uc_out, '--otutabout', otu_table]
-amptklib.runSubprocess(cmd, amptklib.log)
-
-#count reads mapped
-total = amptklib.line_count(uc_out)
+#search each unique sequence once and expand the hits by its abundance in each sample
+uniques = os.path.join(tmp, args.out + '.EE' + args.maxee + '.uniques.fa')
+samples, abundances = amptklib.derepSamples(reads, uniques, amptklib.getCPUS(), tmp)
+amptklib.log.debug('{0:,}'.format(len(abundances)) + ' unique sequences to map')
+total = amptklib.mapUniques(uniques, abundances, samples, otu_clean, uc_out, otu_table)
 amptklib.log.info('{0:,}'.format(total) + ' reads mapped to OTUs '+ '({0:.0f}%)'.format(total/float(orig_total)* 100))
 
 #Move files around, delete tmp if argument passed.
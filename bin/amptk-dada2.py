@@ -7,6 +7,7 @@ currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentfram
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0,parentdir)
 import lib.amptklib as amptklib
+import lib.fasta as fasta
 import numpy as np
 from natsort import natsorted
 
@@ -51,16 +52,15 @@ def folder2list(input, ending):
     return names
 
 def splitDemux2(input, outputdir):
-    for title, seq, qual in FastqGeneralIterator(open(input)):
-        sample = title.split('barcodelabel=')[1]
-        sample = sample.replace(';', '')
-        if not args.length:
-            with open(os.path.join(outputdir, sample+'.fastq'), 'ab') as output:
-                output.write("@%s\n%s\n+\n%s\n" % (title, seq, qual))
-        else:
-            if len(seq) >= int(args.length):
-                with open(os.path.join(outputdir, sample+'.fastq'), 'ab') as output:
-                    output.write("@%s\n%s\n+\n%s\n" % (title, seq[:int(args.length):], qual[:int(args.length)]))
+    with amptklib.MultiWriter() as output:
+        for title, seq, qual in FastqGeneralIterator(open(input)):
+            sample = title.split('barcodelabel=')[1]
+            sample = sample.replace(';', '')
+            if not args.length:
+                output.write(os.path.join(outputdir, sample+'.fastq'), "@%s\n%s\n+\n%s\n" % (title, seq, qual))
+            else:
+                if len(seq) >= int(args.length):
+                    output.write(os.path.join(outputdir, sample+'.fastq'), "@%s\n%s\n+\n%s\n" % (title, seq[:int(args.length):], qual[:int(args.length)]))
 
 def getAvgLength(input):
     AvgLength = []
@@ -216,10 +216,11 @@ else:
 
     #now reformat OTUs and OTU table, dropping chimeric OTUs from table, sorting the output as well
     nonchimeras = amptklib.fasta2list(uchime_out)
-    inferredSeqs = SeqIO.index(uchime_out, 'fasta')
+    inferredSeqs = fasta.FastaIndex(uchime_out, Save=False)
     with open(iSeqs, 'w') as iSeqout:
         for x in natsorted(nonchimeras):
-            SeqIO.write(inferredSeqs[x], iSeqout, 'fasta')
+            iSeqout.write('>%s\n%s\n' % (x, inferredSeqs[x]))
+    inferredSeqs.close()
     if not args.debug:
         #clean up chimeras fasta
         amptklib.removefile(uchime_out)
@@ -239,9 +240,12 @@ ClusterComp = args.out+'.iSeqs2clusters.txt'
 amptklib.log.info("Mapping reads to DADA2 iSeqs")
 cmd = ['vsearch', '--fastq_filter', os.path.abspath(no_ns),'--fastq_qmax', '55', '--fastaout', demuxtmp]
 amptklib.runSubprocess(cmd, amptklib.log)
-cmd = ['vsearch', '--usearch_global', demuxtmp, '--db', iSeqs, '--id', '0.97', '--uc', dadademux, '--strand', 'plus', '--otutabout', chimeraFreeTable ]
-amptklib.runSubprocess(cmd, amptklib.log)
-total = amptklib.line_count(dadademux)
+#search each unique sequence once and expand the hits by its abundance in each sample,
+#the same uniques are mapped to the clustered OTUs below
+uniquetmp = args.out+'.uniques.fa'
+samples, abundances = amptklib.derepSamples(demuxtmp, uniquetmp, amptklib.getCPUS(), filtfolder)
+amptklib.log.debug('{0:,}'.format(len(abundances)) + ' unique sequences to map')
+total = amptklib.mapUniques(uniquetmp, abundances, samples, iSeqs, dadademux, chimeraFreeTable)
 amptklib.log.info('{0:,}'.format(total) + ' reads mapped to iSeqs '+ '({0:.0f}%)'.format(total/float(orig_total)* 100))
 
 #cluster
@@ -273,9 +277,7 @@ with open(ClusterComp, 'w') as clusters:
         clusters.write('%s\t%s\n' % (k, ', '.join(v)))
 #create OTU table
 amptklib.log.info("Mapping reads to OTUs")
-cmd = ['vsearch', '--usearch_global', demuxtmp, '--db', bioSeqs, '--id', '0.97', '--uc', uctmp, '--strand', 'plus', '--otutabout', bioTable]
-amptklib.runSubprocess(cmd, amptklib.log)
-total = amptklib.line_count(uctmp)
+total = amptklib.mapUniques(uniquetmp, abundances, samples, bioSeqs, uctmp, bioTable)
 amptklib.log.info('{0:,}'.format(total) + ' reads mapped to OTUs '+ '({0:.0f}%)'.format(total/float(orig_total)* 100))
 
 if not args.debug:
@@ -284,6 +286,7 @@ if not args.debug:
     amptklib.removefile(dada2out)
     amptklib.removefile(derep)
     amptklib.removefile(demuxtmp)
+    amptklib.removefile(uniquetmp)
     amptklib.removefile(uctmp)
     amptklib.removefile(iSeqmap)
     amptklib.removefile(dadademux)
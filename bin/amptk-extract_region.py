@@ -76,35 +76,15 @@ def latin2ascii(error):
     return latin_dict[error.object[error.start]], error.start+1
 codecs.register_error('latin2ascii', latin2ascii)
 
-def invert_dict(d):
-    return dict((v, k) for k in d for v in d[k])
+def taxonomyField(title):
+    return title.split(';')[1] if ';' in title else ''
 
 def dereplicate(input, output):
-    seqs = {}
-    in_file = open(input, 'rU')
-    for rec in SeqIO.parse(in_file, 'fasta'):
-        rec.id = rec.description
-        sequence = str(rec.seq)
-        if sequence not in seqs:
-            seqs[sequence] = [rec.id]
-        else:
-            new = rec.id.split(";")[1]
-            hit = seqs.get(sequence)
-            hit_string = " ".join(hit)
-            if not new in hit_string:
-                hit.append(new)
-    seqs_inv = invert_dict(seqs)
+    #one record per unique sequence and taxonomy, header of the first record with both
+    samples, uniques = amptklib.derepUniques(input, cpus, label=taxonomyField, tmpdir=os.path.dirname(os.path.abspath(output)))
     with open(output, 'w') as out:
-        for key,value in seqs_inv.iteritems():
-            out.write('>'+key+'\n'+value+'\n')
-
-def countfasta(input):
-    count = 0
-    with open(input, 'rU') as f:
-        for line in f:
-            if line.startswith (">"):
-                count += 1
-    return count
+        for title, sequence, size, counts in uniques:
+            out.write('>'+title+'\n'+sequence+'\n')
 
 def stripPrimer(records):
     for rec in records:
@@ -419,7 +399,7 @@ else:
     cpus = args.cpus
 
 with open(FileName, 'rU') as input:
-    SeqCount = countfasta(FileName)
+    SeqCount = amptklib.countfasta(FileName)
     amptklib.log.info('{0:,}'.format(SeqCount) + ' records loaded')
     SeqRecords = SeqIO.parse(FileName, 'fasta')
     chunks = SeqCount / cpus + 1
@@ -460,16 +440,16 @@ with open(OutName, 'w') as outfile:
 shutil.rmtree(folder)
 
 if args.derep_fulllength:
-    Passed = countfasta(OutName)
+    Passed = amptklib.countfasta(OutName)
     amptklib.log.info('{0:,}'.format(Passed) + ' records passed (%.2f%%)' % (Passed*100.0/SeqCount))
     amptklib.log.info("Now dereplicating sequences (remove if sequence and header identical)")
     Derep = args.out + '.derep.extracted.fa'
     dereplicate(OutName, Derep)
-    Total = countfasta(Derep)
+    Total = amptklib.countfasta(Derep)
     amptklib.log.info('{0:,}'.format(Total) + ' records passed (%.2f%%)' % (Total*100.0/Passed))
     os.remove(OutName)
 else:
-    Total = countfasta(OutName)
+    Total = amptklib.countfasta(OutName)
     amptklib.log.info('{0:,}'.format(Total) + ' records passed (%.2f%%)' % (Total*100.0/SeqCount))
     Derep = OutName
 
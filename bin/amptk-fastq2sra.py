@@ -7,6 +7,7 @@ sys.path.insert(0,parentdir)
 import lib.amptklib as amptklib
 import lib.revcomp_lib as revcomp_lib
 import lib.primer as primer
+import lib.barcode as barcode
 from Bio.SeqIO.QualityIO import FastqGeneralIterator
 
 class MyFormatter(argparse.ArgumentDefaultsHelpFormatter):
@@ -39,13 +40,6 @@ parser.add_argument('--force', action='store_true', help='Overwrite existing dir
 parser.add_argument('-a','--append', help='Append a name to all sample names for a run, i.e. --append run1 would yield Sample_run1')
 args=parser.parse_args()
 
-def FindBarcode(Seq, BarcodeDict):
-    for BarcodeLabel in BarcodeDict.keys():
-        Barcode = BarcodeDict[BarcodeLabel]
-        if Seq.startswith(Barcode):
-            return Barcode, BarcodeLabel
-    return "", ""
-
 log_name = args.out + '.amptk-sra.log'
 if os.path.isfile(log_name):
     os.remove(log_name)
@@ -187,6 +181,7 @@ else:
                     name = line[1:-1] + ".fastq"
                 continue
             Barcodes[name]=line.strip()
+    BarcodeIdx = barcode.BarcodeIndex(Barcodes)
 
     #count FASTQ records in input
     amptklib.log.info("Loading FASTQ Records")
@@ -205,12 +200,13 @@ else:
     
 
     #this will loop through FASTQ file once, splitting those where barcodes are found, and primers trimmed
+    #per-sample files are gzipped as they are written through a pool of buffered handles
     runningTotal = 0
     trim = len(FwdPrimer)
     #print Barcodes
-    with open(args.FASTQ, 'rU') as input:
+    with open(args.FASTQ, 'rU') as input, amptklib.MultiWriter(compress='gzip') as output:
         for title, seq, qual in FastqGeneralIterator(input):
-            Barcode, BarcodeLabel = FindBarcode(seq, Barcodes)
+            Barcode, BarcodeLabel = BarcodeIdx.find(seq)
             if Barcode == "": #if not found, move onto next record
                 continue
             BarcodeLength = len(Barcode)
@@ -236,9 +232,8 @@ else:
             if len(seq) < args.min_len: #filter out sequences less than minimum length.
                 continue
             runningTotal += 1
-            fileout = os.path.join(args.out, BarcodeLabel)
-            with open(fileout, 'ab') as output:
-                output.write("@%s\n%s\n+\n%s\n" % (title, seq, qual))
+            fileout = os.path.join(args.out, BarcodeLabel+'.gz')
+            output.write(fileout, "@%s\n%s\n+\n%s\n" % (title, seq, qual))
     if args.require_primer == 'off':   
         amptklib.log.info('{0:,}'.format(runningTotal) + ' total reads with valid barcode')
     elif args.require_primer == 'forward':
@@ -246,20 +241,6 @@ else:
     elif args.require_primer == 'both':
         amptklib.log.info('{0:,}'.format(runningTotal) + ' total reads with valid barcode and both primers')
     
-    amptklib.log.info("Now Gzipping files")
-    gzip_list = []
-    for file in os.listdir(args.out):
-        if file.endswith(".fastq"):
-            gzip_list.append(file)
-
-    for file in gzip_list:
-        file_path = os.path.join(args.out, file)
-        new_path = file_path + '.gz'
-        with open(file_path, 'rU') as orig_file:
-            with gzip.open(new_path, 'w') as zipped_file:
-                zipped_file.writelines(orig_file)
-        os.remove(file_path)
-    
     #after all files demuxed into output folder, loop through and create SRA metadata file
     filelist = []
     for file in os.listdir(args.out):
@@ -8,8 +8,9 @@ sys.path.insert(0,parentdir)
 import lib.amptklib as amptklib
 import lib.primer as primer
 import lib.revcomp_lib as revcomp_lib
+import lib.fastx as fastx
+import lib.readstore as readstore
 from Bio import SeqIO
-from Bio.SeqIO.QualityIO import FastqGeneralIterator
 
 class MyFormatter(argparse.ArgumentDefaultsHelpFormatter):
     def __init__(self,prog):
@@ -41,78 +42,95 @@ parser.add_argument('--full_length', action='store_true', help='Keep only full l
 parser.add_argument('-p','--pad', default='on', choices=['on', 'off'], help='Pad with Ns to a set length')
 parser.add_argument('-u','--usearch', dest="usearch", default='usearch9', help='USEARCH executable')
 parser.add_argument('--sra', action='store_true', help='Input files are from NCBI SRA not direct from illumina')
+parser.add_argument('--binary', default='off', choices=['off', 'on', 'binned'], help='Write demuxed reads as compact binary .reads, binned: 8 level qualities')
 parser.add_argument('--cleanup', action='store_true', help='Delete all intermediate files')
 args=parser.parse_args()
 
+def mergeSample(input):
+    #input is a tuple of (name, R1, R2, read_length, threads), merge or copy one sample into args.out
+    #and return the merged file
+    name, for_reads, rev_reads, read_length, threads = input
+    outname = name + '.fq'
+    if args.reads == 'paired' and amptklib.check_valid_file(rev_reads):
+        amptklib.MergeReads(for_reads, rev_reads, args.out, outname, read_length, args.min_len, args.usearch, args.rescue_forward, threads=threads)
+    else:
+        amptklib.zcopy(for_reads, os.path.join(args.out, outname))
+    return os.path.join(args.out, outname)
+
 def processRead(input):
-    #input is expected to be a FASTQ file
-    #local variables that need to be previously declared: ForPrimer, RevPrimer
+    #input is expected to be a FASTQ file, returns the stats of the sample
+    #(Total, NoPrimer, RevPrimerFound, TooShort, ValidSeqs, Bases, MinLen, MaxLen)
+    #local variables that need to be previously declared: ForPrimer, RevPrimer, ReadLen
     Name = os.path.basename(input).split(".fq",-1)[0]
     DemuxOut = os.path.join(args.out, Name + '.demux.fq')
     Sample = Name.split('_')[0]
-    StatsOut = os.path.join(args.out, Name+'.stats')
     Total = 0
     NoPrimer = 0
     TooShort = 0
     RevPrimerFound = 0
     ValidSeqs = 0
+    Bases = 0
+    MinLen = 0
+    MaxLen = 0
     PL = len(FwdPrimer)
-    with open(StatsOut, 'w') as counts:
-        with open(DemuxOut, 'w') as out:
-            for title, seq, qual in FastqGeneralIterator(open(input)):
-                Total += 1
-                #first thing is look for forward primer, if found trim it off
-                Diffs = primer.MatchPrefix(seq, FwdPrimer)
-                #if require primer is on make finding primer in amplicon required if amplicon is larger than read length
-                #if less than read length, can't enforce primer because could have been trimmed via staggered trim in fastq_mergepairs
-                if args.primer == 'on' and len(seq) > ReadLen:
-                    if Diffs > args.primer_mismatch:
-                        NoPrimer += 1
-                        continue
+    with open(DemuxOut, 'w') as out:
+        for title, seq, qual in fastx.fastq_records(open(input, 'rb')):
+            Total += 1
+            #first thing is look for forward primer, if found trim it off
+            Diffs = primer.MatchPrefix(seq, FwdPrimer)
+            #if require primer is on make finding primer in amplicon required if amplicon is larger than read length
+            #if less than read length, can't enforce primer because could have been trimmed via staggered trim in fastq_mergepairs
+            if args.primer == 'on' and len(seq) > ReadLen:
+                if Diffs > args.primer_mismatch:
+                    NoPrimer += 1
+                    continue
+                Seq = seq[PL:]
+                Qual = qual[PL:]
+            else:
+                if Diffs <= args.primer_mismatch:
                     Seq = seq[PL:]
                     Qual = qual[PL:]
                 else:
-                    if Diffs <= args.primer_mismatch:
-                        Seq = seq[PL:]
-                        Qual = qual[PL:]
-                    else:
-                        NoPrimer += 1
-                        Seq = seq
-                        Qual = qual
-                #now look for reverse primer
-                BestPosRev, BestDiffsRev = primer.BestMatch2(Seq, RevPrimer, args.primer_mismatch)
-                if BestPosRev > 0:  #reverse primer was found
-                    RevPrimerFound += 1
-                    #location to trim sequences, trim seqs
-                    Seq = Seq[:BestPosRev]
-                    Qual = Qual[:BestPosRev]
-                else:
-                    if args.full_length and len(Seq) > ReadLen: #if full length and no primer found, exit, except when length is less than read length
-                        continue
-                #if full_length is passed, then only trim primers
-                if not args.full_length:
-                    #got here if primers were found they were trimmed
-                    #now check seq length, pad if too short, trim if too long
-                    if len(Seq) < args.min_len: #need this check here or primer dimers will get through
-                        TooShort += 1
-                        continue
-                    if len(Seq) < args.trim_len and args.pad == 'on':
-                        pad = args.trim_len - len(Seq)
-                        Seq = Seq + pad*'N'
-                        Qual = Qual +pad*'J'
-                    else: #len(Seq) > args.trim_len:
-                        Seq = Seq[:args.trim_len]
-                        Qual = Qual[:args.trim_len]
-                #got here, reads are primers trimmed and trim/padded, check length
-                if len(Seq) < args.min_len:
+                    NoPrimer += 1
+                    Seq = seq
+                    Qual = qual
+            #now look for reverse primer
+            BestPosRev, BestDiffsRev = primer.QuickBestMatch2(Seq, RevPrimer, args.primer_mismatch)
+            if BestPosRev > 0:  #reverse primer was found
+                RevPrimerFound += 1
+                #location to trim sequences, trim seqs
+                Seq = Seq[:BestPosRev]
+                Qual = Qual[:BestPosRev]
+            else:
+                if args.full_length and len(Seq) > ReadLen: #if full length and no primer found, exit, except when length is less than read length
+                    continue
+            #if full_length is passed, then only trim primers
+            if not args.full_length:
+                #got here if primers were found they were trimmed
+                #now check seq length, pad if too short, trim if too long
+                if len(Seq) < args.min_len: #need this check here or primer dimers will get through
                     TooShort += 1
                     continue
-                ValidSeqs += 1     
-                #now fix header
-                Title = 'R_'+str(ValidSeqs)+';barcodelabel='+Sample+';'
-                #now write to file
-                out.write("@%s\n%s\n+\n%s\n" % (Title, Seq, Qual))
-            counts.write('%i,%i,%i,%i,%i\n' % (Total, NoPrimer, RevPrimerFound, TooShort, ValidSeqs))
+                if len(Seq) < args.trim_len and args.pad == 'on':
+                    pad = args.trim_len - len(Seq)
+                    Seq = Seq + pad*'N'
+                    Qual = Qual +pad*'J'
+                else: #len(Seq) > args.trim_len:
+                    Seq = Seq[:args.trim_len]
+                    Qual = Qual[:args.trim_len]
+            #got here, reads are primers trimmed and trim/padded, check length
+            if len(Seq) < args.min_len:
+                TooShort += 1
+                continue
+            ValidSeqs += 1     
+            Bases += len(Seq)
+            MinLen = len(Seq) if ValidSeqs == 1 else min(MinLen, len(Seq))
+            MaxLen = max(MaxLen, len(Seq))
+            #now fix header
+            Title = 'R_'+str(ValidSeqs)+';barcodelabel='+Sample+';'
+            #now write to file
+            out.write("@%s\n%s\n+\n%s\n" % (Title, Seq, Qual))
+    return [Total, NoPrimer, RevPrimerFound, TooShort, ValidSeqs, Bases, MinLen, MaxLen]
              
 #sometimes people add slashes in the output directory, this could be bad, try to fix it
 args.out = re.sub(r'\W+', '', args.out)
@@ -137,24 +155,12 @@ amptklib.SystemInfo()
 usearch = args.usearch
 amptklib.versionDependencyChecks(usearch)
 
-#check folder if files are gzipped, then gunzip them
-#try to gunzip files
-gzip_list = []
-for file in os.listdir(args.input):
-    if file.endswith(".fastq.gz"):
-        gzip_list.append(file)
-if gzip_list:
-    amptklib.log.info("Gzipped files detected, uncompressing")
-    for file in gzip_list:
-        amptklib.log.debug("Uncompressing %s" % file)
-        OutName = os.path.join(args.input, os.path.splitext(file)[0])
-        InFile = gzip.open(os.path.join(args.input, file), 'rU')
-        ReadFile = InFile.read()
-        OutFile = open(OutName, 'w')
-        OutFile.write(ReadFile)
-        OutFile.close()
-        InFile.close()
-        os.remove(os.path.join(args.input, file)) #remove .gz file  
+if not args.cpus:
+    cpus = multiprocessing.cpu_count()
+else:
+    cpus = args.cpus
+
+#gzipped FASTQ files are read directly, they are no longer uncompressed in the input folder
 
 #check for mapping file, if exists, then use names from first column only for filenames
 if args.mapping_file:
@@ -171,7 +177,7 @@ if args.mapping_file:
     filenames = []
     for file in os.listdir(args.input):
         if file.startswith(tuple(sample_names)):
-            if file.endswith('.fastq'):
+            if file.endswith('.fastq') or file.endswith('.fastq.gz'):
                 filenames.append(file)
     
     if len(filenames) < 1:
@@ -185,7 +191,7 @@ else: #if not then search through and find all the files you can in the folder
     #now get the FASTQ files and proceed
     filenames = []
     for file in os.listdir(args.input):
-        if file.endswith(".fastq"):
+        if file.endswith(".fastq") or file.endswith(".fastq.gz"):
             filenames.append(file)
     #look up primer db otherwise default to entry
     if args.F_primer in amptklib.primer_db:
@@ -197,6 +203,19 @@ else: #if not then search through and find all the files you can in the folder
     else:
         RevPrimer = args.R_primer
 
+#make sure primer is reverse complemented
+RevPrimer = revcomp_lib.RevComp(RevPrimer)
+
+#one pool of workers for merging and demuxing, the workers start when the first samples are
+#merged so everything processRead needs from here (primers, ReadLen) has to be set before then
+pool = amptklib.WorkerPool(cpus)
+
+#per-sample cache of merged and demuxed reads, keyed by a hash of the input files and the
+#options used for each step, so a re-run only redoes the samples/steps that changed
+CacheFile = os.path.join(args.out, 'amptk.cache.txt')
+Cache = amptklib.readCache(CacheFile)
+amptklib.setCountCache(os.path.join(args.out, 'amptk.counts.txt'))
+
 #if files are from SRA, then do something different as they are already merged
 if args.sra:
     #take list of filenames, move over to output folder
@@ -204,7 +223,14 @@ if args.sra:
     for x in filenames:
         rename = os.path.basename(x).split(".fastq",-1)[0]
         sampleDict[rename] = 'unknown'
-        shutil.copyfile(os.path.join(args.input, x), os.path.join(args.out, rename+'.fq'))
+        infile = os.path.join(args.input, x)
+        key = amptklib.cacheKey(amptklib.fileDigest(infile))
+        if Cache.get((rename, 'merge')) == key and amptklib.check_valid_file(os.path.join(args.out, rename+'.fq')):
+            amptklib.log.debug("Output for %s is up to date, skipping" % rename)
+            continue
+        amptklib.zcopy(infile, os.path.join(args.out, rename+'.fq'))
+        Cache[(rename, 'merge')] = key
+    amptklib.writeCache(Cache, CacheFile)
     ReadLen = args.min_len
 else:
     if len(filenames) % 2 != 0:
@@ -251,11 +277,10 @@ else:
                 else:
                     sampleDict[column[0]] = i5
 
-    #loop through each set and merge reads
-    if args.reads == 'paired':
-        amptklib.log.info("Merging Overlaping Pairs using USEARCH")
-
+    #loop through each set and queue up samples to merge
     ReadLengths = []
+    MergeJobs = []
+    MergeKeys = {}
     for i in range(0,len(fastq_for)):
         name = fastq_for[i].split("_")[0]
         outname = name + '.fq'
@@ -268,77 +293,134 @@ else:
                 read_length = args.read_length
             else:
                 read_length = amptklib.GuessRL(for_reads)
-            amptklib.log.info("working on sample %s (Read Length: %i)" % (name, read_length))
+            amptklib.log.debug("Sample %s (Read Length: %i)" % (name, read_length))
             #append read lengths for processReads function
             ReadLengths.append(read_length)
-            #checked for merged output, skip if it exists
-            if os.path.isfile(os.path.join(args.out, outname)):
-                amptklib.log.info("Output for %s detected, skipping files" % outname)
+            #skip merging if output exists from a run with the same input and options
+            digests = [amptklib.fileDigest(x) for x in [for_reads, rev_reads] if os.path.isfile(x)]
+            MergeKeys[name] = amptklib.cacheKey(args.reads, read_length, args.min_len, args.usearch, args.rescue_forward, *digests)
+            if Cache.get((name, 'merge')) == MergeKeys[name] and amptklib.check_valid_file(os.path.join(args.out, outname)):
+                amptklib.log.debug("Output for %s is up to date, skipping" % outname)
                 continue
-            #if PE reads, then need to merge them
-            if args.reads == 'paired' and amptklib.check_valid_file(rev_reads):                
-                amptklib.MergeReads(for_reads, rev_reads, args.out, name+'.fq', read_length, args.min_len, args.usearch, args.rescue_forward)
-            else:
-                shutil.copy(for_reads, os.path.join(args.out, outname))
+            MergeJobs.append((name, for_reads, rev_reads, read_length))
         else:
             amptklib.log.debug("ERROR: %s file is empty, skipping" % for_reads)
 
     #get read lengths for process read function
     ReadLen = max(set(ReadLengths))
 
-#Now all the data is in folder args.out that needs to be de-multiplexed
-if not args.cpus:
-    cpus = multiprocessing.cpu_count()
-else:
-    cpus = args.cpus
+    #run several samples at once, each gets an equal share of the cpus for usearch, and
+    #the largest samples are started first so the small ones fill in at the end of the run
+    if MergeJobs:
+        workers = min(cpus, len(MergeJobs))
+        threads = max(1, cpus // workers)
+        MergeJobs.sort(key=lambda x: sum(amptklib.getSize(f) for f in x[1:3] if os.path.isfile(f)), reverse=True)
+        MergeJobs = [x + (threads,) for x in MergeJobs]
+        if args.reads == 'paired':
+            amptklib.log.info("Merging Overlaping Pairs using USEARCH: %i samples, %i at a time" % (len(MergeJobs), workers))
+        else:
+            amptklib.log.info("Copying forward reads: %i samples" % len(MergeJobs))
+        for job, merged, seconds in pool.imap(mergeSample, MergeJobs):
+            amptklib.log.debug("%s merged in %.1f seconds" % (job[0], seconds))
+            if amptklib.check_valid_file(merged):
+                Cache[(job[0], 'merge')] = MergeKeys[job[0]]
+        amptklib.writeCache(Cache, CacheFile)
+    else:
+        amptklib.log.info("Merged reads for all samples are up to date")
 
-#get list of files to demux
+#get list of files to demux, only samples from this run, skipping those already demuxed with the same options
 file_list = []
-for file in os.listdir(args.out):
-    if file.endswith(".fq"):
-        if not file.endswith('.demux.fq'): #i don't want to demux the demuxed files.
-            file = os.path.join(args.out, file)
-            #check that the file is not empty
-            if amptklib.check_valid_file(file):
-                file_list.append(file)
-            else:
-                amptklib.log.debug("ERROR: %s demuxed file is empty, skipping" % file)
+sample_list = []
+DemuxKeys = {}
+for name in natsorted(sampleDict.keys()):
+    file = os.path.join(args.out, name+'.fq')
+    #check that the file is not empty
+    if not amptklib.check_valid_file(file):
+        amptklib.log.debug("ERROR: %s merged file is empty, skipping" % file)
+        continue
+    sample_list.append(name)
+    DemuxKeys[name] = amptklib.cacheKey(Cache.get((name, 'merge')), FwdPrimer, RevPrimer, args.primer, args.primer_mismatch, args.min_len, args.trim_len, args.pad, args.full_length, ReadLen)
+    if Cache.get((name, 'demux')) == DemuxKeys[name] and os.path.isfile(os.path.join(args.out, name+'.demux.fq')) and (name, 'stats') in Cache:
+        continue
+    for ext in ['.demux.fq', '.stats']:
+        if os.path.isfile(os.path.join(args.out, name+ext)):
+            os.remove(os.path.join(args.out, name+ext))
+    file_list.append(file)
+if len(file_list) < len(sample_list):
+    amptklib.log.info("Demuxed reads for %i of %i samples are up to date" % (len(sample_list)-len(file_list), len(sample_list)))
 if not args.full_length:
     amptklib.log.info("Stripping primers and trim/pad to %s bp" % (args.trim_len))
 else:
     amptklib.log.info("Stripping primers and keeping only full length sequences")
 amptklib.log.info("splitting the job over %i cpus, but this may still take awhile" % (cpus))
 
-#make sure primer is reverse complemented
-RevPrimer = revcomp_lib.RevComp(RevPrimer)
 amptklib.log.info("Foward primer: %s,  Rev comp'd rev primer: %s" % (FwdPrimer, RevPrimer))
 
-#finally process reads over number of cpus
-amptklib.runMultiProgress(processRead, file_list, cpus)
+#finally process reads over number of cpus, the stats of each sample are kept in the cache
+#next to its demux key so up to date samples are counted without demuxing them again
+for file, stats, seconds in pool.imap(processRead, file_list):
+    name = os.path.basename(file).split(".fq",-1)[0]
+    amptklib.log.debug("%s demuxed in %.1f seconds" % (name, seconds))
+    Cache[(name, 'demux')] = DemuxKeys[name]
+    Cache[(name, 'stats')] = ','.join([str(x) for x in stats])
+pool.close()
+amptklib.writeCache(Cache, CacheFile)
 print "-------------------------------------------------------"
-#Now concatenate all of the demuxed files together
-amptklib.log.info("Concatenating Demuxed Files")
+#sum the stats, each file holds one sample so ValidSeqs is also the count for its barcodelabel
+#(Total, NoPrimer, RevPrimerFound, TooShort, ValidSeqs, Bases, MinLen, MaxLen))
+finalstats = [0,0,0,0,0]
+BarcodeCount = {}
+SampleStats = {}
+for name in sample_list:
+    if (name, 'stats') in Cache:
+        newstats = [int(i) for i in Cache[(name, 'stats')].split(',')]
+        for x, num in enumerate(newstats[:5]):
+            finalstats[x] += num
+        SampleStats[name] = newstats
+        if newstats[4] > 0:
+            ID = name.split('_')[0]
+            if ID not in BarcodeCount:
+                BarcodeCount[ID] = newstats[4]
+            else:
+                BarcodeCount[ID] += newstats[4]
 
-catDemux = args.out + '.demux.fq'
-with open(catDemux, 'wb') as outfile:
-    for filename in glob.glob(os.path.join(args.out,'*.demux.fq')):
-        if filename == catDemux:
-            continue
-        with open(filename, 'rU') as readfile:
-            shutil.copyfileobj(readfile, outfile)
+#Now concatenate all of the demuxed files together, each sample is one block in the demux index
+amptklib.log.info("Concatenating Demuxed Files")
 
-#parse the stats
-#(Total, NoPrimer, RevPrimerFound, TooShort, ValidSeqs))
-finalstats = [0,0,0,0,0]
-for file in os.listdir(args.out):
-    if file.endswith('.stats'):
-        with open(os.path.join(args.out, file), 'rU') as statsfile:
-            line = statsfile.readline()
-            line = line.replace('\n', '')
-            newstats = line.split(',')
-            newstats = [int(i) for i in newstats]
-            for x, num in enumerate(newstats):
-                finalstats[x] += num           
+if args.binary == 'off':
+    catDemux = args.out + '.demux.fq'
+    index = amptklib.DemuxIndex()
+    indexed = True
+    offset = 0
+    with open(catDemux, 'wb') as outfile:
+        for name in sample_list:
+            filename = os.path.join(args.out, name+'.demux.fq')
+            if not os.path.isfile(filename):
+                continue
+            length = amptklib.getSize(filename)
+            stats = SampleStats.get(name, [])
+            if len(stats) < 8: #no read lengths in stats, can't index this sample
+                indexed = False
+            elif stats[4] > 0:
+                index.add(name.split('_')[0], offset, length, stats[4], stats[5], stats[6], stats[7])
+            with open(filename, 'rb') as readfile:
+                shutil.copyfileobj(readfile, outfile)
+            offset += length
+    if indexed:
+        index.write(catDemux)
+    elif os.path.isfile(catDemux+'.idx'):
+        os.remove(catDemux+'.idx')
+else:
+    #one block per sample in a binary .reads file, it carries its own per sample index
+    catDemux = args.out + '.demux.reads'
+    with readstore.ReadStoreWriter(catDemux, args.binary == 'binned') as store:
+        for name in sample_list:
+            filename = os.path.join(args.out, name+'.demux.fq')
+            if not os.path.isfile(filename):
+                continue
+            with open(filename, 'rU') as readfile:
+                for records in fastx.fastq_chunks(readfile):
+                    store.add(name.split('_')[0], [x[1] for x in records], [x[2] for x in records])
 
 #output stats of the run
 amptklib.log.info('{0:,}'.format(finalstats[0])+' total reads')
@@ -346,17 +428,6 @@ amptklib.log.info('{0:,}'.format(finalstats[0]-finalstats[1])+' Fwd Primer found
 amptklib.log.info('{0:,}'.format(finalstats[3])+' discarded too short (< %i bp)' % args.min_len)
 amptklib.log.info('{0:,}'.format(finalstats[4])+' valid output reads')
 
-#now loop through data and find barcoded samples, counting each.....
-BarcodeCount = {}
-with open(catDemux, 'rU') as input:
-    header = itertools.islice(input, 0, None, 4)
-    for line in header:
-        ID = line.split("=")[-1].split(";")[0]
-        if ID not in BarcodeCount:
-            BarcodeCount[ID] = 1
-        else:
-            BarcodeCount[ID] += 1
-
 #now let's count the barcodes found and count the number of times they are found.
 barcode_counts = "%30s:  %s" % ('Sample', 'Count')
 for k,v in natsorted(BarcodeCount.items(), key=lambda (k,v): v, reverse=True):
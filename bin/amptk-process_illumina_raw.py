@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import sys, os, inspect, argparse, shutil, logging, subprocess, multiprocessing, glob, itertools, re
+from cStringIO import StringIO
 from Bio import SeqIO
 from natsort import natsorted
 currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
@@ -10,6 +11,8 @@ import lib.fasta as fasta
 import lib.primer as primer
 import lib.revcomp_lib as revcomp_lib
 import lib.amptklib as amptklib
+import lib.barcode as barcode
+import lib.fastx as fastx
 
 class MyFormatter(argparse.ArgumentDefaultsHelpFormatter):
     def __init__(self,prog):
@@ -25,77 +28,66 @@ parser=argparse.ArgumentParser(prog='amptk-process_illumina_raw.py', usage="%(pr
     formatter_class=MyFormatter)
 
 parser.add_argument('-i','--fastq', dest='fastq', required=True, help='Illumina FASTQ R1 reads')
-parser.add_argument('--reverse', required=True, help='Illumina FASTQ R2 reads')
-parser.add_argument('--index', required=True, help='Illumina FASTQ index reads')
+parser.add_argument('--reverse', help='Illumina FASTQ R2 reads, without them R1 reads are used unmerged')
+parser.add_argument('--index', help='Illumina FASTQ index reads')
 parser.add_argument('--map_file', help='QIIME-like mapping tool')
 parser.add_argument('-o','--out', dest="out", default='illumina_out', help='Base name for output')
 parser.add_argument('-f','--fwd_primer', dest="F_primer", default='fITS7', help='Forward Primer')
 parser.add_argument('-r','--rev_primer', dest="R_primer", default='ITS4', help='Reverse Primer')
 parser.add_argument('--primer_mismatch', default=2, type=int, help='Number of mis-matches in primer')
+parser.add_argument('--barcode_mismatch', default=0, type=int, choices=[0, 1, 2], help='Number of mis-matches in barcode')
+parser.add_argument('--index_mismatch', default=2, type=int, choices=[0, 1, 2], help='Number of mis-matches in index read barcodes')
 parser.add_argument('--barcode_fasta', default='pgm_barcodes.fa', help='FASTA file containing Barcodes (Names & Sequences)')
 parser.add_argument('--reverse_barcode', help='FASTA file containing 3 prime Barocdes')
 parser.add_argument('-n','--name_prefix', dest="prefix", default='R_', help='Prefix for renaming reads')
 parser.add_argument('-m','--min_len', default='50', help='Minimum read length to keep')
 parser.add_argument('-l','--trim_len', default='250', help='Trim length for reads')
 parser.add_argument('--full_length', action='store_true', help='Keep only full length reads (no trimming/padding)')
+parser.add_argument('--mult_samples', dest="multi", default='False', help='Combine multiple samples (i.e. FACE1)')
 parser.add_argument('--cpus', type=int, help="Number of CPUs. Default: auto")
+parser.add_argument('--binary', default='off', choices=['off', 'on', 'binned'], help='Write demuxed reads as compact binary .reads, binned: 8 level qualities')
 parser.add_argument('-u','--usearch', dest="usearch", default='usearch8', help='USEARCH8 EXE')
 args=parser.parse_args()
 
-def FindBarcode(Seq, BarcodeDict):
-    for BarcodeLabel in BarcodeDict.keys():
-        Barcode = BarcodeDict[BarcodeLabel]
-        if Seq.startswith(Barcode):
-            return Barcode, BarcodeLabel
-    return "", ""
-
 def TrimRead(record, Ftrim, Rtrim, Name, Count):
-    #function to trim a seqrecord and rename
+    #function to trim a (title, seq, qual) record and rename
+    title, seq, qual = record
     if Rtrim:
-        record = record[Ftrim:Rtrim]
+        seq, qual = seq[Ftrim:Rtrim], qual[Ftrim:Rtrim]
     else:
-        record = record[Ftrim:]
+        seq, qual = seq[Ftrim:], qual[Ftrim:]
     #rename header
     if args.multi == 'False':
-        record.id = LabelPrefix + str(Count) + ";barcodelabel=" + Name + ";"
+        title = LabelPrefix + str(Count) + ";barcodelabel=" + Name + ";"
     elif args.multi != 'False':
         if args.multi.endswith('_'):
             args.multi = args.multi.replace('_', '')
-        record.id = LabelPrefix + str(Count) + ";barcodelabel=" + args.multi + "_" + Name + ";"
-    record.name = ''
-    record.description = ''
-    return record
+        title = LabelPrefix + str(Count) + ";barcodelabel=" + args.multi + "_" + Name + ";"
+    return title, seq, qual
 
 def ProcessReads(records):
     global OutCount
     for rec in records:
-        #convert to string for processing
-        Seq = str(rec.seq)
+        Seq = rec[1]
         
-        #look for barcodes
-        Barcode, BarcodeLabel = FindBarcode(Seq, Barcodes)
-        if Barcode == "": #if not found, try to find with mismatches
-            if args.barcode_mismatch > 0:
-                hit = [None, None, 0, None, None]
-                for k,v in Barcodes.items():
-                    alignment = amptklib.fuzzymatch(v, Seq, args.barcode_mismatch)
-                    if alignment:
-                        if alignment[0] > hit[2]:
-                            hit = [k, v, alignment[0], alignment[1], alignment[2]]
-                if hit[0] != None:
-                    BarcodeLength = hit[4] - hit[3] #might be shorter than actual barcode
-                    BarcodeLabel = hit[0]
-                    Barcode = hit[1]
-                else:
-                    continue
-            else:
+        if args.index:
+            #sample was assigned from the index read, no inline barcode
+            BarcodeLabel = rec[0].split(None, 1)[0].split('barcodelabel=')[-1].split(';')[0]
+            BarcodeLength = 0
+        else:
+            #look for barcodes, index also holds the --barcode_mismatch neighbors
+            Barcode, BarcodeLabel = Barcodes.find(Seq)
+            if Barcode == "":
                 continue
-        else: #barcode was found from dictionary
             BarcodeLength = len(Barcode)
 
         #now look for primer, if not found, move onto next record
         BestPosFor, BestDiffsFor = primer.BestMatch2(Seq, FwdPrimer, MAX_PRIMER_MISMATCHES)
-        if BestPosFor > 0 and BestPosFor <= BarcodeLength+2: #if found will be > 0, and should be found after barcode
+        if args.index:
+            PrimerFound = BestPosFor >= 0
+        else:
+            PrimerFound = BestPosFor > 0
+        if PrimerFound and BestPosFor <= BarcodeLength+2: #if found should be found after barcode
             ForTrim = BestPosFor + PL
         else:
             continue
@@ -104,7 +96,7 @@ def ProcessReads(records):
         OutCount += 1
 
         #look for reverse primer
-        BestPosRev, BestDiffsRev = primer.BestMatch2(Seq, RevPrimer, MAX_PRIMER_MISMATCHES)
+        BestPosRev, BestDiffsRev = primer.QuickBestMatch2(Seq, RevPrimer, MAX_PRIMER_MISMATCHES)
         if BestPosRev > 0:  #reverse primer was found    
             #location to trim sequences
             RevTrim = BestPosRev
@@ -113,22 +105,9 @@ def ProcessReads(records):
             if args.reverse_barcode:
                 BCcut = BestPosRev + RL
                 CutSeq = Seq[BCcut:]
-                if not CutSeq in RevBarcodes:
-                    if args.barcode_mismatch > 0:
-                        hit = [None, None, 0, None, None]
-                        for k,v in RevBarcodes.items():
-                            alignment = amptklib.fuzzymatch(k, CutSeq, args.barcode_mismatch)
-                            if alignment:
-                                if alignment[0] > hit[2]:
-                                    hit = [v, k, alignment[0], alignment[1], alignment[2]]
-                        if hit[0] != None:
-                            BCname = hit[0]
-                        else:
-                            continue
-                    else:
-                        continue
-                else:
-                    BCname = RevBarcodes.get(CutSeq)
+                RevBarcode, BCname = RevBarcodes.find(CutSeq)
+                if RevBarcode == "":
+                    continue
                 #update name
                 BarcodeLabel = BarcodeLabel+'_'+BCname
             
@@ -136,26 +115,16 @@ def ProcessReads(records):
             rec = TrimRead(rec, ForTrim, RevTrim, BarcodeLabel, OutCount)
             
             #check length       
-            L = len(rec.seq)
+            L = len(rec[1])
             if L < MinLen:
                 continue
             if not args.full_length:
-                #now check trim length, pad if necessary
+                #now check trim length, pad if necessary, padded bases get quality 40
                 if L < TrimLen:
                     pad = TrimLen - L
-                    Seq = str(rec.seq)
-                    Seq = Seq + pad*'N'
-                    Qual = rec.letter_annotations["phred_quality"]
-                    pad = TrimLen - L
-                    add = [40] * pad
-                    Qual.extend(add)
-                    del rec.letter_annotations["phred_quality"]
-                    rec.seq = Seq
-                    rec.letter_annotations["phred_quality"] = Qual
-                    yield rec
+                    yield rec[0], rec[1] + pad*'N', rec[2] + pad*'I'
                 elif L >= TrimLen:   
-                    rec = rec[:TrimLen]
-                    yield rec
+                    yield rec[0], rec[1][:TrimLen], rec[2][:TrimLen]
             else:
                 yield rec
 
@@ -164,20 +133,21 @@ def ProcessReads(records):
                 #trim record
                 rec = TrimRead(rec, ForTrim, False, BarcodeLabel, OutCount)
                 #check length
-                L = len(rec.seq)
+                L = len(rec[1])
                 if L < MinLen: #remove if shorter than minimum length
                     continue
                 #truncate down to trim length
                 if L >= TrimLen:
-                    rec = rec[:TrimLen]        
-                    yield rec
+                    yield rec[0], rec[1][:TrimLen], rec[2][:TrimLen]
 
-def worker(input):
-    output = input.split(".",-1)[0] + '.demux.fq'
-    with open(output, 'w') as o:
-        with open(input, 'rU') as i:
-            SeqRecords = SeqIO.parse(i, 'fastq')
-            SeqIO.write(ProcessReads(SeqRecords), o, 'fastq')  
+def worker(batch):
+    #batch is raw FASTQ text, returns demuxed FASTQ text and counts to the writer
+    Records = fastx.parse_fastq(batch)
+    Demuxed = list(ProcessReads(Records))
+    out = StringIO()
+    with fastx.FastqWriter(out) as writer:
+        writer.writerecords(Demuxed)
+    return len(batch), out.getvalue(), [len(Records), len(Demuxed)]
 
 args.out = re.sub(r'\W+', '', args.out)
 
@@ -203,17 +173,20 @@ if os.path.isfile(barcode_file):
     os.remove(barcode_file)
 
 #check if mapping file passed, use this if present, otherwise use command line arguments
-if args.mapping_file:
-    if not os.path.isfile(args.mapping_file):
-        amptklib.error("Mapping file is not valid: %s" % args.mapping_file)
+if args.map_file:
+    if not os.path.isfile(args.map_file):
+        amptklib.log.error("Mapping file is not valid: %s" % args.map_file)
         sys.exit(1)
-    mapdata = amptklib.parseMappingFile(args.mapping_file, barcode_file)
+    if args.index: #barcodes are index reads, not part of LinkerPrimerSequence
+        mapdata = amptklib.parseMappingFileIllumina(args.map_file)[1:]
+    else:
+        mapdata = amptklib.parseMappingFile(args.map_file, barcode_file)
     #forward primer in first item in tuple, reverse in second
     FwdPrimer = mapdata[0]
     RevPrimer = mapdata[1]
-    genericmapfile = args.mapping_file
+    genericmapfile = args.map_file
 else:
-    if args.barcode_fasta:
+    if not args.index:
         if not os.path.isfile(args.barcode_fasta):
             amptklib.error("Mapping file or barcode_fasta is required")
             sys.exit(1)
@@ -231,22 +204,24 @@ else:
     else:
         RevPrimer = args.R_primer
 
-#setup 
-if args.map_file:
-    mapdict = amptklib.mapping2dict(args.map_file)
-else:
-    mapdict = False
-
-print mapdict
-
-#now try to get index reads into dictionary
-indexReads = amptklib.barcodes2dict(args.index, mapdict)
-
-print indexReads
-sys.exit(1)
-
+#assign reads to samples from the index reads, streamed in lockstep with R1/R2
+if args.index:
+    if args.map_file:
+        mapdict = amptklib.mapping2dict(args.map_file)
+    else:
+        mapdict = False
+    amptklib.log.info("Assigning reads to samples from index reads: %s" % args.index)
+    IndexFor = args.out + '.index_R1.fq'
+    IndexRev = args.out + '.index_R2.fq'
+    if args.reverse:
+        total, IndexCounts = amptklib.indexDemux(args.index, [args.fastq, args.reverse], [IndexFor, IndexRev], mapdict, args.index_mismatch)
+        args.reverse = IndexRev
+    else:
+        total, IndexCounts = amptklib.indexDemux(args.index, [args.fastq], [IndexFor], mapdict, args.index_mismatch)
+    args.fastq = IndexFor
+    amptklib.log.info('{0:,}'.format(total) + ' index reads, ' + '{0:,}'.format(sum(IndexCounts.values())) + ' assigned to %i samples' % len(IndexCounts))
 
-if args.barcode_fasta == 'pgm_barcodes.fa':
+if not args.index and args.barcode_fasta == 'pgm_barcodes.fa':
     amptklib.log.error("You did not specify a --barcode_fasta, it is required this type of data")
     os._exit(1)
 if args.reverse:
@@ -280,32 +255,34 @@ else:
 RevPrimer = revcomp_lib.RevComp(RevPrimer)
 amptklib.log.info("Foward primer: %s,  Rev comp'd rev primer: %s" % (FwdPrimer, RevPrimer))
 
-#dealing with Barcodes, get ion barcodes or parse the barcode_fasta argument
-barcode_file = args.out + ".barcodes_used.fa"
-if os.path.isfile(barcode_file):
-    os.remove(barcode_file)
-
-if args.barcode_fasta == 'pgm_barcodes.fa':
-    #get script path and barcode file name
-    pgm_barcodes = os.path.join(parentdir, 'DB', args.barcode_fasta)
-    if args.barcodes == "all":
-        shutil.copyfile(pgm_barcodes, barcode_file)
+#inline barcodes, not needed if reads were assigned from index reads
+if not args.index:
+    #dealing with Barcodes, get ion barcodes or parse the barcode_fasta argument
+    barcode_file = args.out + ".barcodes_used.fa"
+    if os.path.isfile(barcode_file):
+        os.remove(barcode_file)
+
+    if args.barcode_fasta == 'pgm_barcodes.fa':
+        #get script path and barcode file name
+        pgm_barcodes = os.path.join(parentdir, 'DB', args.barcode_fasta)
+        if args.barcodes == "all":
+            shutil.copyfile(pgm_barcodes, barcode_file)
+        else:
+            bc_list = args.barcodes.split(",")
+            inputSeqFile = open(pgm_barcodes, "rU")
+            SeqRecords = SeqIO.to_dict(SeqIO.parse(inputSeqFile, "fasta"))
+            for rec in bc_list:
+                name = "BC_" + rec
+                seq = SeqRecords[name].seq
+                outputSeqFile = open(barcode_file, "a")
+                outputSeqFile.write(">%s\n%s\n" % (name, seq))
+            outputSeqFile.close()
+            inputSeqFile.close()
     else:
-        bc_list = args.barcodes.split(",")
-        inputSeqFile = open(pgm_barcodes, "rU")
-        SeqRecords = SeqIO.to_dict(SeqIO.parse(inputSeqFile, "fasta"))
-        for rec in bc_list:
-            name = "BC_" + rec
-            seq = SeqRecords[name].seq
-            outputSeqFile = open(barcode_file, "a")
-            outputSeqFile.write(">%s\n%s\n" % (name, seq))
-        outputSeqFile.close()
-        inputSeqFile.close()
-else:
-    shutil.copyfile(args.barcode_fasta, barcode_file)
+        shutil.copyfile(args.barcode_fasta, barcode_file)
 
-#setup barcode dictionary
-Barcodes = fasta.ReadSeqsDict(barcode_file)
+    #setup barcode index
+    Barcodes = barcode.BarcodeIndex(fasta.ReadSeqsDict(barcode_file), args.barcode_mismatch)
 
 #setup for looking for reverse barcode
 if args.reverse_barcode:
@@ -327,6 +304,7 @@ if args.reverse_barcode:
                 else:
                     amptklib.log.error("Duplicate reverse barcodes detected, exiting")
                     sys.exit(1)
+    RevBarcodes = barcode.BarcodeIndex(dict((v,k) for k,v in RevBarcodes.items()), args.barcode_mismatch)
     
 #get number of CPUs to use
 if not args.cpus:
@@ -343,72 +321,19 @@ PL = len(FwdPrimer)
 RL = len(RevPrimer)
 OutCount = 0
 
-#split the input FASTQ file into chunks to process
-with open(SeqIn, 'rU') as input:
-    SeqCount = amptklib.countfastq(SeqIn)
-    amptklib.log.info('{0:,}'.format(SeqCount) + ' records loaded')
-    SeqRecords = SeqIO.parse(SeqIn, 'fastq')
-    chunks = SeqCount / cpus + 1
-    amptklib.log.info("splitting job over %i cpus, this may still take awhile" % cpus)
-    #divide into chunks, store in tmp file
-    pid = os.getpid()
-    folder = 'amptk_tmp_' + str(pid)
-    if not os.path.exists(folder):
-        os.makedirs(folder)
-    for i, batch in enumerate(amptklib.batch_iterator(SeqRecords, chunks)) :
-        filename = "chunk_%i.fq" % (i+1)
-        tmpout = os.path.join(folder, filename)
-        handle = open(tmpout, "w")
-        count = SeqIO.write(batch, handle, "fastq")
-        handle.close()
-
-#now get file list from tmp folder
-file_list = []
-for file in os.listdir(folder):
-    if file.endswith(".fq"):
-        file = os.path.join(folder, file)
-        file_list.append(file)
-
-p = multiprocessing.Pool(cpus)
-for f in file_list:
-    p.apply_async(worker, [f])
-p.close()
-p.join()
-
+#stream the input FASTQ over cpus, demuxed reads are written to a single file
+size = amptklib.checkfastqsize(SeqIn)
+amptklib.log.info("Demuxing %s (%s), splitting job over %i cpus" % (SeqIn, amptklib.convertSize(size), cpus))
+#reads are renumbered and counted per barcode as they are written
+if args.binary == 'off':
+    catDemux = args.out + '.demux.fq'
+else:
+    catDemux = args.out + '.demux.reads'
+finalstats, BarcodeCount = amptklib.runStreamingDemux(worker, SeqIn, catDemux, cpus, binned=args.binary == 'binned')
 print "-------------------------------------------------------"
-#Now concatenate all of the demuxed files together
-amptklib.log.info("Concatenating Demuxed Files")
-
-tmpDemux = args.out + '.tmp.demux.fq'
-with open(tmpDemux, 'wb') as outfile:
-    for filename in glob.glob(os.path.join(folder,'*.demux.fq')):
-        if filename == tmpDemux:
-            continue
-        with open(filename, 'rU') as readfile:
-            shutil.copyfileobj(readfile, outfile)
-
-#clean up tmp folder
-shutil.rmtree(folder)
-
-#last thing is to re-number of reads as it is possible they could have same name from multitprocessor split
-catDemux = args.out + '.demux.fq'
-amptklib.fastqreindex(tmpDemux, catDemux)
-os.remove(tmpDemux)
-        
-amptklib.log.info("Counting FASTQ Records")
-total = amptklib.countfastq(catDemux)
-amptklib.log.info('{0:,}'.format(total) + ' reads processed')
-
-#now loop through data and find barcoded samples, counting each.....
-BarcodeCount = {}
-with open(catDemux, 'rU') as input:
-    header = itertools.islice(input, 0, None, 4)
-    for line in header:
-        ID = line.split("=")[-1].split(";")[0]
-        if ID not in BarcodeCount:
-            BarcodeCount[ID] = 1
-        else:
-            BarcodeCount[ID] += 1
+if finalstats:
+    amptklib.log.info('{0:,}'.format(finalstats[0]) + ' records loaded')
+    amptklib.log.info('{0:,}'.format(finalstats[1]) + ' reads processed')
 
 #now let's count the barcodes found and count the number of times they are found.
 barcode_counts = "%30s:  %s" % ('Sample', 'Count')
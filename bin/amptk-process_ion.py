@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 
 import sys, os, inspect, argparse, shutil, logging, subprocess, multiprocessing, glob, itertools, re, gzip
+from cStringIO import StringIO
 from Bio import SeqIO
 from Bio.SeqIO.QualityIO import FastqGeneralIterator
 from natsort import natsorted
+import numpy as np
 currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0,parentdir) 
@@ -11,6 +13,8 @@ import lib.fasta as fasta
 import lib.primer as primer
 import lib.revcomp_lib as revcomp_lib
 import lib.amptklib as amptklib
+import lib.barcode as barcode
+import lib.readbatch as readbatch
 
 class MyFormatter(argparse.ArgumentDefaultsHelpFormatter):
     def __init__(self,prog):
@@ -33,6 +37,7 @@ parser.add_argument('-r','--rev_primer', dest="R_primer", default='ITS4', help='
 parser.add_argument('-m','--mapping_file', help='Mapping file: QIIME format can have extra meta data columns')
 parser.add_argument('-p','--pad', default='on', choices=['on', 'off'], help='Pad with Ns to a set length')
 parser.add_argument('--primer_mismatch', default=2, type=int, help='Number of mis-matches in primer')
+parser.add_argument('--barcode_mismatch', default=0, type=int, choices=[0, 1, 2], help='Number of mis-matches in barcode')
 parser.add_argument('--barcode_fasta', default='pgm_barcodes.fa', help='FASTA file containing Barcodes (Names & Sequences)')
 parser.add_argument('--reverse_barcode', help='FASTA file containing 3 prime Barocdes')
 parser.add_argument('-b','--list_barcodes', dest="barcodes", default='all', help='Enter Barcodes used separated by commas')
@@ -45,101 +50,86 @@ parser.add_argument('--ion', action='store_true', help='Input data is Ion Torren
 parser.add_argument('--454', action='store_true', help='Input data is 454')
 parser.add_argument('--reverse', help='Illumina reverse reads')
 parser.add_argument('--cpus', type=int, help="Number of CPUs. Default: auto")
+parser.add_argument('--binary', default='off', choices=['off', 'on', 'binned'], help='Write demuxed reads as compact binary .reads, binned: 8 level qualities')
 parser.add_argument('-u','--usearch', dest="usearch", default='usearch9', help='USEARCH EXE')
 args=parser.parse_args()
 
-def FindBarcode(Seq, BarcodeDict):
-    for BarcodeLabel in BarcodeDict.keys():
-        Barcode = BarcodeDict[BarcodeLabel]
-        if Seq.startswith(Barcode):
-            return Barcode, BarcodeLabel
-    return "", ""
-
-def processRead(input):
-    base = os.path.basename(input).split('.')[0]
+def processRead(batch):
+    #batch is raw FASTQ text or a list of (title, seq, qual), returns demuxed FASTQ text and counts to the writer
+    #barcodes and primers are found read by read, trimming, padding and length filters are then
+    #done on the whole batch at once, see lib/readbatch.py
     PL = len(FwdPrimer)
     RL = len(RevPrimer)
-    DemuxOut = os.path.join(tmpdir, base+'.demux.fq')
-    StatsOut = os.path.join(tmpdir, base+'.stats')
     Total = 0
     NoBarcode = 0
     NoRevBarcode = 0
     NoPrimer = 0
-    TooShort = 0
     RevPrimerFound = 0
-    ValidSeqs = 0
-    with open(StatsOut, 'w') as counts:
-        with open(DemuxOut, 'w') as out:   
-            for title, seq, qual in FastqGeneralIterator(open(input)):
-                Total += 1
-                #look for barcode, trim it off
-                Barcode, BarcodeLabel = FindBarcode(seq, Barcodes)
-                if Barcode == "":
-                    NoBarcode += 1
-                    continue
-                BarcodeLength = len(Barcode)
-                Seq = seq[BarcodeLength:]
-                Qual = qual[BarcodeLength:]
-                #now search for forward primer
-                Diffs = primer.MatchPrefix(Seq, FwdPrimer)
-                if Diffs > args.primer_mismatch:
-                    NoPrimer += 1
-                    continue
-                ForTrim = PL      
-                #now search for reverse primer
-                BestPosRev, BestDiffsRev = primer.BestMatch2(Seq, RevPrimer, args.primer_mismatch)
-                if BestPosRev > 0:  #reverse primer was found
-                    RevPrimerFound += 1 
-                    #location to trim sequences
-                    RevTrim = BestPosRev                
-                    #determine reverse barcode
-                    if args.reverse_barcode:
-                        RevBCdiffs = 0
-                        BCcut = BestPosRev + RL
-                        CutSeq = Seq[BCcut:]
-                        RevBarcode, RevBarcodeLabel = FindBarcode(CutSeq, RevBarcodes)
-                        if RevBarcode == "":
-                            NoRevBarcode += 1
-                            continue
-                        BarcodeLabel = BarcodeLabel+'_'+RevBarcodeLabel                       
-                    #now trim record remove forward and reverse reads
-                    Seq = Seq[ForTrim:RevTrim]
-                    Qual = Qual[ForTrim:RevTrim]
-                    #since found reverse primer, now also need to pad/trim
-                    if not args.full_length:
-                        #check minimum length here or primer dimer type sequences will get padded with Ns
-                        if len(Seq) < int(args.min_len):
-                            TooShort += 1
-                            continue
-                        if len(Seq) < args.trim_len and args.pad == 'on':
-                            pad = args.trim_len - len(Seq)
-                            Seq = Seq + pad*'N'
-                            Qual = Qual +pad*'J'
-                        else: #len(Seq) > args.trim_len:
-                            Seq = Seq[:args.trim_len]
-                            Qual = Qual[:args.trim_len]
-                else:
-                    #trim record, did not find reverse primer
-                    if args.full_length: #if full length then move to next record
-                        continue
-                    #trim away forward primer
-                    Seq = Seq[ForTrim:]
-                    Qual = Qual[ForTrim:]
-                    #check length and trim, throw away if too short as it was bad read
-                    if len(Seq) < args.trim_len:
-                        TooShort += 1
-                        continue
-                    Seq = Seq[:args.trim_len]
-                    Qual = Qual[:args.trim_len]
-                #check minimum length
-                if len(Seq) < int(args.min_len):
-                    TooShort += 1
+    Labels = []
+    Seqs = []
+    Quals = []
+    BarcodeLengths = []
+    for title, seq, qual in amptklib.batch_records(batch):
+        Total += 1
+        #look for barcode
+        Barcode, BarcodeLabel = Barcodes.find(seq)
+        if Barcode == "":
+            NoBarcode += 1
+            continue
+        Labels.append(BarcodeLabel)
+        Seqs.append(seq)
+        Quals.append(qual)
+        BarcodeLengths.append(len(Barcode))
+    #trim off barcodes, then search for forward primer in all reads at once. Unless keeping full
+    #length reads, nothing past trim_len after the primer is written or changes which reads are kept
+    Width = None
+    if not args.full_length and BarcodeLengths:
+        Width = max(BarcodeLengths) + PL + args.trim_len
+    Reads = readbatch.ReadBatch(Seqs, Quals, width=Width)
+    Reads.trim_left(np.array(BarcodeLengths, dtype=np.int64))
+    Keep = Reads.prefix_diffs(FwdPrimer) <= args.primer_mismatch
+    NoPrimer = len(Reads) - int(Keep.sum())
+    #now search for reverse primer
+    RevTrims = np.zeros(len(Reads), dtype=np.int64)
+    for i in np.flatnonzero(Keep).tolist():
+        Seq = Seqs[i][BarcodeLengths[i]:]
+        BestPosRev, BestDiffsRev = primer.QuickBestMatch2(Seq, RevPrimer, args.primer_mismatch)
+        if BestPosRev > 0:  #reverse primer was found
+            RevPrimerFound += 1 
+            #determine reverse barcode
+            if args.reverse_barcode:
+                BCcut = BestPosRev + RL
+                CutSeq = Seq[BCcut:]
+                RevBarcode, RevBarcodeLabel = RevBarcodes.find(CutSeq)
+                if RevBarcode == "":
+                    NoRevBarcode += 1
+                    Keep[i] = False
                     continue
-                ValidSeqs += 1
-                #rename header
-                Name = 'R_'+str(ValidSeqs)+';barcodelabel='+BarcodeLabel+';'
-                out.write("@%s\n%s\n+\n%s\n" % (Name, Seq, Qual))
-            counts.write('%i,%i,%i,%i,%i,%i,%i\n' % (Total, NoBarcode, NoPrimer, RevPrimerFound, NoRevBarcode, TooShort, ValidSeqs))
+                Labels[i] = Labels[i]+'_'+RevBarcodeLabel
+            RevTrims[i] = BestPosRev
+        elif args.full_length: #if full length then move to next record
+            Keep[i] = False
+    #cut at reverse primer if found, then trim off forward primer
+    Found = RevTrims > 0
+    Reads.truncate(np.where(Found, RevTrims, Reads.lengths()))
+    Reads.trim_left(PL)
+    TooShort = np.zeros(len(Reads), dtype=bool)
+    if not args.full_length:
+        #check minimum length before padding or primer dimer type sequences will get padded with Ns,
+        #reads without reverse primer were bad reads if shorter than trim length
+        Lengths = Reads.lengths()
+        TooShort = np.where(Found, Lengths < int(args.min_len), Lengths < args.trim_len)
+        if args.pad == 'on':
+            Reads.pad(args.trim_len, rows=Keep & Found & ~TooShort)
+        Reads.truncate(args.trim_len)
+    #check minimum length
+    TooShort = Keep & (TooShort | (Reads.lengths() < int(args.min_len)))
+    Keep &= ~TooShort
+    TooShort = int(TooShort.sum())
+    ValidSeqs = int(Keep.sum())
+    #rename header
+    Names = ['R_'+str(i+1)+';barcodelabel='+Label+';' for i, Label in enumerate(itertools.compress(Labels, Keep))]
+    return len(batch), Reads.select(Keep).fastq(Names), [Total, NoBarcode, NoPrimer, RevPrimerFound, NoRevBarcode, TooShort, ValidSeqs]
 
 args.out = re.sub(r'\W+', '', args.out)
 
@@ -229,39 +219,21 @@ else:
     else:
         Adapter = ''
 
-#check if input is compressed
-gzip_list = []
+#compressed input is streamed as is, get the input format from the name without .gz
 if args.fastq.endswith('.gz'):
-    gzip_list.append(os.path.abspath(args.fastq))
-if args.reverse:
-    if args.reverse.endswith('.gz'):
-        gzip_list.append(os.path.abspath(args.reverse))
-if gzip_list:
-    amptklib.log.info("Gzipped input files detected, uncompressing")
-    for file in gzip_list:
-        amptklib.log.debug("Uncompressing %s" % file)
-        OutName = os.path.splitext(file)[0]
-        InFile = gzip.open(file, 'rU')
-        ReadFile = InFile.read()
-        OutFile = open(OutName, 'w')
-        OutFile.write(ReadFile)
-        OutFile.close()
-        InFile.close()
-        os.remove(file) #remove .gz file  
-    args.fastq = args.fastq.replace('.gz', '')
-    if args.reverse:
-        args.reverse = args.reverse.replace('.gz', '')
-        
-#if SFF file passed, convert to FASTQ with biopython
-if args.fastq.endswith(".sff"):
+    amptklib.log.info("Gzipped input detected, decompressing on the fly")
+    InputName = args.fastq[:-3]
+else:
+    InputName = args.fastq
+
+#SFF, FASTA + QUAL and BAM input are decoded on the fly and streamed straight into the demuxing
+if InputName.endswith(".sff"):
     if args.barcode_fasta == 'pgm_barcodes.fa':
         if not args.mapping_file:
             amptklib.log.error("You did not specify a --barcode_fasta or --mapping_file, one is required for 454 data")
             sys.exit(1)
-    amptklib.log.info("SFF input detected, converting to FASTQ")
-    SeqIn = args.out + '.sff.extract.fastq'
-    SeqIO.convert(args.fastq, "sff-trim", SeqIn, "fastq")
-elif args.fastq.endswith(".fas") or args.fastq.endswith(".fasta") or args.fastq.endswith(".fa"):
+    amptklib.log.info("SFF input detected, reading trimmed reads directly")
+elif InputName.endswith(".fas") or InputName.endswith(".fasta") or InputName.endswith(".fa"):
     if not args.qual:
         amptklib.log.error("FASTA input detected, however no QUAL file was given.  You must have FASTA + QUAL files")
         sys.exit(1)
@@ -270,25 +242,10 @@ elif args.fastq.endswith(".fas") or args.fastq.endswith(".fasta") or args.fastq.
             if not args.mapping_file:
                 amptklib.log.error("You did not specify a --barcode_fasta or --mapping_file, one is required for 454 data")
                 sys.exit(1)
-        SeqIn = args.out + '.fastq'
-        amptklib.log.info("FASTA + QUAL detected, converting to FASTQ")
-        amptklib.faqual2fastq(args.fastq, args.qual, SeqIn)
-elif args.fastq.endswith('.bam'):
-    #so we can convert natively with pybam, however it is 10X slower than bedtools/samtools
-    #since samtools is fastest, lets use that if exists, if not then bedtools, else default to pybam
-    amptklib.log.info("Converting Ion Torrent BAM file to FASTQ")
-    SeqIn = args.out+'.fastq'
-    if amptklib.which('samtools'):
-        cmd = ['samtools', 'fastq', '-@', str(cpus), args.fastq]
-        amptklib.runSubprocess2(cmd, amptklib.log, SeqIn)
-    else:
-        if amptklib.which('bedtools'):
-            cmd = ['bedtools', 'bamtofastq', '-i', args.fastq, '-fq', SeqIn]
-            amptklib.runSubprocess(cmd, amptklib.log)
-        else: #default to pybam
-            amptklib.bam2fastq(args.fastq, SeqIn)
-else:        
-    SeqIn = args.fastq
+        amptklib.log.info("FASTA + QUAL detected, reading paired records directly")
+elif InputName.endswith('.bam'):
+    amptklib.log.info("Ion Torrent BAM file detected, reading records directly")
+SeqIn = args.fastq
 
 #check if illumina argument is passed, if so then run merge PE
 if args.illumina:
@@ -312,8 +269,8 @@ if args.illumina:
 RevPrimer = revcomp_lib.RevComp(RevPrimer)
 amptklib.log.info("Foward primer: %s,  Rev comp'd rev primer: %s" % (FwdPrimer, RevPrimer))
 
-#then setup barcode dictionary
-Barcodes = fasta.ReadSeqsDict(barcode_file)
+#then setup barcode index, hash lookup of barcodes and their mismatch neighborhoods
+Barcodes = barcode.BarcodeIndex(fasta.ReadSeqsDict(barcode_file), args.barcode_mismatch)
 
 #setup for looking for reverse barcode
 if args.reverse_barcode:
@@ -336,69 +293,22 @@ if args.reverse_barcode:
                 else:
                     amptklib.log.error("Duplicate reverse barcodes detected, exiting")
                     sys.exit(1)
-#Count FASTQ records
-amptklib.log.info("Loading FASTQ Records")
-orig_total = amptklib.countfastq(SeqIn)
+    RevBarcodes = barcode.BarcodeIndex(RevBarcodes, args.barcode_mismatch)
+#Stream FASTQ records
 size = amptklib.checkfastqsize(SeqIn)
 readablesize = amptklib.convertSize(size)
-amptklib.log.info('{0:,}'.format(orig_total) + ' reads (' + readablesize + ')')
-
-#create tmpdir and split input into n cpus
-tmpdir = args.out.split('.')[0]+'_'+str(os.getpid())
-if not os.path.exists(tmpdir):
-    os.makedirs(tmpdir)
-#split the input FASTQ file into chunks to process
-with open(SeqIn, 'rU') as input:
-    SeqRecords = SeqIO.parse(SeqIn, 'fastq')
-    chunks = orig_total / (2*cpus)+1
-    #divide into chunks, store in tmp file
-    for i, batch in enumerate(amptklib.batch_iterator(SeqRecords, chunks)) :
-        filename = "chunk_%i.fq" % (i+1)
-        tmpout = os.path.join(tmpdir, filename)
-        handle = open(tmpout, "w")
-        count = SeqIO.write(batch, handle, "fastq")
-        handle.close()
-
-#now get file list from tmp folder
-file_list = []
-for file in os.listdir(tmpdir):
-    if file.endswith(".fq"):
-        file = os.path.join(tmpdir, file)
-        file_list.append(file)
-
-#finally process reads over number of cpus
-amptklib.runMultiProgress(processRead, file_list, cpus)
+amptklib.log.info("Demuxing %s (%s) over %i cpus" % (SeqIn, readablesize, cpus))
 
+#batches of reads are read here, demuxed over cpus, and written back to a single file, reads
+#are renumbered and counted per barcode as they are written
+if args.binary == 'off':
+    catDemux = args.out + '.demux.fq'
+else:
+    catDemux = args.out + '.demux.reads'
+finalstats, BarcodeCount = amptklib.runStreamingDemux(processRead, SeqIn, catDemux, cpus, qual=args.qual, binned=args.binary == 'binned')
+if not finalstats:
+    finalstats = [0,0,0,0,0,0,0]
 print "-------------------------------------------------------"
-#Now concatenate all of the demuxed files together
-amptklib.log.info("Concatenating Demuxed Files")
-
-tmpDemux = args.out + '.tmp.demux.fq'
-with open(tmpDemux, 'wb') as outfile:
-    for filename in glob.glob(os.path.join(tmpdir,'*.demux.fq')):
-        if filename == tmpDemux:
-            continue
-        with open(filename, 'rU') as readfile:
-            shutil.copyfileobj(readfile, outfile)
-#parse the stats
-finalstats = [0,0,0,0,0,0,0]
-for file in os.listdir(tmpdir):
-    if file.endswith('.stats'):
-        with open(os.path.join(tmpdir, file), 'rU') as statsfile:
-            line = statsfile.readline()
-            line = line.replace('\n', '')
-            newstats = line.split(',')
-            newstats = [int(i) for i in newstats]
-            for x, num in enumerate(newstats):
-                finalstats[x] += num
-            
-#clean up tmp folder
-shutil.rmtree(tmpdir)
-
-#last thing is to re-number of reads as it is possible they could have same name from multitprocessor split
-catDemux = args.out + '.demux.fq'
-amptklib.fastqreindex(tmpDemux, catDemux)
-os.remove(tmpDemux)
         
 amptklib.log.info('{0:,}'.format(finalstats[0])+' total reads')
 if args.reverse_barcode:
@@ -408,17 +318,6 @@ else:
     amptklib.log.info('{0:,}'.format(finalstats[0]-finalstats[1]-finalstats[2])+' Fwd Primer found, {0:,}'.format(finalstats[3])+ ' Rev Primer found')
 amptklib.log.info('{0:,}'.format(finalstats[5])+' discarded too short (< %i bp)' % args.min_len)
 amptklib.log.info('{0:,}'.format(finalstats[6])+' valid output reads')
-#now loop through data and find barcoded samples, counting each.....
-BarcodeCount = {}
-with open(catDemux, 'rU') as input:
-    header = itertools.islice(input, 0, None, 4)
-    for line in header:
-        ID = line.split("=",1)[-1].split(";")[0]
-        if ID not in BarcodeCount:
-            BarcodeCount[ID] = 1
-        else:
-            BarcodeCount[ID] += 1
-
 #now let's count the barcodes found and count the number of times they are found.
 barcode_counts = "%22s:  %s" % ('Sample', 'Count')
 barcodes_found = []
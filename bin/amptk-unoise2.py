@@ -66,6 +66,7 @@ amptklib.versionDependencyChecks(usearch)
 tmp = args.out + '_tmp'
 if not os.path.exists(tmp):
     os.makedirs(tmp)
+amptklib.setCountCache(os.path.join(tmp, 'amptk.counts.txt'))
 
 #Count FASTQ records
 amptklib.log.info("Loading FASTQ Records")
@@ -79,10 +80,8 @@ filter_out = os.path.join(tmp, args.out + '.EE' + args.maxee + '.filter.fq')
 filter_fasta = os.path.join(tmp, args.out + '.EE' + args.maxee + '.filter.fa')
 orig_fasta = os.path.join(tmp, args.out+'.orig.fa')
 amptklib.log.info("Quality Filtering, expected errors < %s" % args.maxee)
-cmd = ['vsearch', '--fastq_filter', args.FASTQ, '--fastq_maxee', str(args.maxee), '--fastqout', filter_out, '--fastaout', filter_fasta, '--fastq_qmax', '55']
-amptklib.runSubprocess(cmd, amptklib.log)
-cmd = ['vsearch', '--fastq_filter', args.FASTQ, '--fastaout', orig_fasta, '--fastq_qmax', '55']
-amptklib.runSubprocess(cmd, amptklib.log)
+#binary .reads input is filtered without exporting it, all reads are then mapped from it directly
+orig_fasta = amptklib.qualityFilter(args.FASTQ, args.maxee, filter_out, filter_fasta, orig_fasta)
 total = amptklib.countfastq(filter_out)
 amptklib.log.info('{0:,}'.format(total) + ' reads passed')
 
@@ -141,11 +140,12 @@ if args.map_filtered:
 else:
     reads = orig_fasta
 amptklib.log.info("Mapping Reads to iSeqs and Building OTU table")
-cmd = ['vsearch', '--usearch_global', reads, '--strand', 'plus', '--id', '0.97', '--db', iSeqs, '--uc', uc_iSeq_out, '--otutabout', iSeq_otu_table]
-amptklib.runSubprocess(cmd, amptklib.log)
-
-#count reads mapped
-total = amptklib.line_count(uc_iSeq_out)
+#search each unique sequence once and expand the hits by its abundance in each sample,
+#the same uniques are mapped to the clustered OTUs below
+uniques = os.path.join(tmp, args.out + '.EE' + args.maxee + '.uniques.fa')
+samples, abundances = amptklib.derepSamples(reads, uniques, amptklib.getCPUS(), tmp)
+amptklib.log.debug('{0:,}'.format(len(abundances)) + ' unique sequences to map')
+total = amptklib.mapUniques(uniques, abundances, samples, iSeqs, uc_iSeq_out, iSeq_otu_table)
 amptklib.log.info('{0:,}'.format(total) + ' reads mapped to OTUs '+ '({0:.0f}%)'.format(total/float(orig_total)* 100))
 
 #now cluster to biological OTUs with UCLUST
@@ -181,17 +181,8 @@ with open(ClusterComp, 'w') as clusters:
 #now map reads back to OTUs and build OTU table
 uc_out = os.path.join(tmp, args.out + '.EE' + args.maxee + '.cluster.mapping.uc')
 otu_table = os.path.join(tmp, args.out + '.EE' + args.maxee + '.cluster.otu_table.txt')
-#setup reads to map
-if args.map_filtered:
-    reads = filter_fasta
-else:
-    reads = orig_fasta
 amptklib.log.info("Mapping Reads to OTUs and Building OTU table")
-cmd = ['vsearch', '--usearch_global', reads, '--strand', 'plus', '--id', '0.97', '--db', uclust_out, '--uc', uc_out, '--otutabout', otu_table]
-amptklib.runSubprocess(cmd, amptklib.log)
-
-#count reads mapped
-total = amptklib.line_count(uc_out)
+total = amptklib.mapUniques(uniques, abundances, samples, uclust_out, uc_out, otu_table)
 amptklib.log.info('{0:,}'.format(total) + ' reads mapped to OTUs '+ '({0:.0f}%)'.format(total/float(orig_total)* 100))
 
 #Move files around, delete tmp if argument passed.
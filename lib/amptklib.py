@@ -1,9 +1,11 @@
-import sys, logging, csv, os, subprocess, multiprocessing, platform, time, shutil, inspect
+import sys, logging, csv, os, subprocess, multiprocessing, platform, time, shutil, inspect, itertools, gzip, threading, tempfile, hashlib, collections, mmap, signal
+from distutils.spawn import find_executable
 currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 parentdir = os.path.dirname(currentdir)
 from Bio import SeqIO
 from Bio.SeqIO.QualityIO import FastqGeneralIterator
 from natsort import natsorted
+import fastx
 
 ASCII = {'!':'0','"':'1','#':'2','$':'3','%':'4','&':'5',"'":'6','(':'7',')':'8','*':'9','+':'10',',':'11','-':'12','.':'13','/':'14','0':'15','1':'16','2':'17','3':'18','4':'19','5':'20','6':'21','7':'22','8':'23','9':'24',':':'25',';':'26','<':'27','=':'28','>':'29','?':'30','@':'31','A':'32','B':'33','C':'34','D':'35','E':'36','F':'37','G':'38','H':'39','I':'40','J':'41','K':'42','L':'43','M':'44','N':'45','O':'46','P':'47','Q':'48','R':'49','S':'50'}
 
@@ -14,38 +16,357 @@ class colr:
     END = '\033[0m'
     WARN = '\033[93m'
         
+class DecompressPipe(object):
+    #file-like handle on the stdout of a decompression helper process, the exit status of the
+    #helper is checked at end of file and on close() so a truncated or corrupt file raises
+    #IOError instead of looking like a shorter one. tell() is the number of bytes read so far,
+    #readers such as the SFF parser ask for it
+    def __init__(self, cmd):
+        self.cmd = cmd
+        #python ignores SIGPIPE, put it back so the helper just stops if the pipe is closed early.
+        #close_fds, so a helper started from a FifoWorker thread does not hold other pipe ends open
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=-1, close_fds=True, preexec_fn=lambda: signal.signal(signal.SIGPIPE, signal.SIG_DFL))
+        self.handle = self.proc.stdout
+        self.checked = False
+        self.pos = 0
+    def __iter__(self):
+        for line in self.handle:
+            self.pos += len(line)
+            yield line
+        self.check()
+    def __getattr__(self, name):
+        return getattr(self.handle, name)
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+    def read(self, *args):
+        data = self.handle.read(*args)
+        self.pos += len(data)
+        if not data:
+            self.check()
+        return data
+    def readline(self, *args):
+        line = self.handle.readline(*args)
+        self.pos += len(line)
+        if not line:
+            self.check()
+        return line
+    def tell(self):
+        return self.pos
+    def check(self, stopped=False):
+        #stopped: the reader closed the pipe early, so the helper dying of SIGPIPE is fine
+        if self.checked:
+            return
+        self.checked = True
+        status = self.proc.wait()
+        if status and not (stopped and status == -signal.SIGPIPE):
+            raise IOError("%s failed with exit status %i, file is truncated or corrupt" % (' '.join(self.cmd), status))
+    def close(self):
+        self.handle.close()
+        self.check(stopped=True)
+
+def zopen(input, mode='rU'):
+    #open plain or gzipped input for streaming, compressed files are inflated on the fly
+    #and never written to disk. pigz/gzip in a helper process is used when found so
+    #decompression runs on its own core, otherwise fall back to the gzip module
+    if not input.endswith('.gz'):
+        return open(input, mode)
+    for prog in ['pigz', 'gzip']:
+        if find_executable(prog):
+            return DecompressPipe([prog, '-dc', input])
+    return gzip.open(input, 'rb')
+
+def zcopy(input, output):
+    #write plain or gzipped input uncompressed to output
+    with open(output, 'w') as outfile:
+        with zopen(input) as infile:
+            shutil.copyfileobj(infile, outfile)
+
+def fdLimit():
+    #number of files a process may keep open, leave some for everything else
+    try:
+        import resource
+        soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        if soft == resource.RLIM_INFINITY:
+            soft = 4096
+    except (ImportError, ValueError):
+        soft = 512
+    return max(min(soft, 4096) - 64, 8)
+
+#empty BGZF block that ends every BGZF file (SAM specification, section 4.1.2)
+BGZF_EOF = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+class MultiWriter(object):
+    '''
+    Write reads to many output files (one per sample) at once.  Writes are buffered per
+    file and flushed in large chunks through a pool of at most maxopen open handles,
+    the least recently used handle is closed when the pool is full and re-opened in
+    append mode when that file is flushed again.  compress can be 'gzip' or 'bgzf',
+    re-opening a gzip file appends a new gzip member which gzip readers handle
+    transparently, re-opening a BGZF file drops its EOF block and appends new blocks.
+    '''
+    def __init__(self, compress=False, maxopen=None, bufsize=65536):
+        self.compress = compress
+        self.maxopen = maxopen or fdLimit()
+        self.bufsize = bufsize
+        self.handles = collections.OrderedDict()
+        self.buffers = {}
+        self.opened = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _open(self, filename):
+        #files are truncated the first time they are opened and appended to after that
+        mode = 'ab' if filename in self.opened else 'wb'
+        self.opened.add(filename)
+        if self.compress == 'gzip':
+            return gzip.open(filename, mode)
+        elif self.compress == 'bgzf':
+            from Bio import bgzf
+            #BgzfWriter has no append mode, an empty block mid-file ends reading there for
+            #some readers so the EOF block written by the last close is cut off first
+            if mode == 'wb':
+                return bgzf.BgzfWriter(fileobj=open(filename, 'wb'))
+            handle = open(filename, 'r+b')
+            handle.seek(-len(BGZF_EOF), 2)
+            if handle.read() == BGZF_EOF:
+                handle.seek(-len(BGZF_EOF), 2)
+                handle.truncate()
+            return bgzf.BgzfWriter(fileobj=handle)
+        return open(filename, mode)
+
+    def _flush(self, filename):
+        chunks = self.buffers.pop(filename, None)
+        if not chunks:
+            return
+        handle = self.handles.pop(filename, None)
+        if handle is None:
+            if len(self.handles) >= self.maxopen:
+                self.handles.popitem(last=False)[1].close()
+            handle = self._open(filename)
+        self.handles[filename] = handle
+        handle.write(''.join(chunks[1:]))
+
+    def write(self, filename, data):
+        #first item of each buffer is its size in bytes
+        if filename not in self.buffers:
+            self.buffers[filename] = [0]
+        chunks = self.buffers[filename]
+        chunks.append(data)
+        chunks[0] += len(data)
+        if chunks[0] >= self.bufsize:
+            self._flush(filename)
+
+    def close(self):
+        for filename in self.buffers.keys():
+            self._flush(filename)
+        for handle in self.handles.values():
+            handle.close()
+        self.handles.clear()
+
 def myround(x, base=10):
     return int(base * round(float(x)/base))
 
 def GuessRL(input):
     #read first 50 records, get length then exit
     lengths = []
-    for title, seq, qual in FastqGeneralIterator(open(input)):
-        if len(lengths) < 50:
-            lengths.append(len(seq))
-        else:
-            break
+    with zopen(input) as infile:
+        for title, seq, qual in FastqGeneralIterator(infile):
+            if len(lengths) < 50:
+                lengths.append(len(seq))
+            else:
+                break
     return myround(max(set(lengths)))
 
-def countfasta(input):
+#counts of files, keyed by (absolute path, kind) with the size and mtime they were counted at.
+#Counts are always kept in memory, setCountCache() makes them persistent in a cache file that
+#belongs to the run (in its output or tmp folder), input folders are never written to
+CountCache = {}
+CountCacheFile = None
+
+def setCountCache(output):
+    #load counts from output, if it exists, and keep new counts there from now on
+    global CountCacheFile
+    CountCacheFile = output
+    if os.path.isfile(output):
+        with open(output, 'rU') as infile:
+            for line in infile:
+                cols = line.rstrip('\n').split('\t')
+                if len(cols) == 5 and cols[4].isdigit():
+                    CountCache[(cols[0], cols[1])] = ('\t'.join(cols[2:4]), int(cols[4]))
+
+def writeCountCache(output):
+    #tab delimited: file, kind, size, mtime, count. Entries of files that are gone are dropped,
+    #written to a tmp file and renamed so an interrupted run (or worker processes writing at
+    #the same time) never leaves a partial cache
+    tmpout = '%s.%i.tmp' % (output, os.getpid())
+    with open(tmpout, 'w') as outfile:
+        for name, kind in sorted(CountCache.keys()):
+            if os.path.isfile(name):
+                stamp, count = CountCache[(name, kind)]
+                outfile.write('%s\t%s\t%s\t%i\n' % (name, kind, stamp, count))
+    os.rename(tmpout, output)
+
+def fileStamp(input):
+    #size and mtime (microseconds) of input, tab separated
+    st = os.stat(input)
+    return '%i\t%i' % (st.st_size, int(st.st_mtime * 1000000))
+
+def cachedCount(input, kind, counter):
+    #counter(input) is only run if input changed since it was last counted in this run
+    path = os.path.abspath(input)
+    stamp = fileStamp(path)
+    cached = CountCache.get((path, kind))
+    if cached and cached[0] == stamp:
+        return cached[1]
+    count = counter(path)
+    CountCache[(path, kind)] = (stamp, count)
+    if CountCacheFile:
+        writeCountCache(CountCacheFile)
+    return count
+
+def readBlocks(input, size=1048576):
+    #contents of plain or gzipped input in large blocks, plain files are memory mapped
+    if input.endswith('.gz') or getSize(input) == 0:
+        with zopen(input, 'rb') as infile:
+            for block in iter(lambda: infile.read(size), ''):
+                yield block
+        return
+    with open(input, 'rb') as infile:
+        mapped = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for i in xrange(0, len(mapped), size):
+                yield mapped[i:i+size]
+        finally:
+            mapped.close()
+
+def countLines(input):
+    #number of lines, a last line without a newline is counted
     count = 0
-    with open(input, 'rU') as f:
-        for line in f:
-            if line.startswith (">"):
-                count += 1
+    last = '\n'
+    for block in readBlocks(input):
+        count += block.count('\n')
+        last = block[-1]
+    if last != '\n':
+        count += 1
     return count
-    
-def countfastq(input):
-    lines = sum(1 for line in open(input))
-    count = int(lines) / 4
+
+def countLinesStarting(input, char):
+    #number of lines that start with char
+    count = 0
+    last = '\n'
+    for block in readBlocks(input):
+        count += block.count('\n'+char)
+        if last == '\n' and block.startswith(char):
+            count += 1
+        last = block[-1]
     return count
 
+def countfasta(input):
+    return cachedCount(input, 'fasta', lambda x: countLinesStarting(x, '>'))
+
+def countfastq(input):
+    if seqFormat(input) == 'reads':
+        import readstore
+        return readstore.ReadStore(input).total()
+    index = loadDemuxIndex(input)
+    if index:
+        return index.total()
+    return cachedCount(input, 'fastq', countLines) / 4
+
+class DemuxIndex(object):
+    '''
+    Sidecar index of a demuxed FASTQ file (written next to it as <file>.idx).  For each
+    sample it keeps the read count, total bases, min/max read length and the byte blocks
+    (offset, length) of the file that hold its reads, so counts can be answered without
+    reading the FASTQ and a sample's reads can be read by seeking straight to them.
+    '''
+    def __init__(self):
+        self.samples = {}
+
+    def add(self, sample, offset, length, reads, bases, minlen, maxlen):
+        #one contiguous block of reads all from sample
+        if sample not in self.samples:
+            self.samples[sample] = [0, 0, minlen, maxlen, []]
+        stats = self.samples[sample]
+        stats[0] += reads
+        stats[1] += bases
+        stats[2] = min(stats[2], minlen)
+        stats[3] = max(stats[3], maxlen)
+        stats[4].append((offset, length))
+
+    def counts(self):
+        return dict((k, v[0]) for k, v in self.samples.items())
+
+    def total(self):
+        return sum(v[0] for v in self.samples.values())
+
+    def records(self, input, samples):
+        #yield (title, seq, qual) for the reads of samples, in sample order
+        with open(input, 'rb') as fastq:
+            for sample in samples:
+                if sample not in self.samples:
+                    continue
+                for offset, length in self.samples[sample][4]:
+                    fastq.seek(offset)
+                    block = fastq.read(length)
+                    for rec in fastx.parse_fastq(block):
+                        yield rec
+
+    def write(self, input):
+        #first line holds the size and mtime of the FASTQ so a stale index is ignored, call
+        #once the FASTQ is closed
+        with open(input+'.idx', 'w') as out:
+            out.write('#amptk-demux-index\t%s\n' % fileStamp(input))
+            out.write('#Sample\tReads\tBases\tMinLen\tMaxLen\tBlocks\n')
+            for sample in natsorted(self.samples.keys()):
+                reads, bases, minlen, maxlen, blocks = self.samples[sample]
+                out.write('%s\t%i\t%i\t%i\t%i\t%s\n' % (sample, reads, bases, minlen, maxlen, ','.join(['%i:%i' % x for x in blocks])))
+
+def loadDemuxIndex(input):
+    #return DemuxIndex for a demuxed FASTQ, or None if it has no index or the index is stale
+    IndexFile = input + '.idx'
+    if not os.path.isfile(IndexFile) or not os.path.isfile(input):
+        return None
+    index = DemuxIndex()
+    with open(IndexFile, 'rU') as infile:
+        header = infile.readline().rstrip('\n').split('\t')
+        if header[0] != '#amptk-demux-index' or '\t'.join(header[1:]) != fileStamp(input):
+            return None
+        for line in infile:
+            if line.startswith('#'):
+                continue
+            cols = line.rstrip('\n').split('\t')
+            blocks = [tuple([int(i) for i in x.split(':')]) for x in cols[5].split(',') if x]
+            index.samples[cols[0]] = [int(cols[1]), int(cols[2]), int(cols[3]), int(cols[4]), blocks]
+    return index
+
+def getBarcodeCounts(input):
+    #reads per barcodelabel, from the demux index when there is one
+    if seqFormat(input) == 'reads':
+        import readstore
+        return readstore.ReadStore(input).counts()
+    index = loadDemuxIndex(input)
+    if index:
+        return index.counts()
+    BarcodeCount = {}
+    with open(input, 'rU') as infile:
+        header = itertools.islice(infile, 0, None, 4)
+        for line in header:
+            ID = line.split("=")[-1].split(";")[0]
+            if ID not in BarcodeCount:
+                BarcodeCount[ID] = 1
+            else:
+                BarcodeCount[ID] += 1
+    return BarcodeCount
+
 def line_count(fname):
-    with open(fname) as f:
-        i = -1
-        for i, l in enumerate(f):
-            pass
-    return i + 1
+    return cachedCount(fname, 'lines', countLines)
 
 def line_count2(fname):
     count = 0
@@ -72,6 +393,12 @@ def runSubprocess(cmd, logfile):
         logfile.debug(stdout)
     if stderr:
         logfile.debug(stderr)
+    return proc.returncode
+
+def checkFailed(cmd, status, logfile=None):
+    #log and raise CalledProcessError for a command that exited with a non-zero status
+    (logfile or log).error("%s exited with status %i" % (' '.join(cmd), status))
+    raise subprocess.CalledProcessError(status, ' '.join(cmd))
 
 def runSubprocess2(cmd, logfile, output):
     #function where output of cmd is STDOUT, capture STDERR in logfile
@@ -101,48 +428,151 @@ def check_valid_file(input):
 def bam2fastq(input, output):
     import pybam
     with open(output, 'w') as fastqout:
-        with open(input, 'rb') as bamin:
-            for title, seq, qual in pybam.read(bamin,['sam_qname', 'sam_seq','sam_qual']):
-                fastqout.write("@%s\n%s\n+\n%s\n" % (title, seq, qual))
+        for batch in pybam.fastq_batches(input):
+            fastqout.write(''.join(["@%s\n%s\n+\n%s\n" % rec for rec in batch]))
                 
-def MergeReads(R1, R2, tmpdir, outname, read_length, minlen, usearch, rescue):
-    pretrim_R1 = os.path.join(tmpdir, outname + '.pretrim_R1.fq')
-    pretrim_R2 = os.path.join(tmpdir, outname + '.pretrim_R2.fq')
-    log.debug("Removing index 3prime bp 'A' from reads")    
-    cmd = ['vsearch', '--fastq_filter', R1, '--fastq_trunclen', str(read_length), '--fastqout', pretrim_R1]
-    runSubprocess(cmd, log)
-    cmd = ['vsearch', '--fastq_filter', R2, '--fastq_trunclen', str(read_length), '--fastqout', pretrim_R2]
-    runSubprocess(cmd, log)
-
-    #next run USEARCH mergepe
+class FifoWorker(threading.Thread):
+    #thread that runs work(handle) on one end of a named pipe, mode 'w' feeds a process
+    #reading the pipe and mode 'r' drains a process writing to it. The return value of
+    #work is kept in self.result, an error in work (including the other end going away
+    #before everything was written) is kept and raised by finish()
+    def __init__(self, fifo, mode, work):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.fifo = fifo
+        self.mode = mode
+        self.work = work
+        self.result = 0
+        self.error = None
+    def run(self):
+        try:
+            with open(self.fifo, self.mode) as handle:
+                self.result = self.work(handle)
+        except Exception as e:
+            self.error = e
+    def finish(self, check=True):
+        #call once the process on the other end has exited, if it never opened the pipe
+        #open the other end here so the thread is not left blocked forever. With check,
+        #an error in the thread is raised here as IOError
+        if self.is_alive():
+            try:
+                if self.mode == 'w':
+                    fd = os.open(self.fifo, os.O_RDONLY | os.O_NONBLOCK)
+                else:
+                    fd = os.open(self.fifo, os.O_WRONLY | os.O_NONBLOCK)
+                os.close(fd)
+            except OSError:
+                pass
+        self.join()
+        if check and self.error is not None:
+            raise IOError("%s of %s failed: %s" % ('writing' if self.mode == 'w' else 'reading', self.fifo, self.error))
+        return self.result
+
+def MergeReads(R1, R2, tmpdir, outname, read_length, minlen, usearch, rescue, threads=False):
+    #reads are passed between the trimming, merging and phix steps through named pipes, only
+    #the merged/not-merged reads written by usearch and the final output go to disk. A usearch
+    #build that cannot stream a pipe (seeks its input, exits non-zero or stops reading early)
+    #gets the sample again through regular temp files
+    pipedir = tempfile.mkdtemp(prefix=os.path.basename(outname)+'.', dir=tmpdir)
+    try:
+        try:
+            return mergeSteps(R1, R2, tmpdir, pipedir, outname, read_length, minlen, usearch, rescue, threads, True)
+        except (subprocess.CalledProcessError, IOError) as e:
+            log.debug("%s: named pipes failed (%s), rerunning with temp files" % (outname, e))
+            for f in os.listdir(pipedir):
+                os.remove(os.path.join(pipedir, f))
+        return mergeSteps(R1, R2, tmpdir, pipedir, outname, read_length, minlen, usearch, rescue, threads, False)
+    finally:
+        shutil.rmtree(pipedir)
+
+def mergeSteps(R1, R2, tmpdir, pipedir, outname, read_length, minlen, usearch, rescue, threads, pipes):
+    #trim, merge and phix filter one sample, intermediates in pipedir are named pipes with
+    #pipes, otherwise temp files written before (or read after) each usearch step
+    pretrim_R1 = os.path.join(pipedir, 'pretrim_R1.fq')
+    pretrim_R2 = os.path.join(pipedir, 'pretrim_R2.fq')
+    phix_in = os.path.join(pipedir, 'phix_in.fq')
+    phix_out = os.path.join(pipedir, 'phix_out.fq')
+    if pipes:
+        for fifo in [pretrim_R1, pretrim_R2, phix_in, phix_out]:
+            os.mkfifo(fifo)
+
+    def runStep(cmd, feeds, drains):
+        #feeds are (path, work) written for cmd to read, drains (path, work) read from what cmd
+        #wrote, returns the results of work in that order. Through pipes a failed usearch or
+        #thread raises without logging an error, the caller retries with temp files
+        if pipes:
+            workers = [FifoWorker(f, 'w', work) for f, work in feeds] + [FifoWorker(f, 'r', work) for f, work in drains]
+            for t in workers:
+                t.start()
+            status = runSubprocess(cmd, log)
+            for t in workers:
+                t.finish(check=False)
+            if status:
+                raise subprocess.CalledProcessError(status, ' '.join(cmd))
+            return [t.finish() for t in workers]
+        results = []
+        for f, work in feeds:
+            with open(f, 'w') as handle:
+                results.append(work(handle))
+        status = runSubprocess(cmd, log)
+        if status:
+            checkFailed(cmd, status)
+        for f, work in drains:
+            with open(f, 'rU') as handle:
+                results.append(work(handle))
+        return results
+
+    def trimReads(input):
+        #same as vsearch --fastq_trunclen, reads shorter than read_length are dropped
+        def work(handle):
+            count = 0
+            with zopen(input) as infile:
+                for title, seq, qual in fastx.fastq_records(infile):
+                    count += 1
+                    if len(seq) < read_length:
+                        continue
+                    handle.write("@%s\n%s\n+\n%s\n" % (title, seq[:read_length], qual[:read_length]))
+            return count
+        return work
+
+    #next run USEARCH mergepe on the reads with the index 3prime bp 'A' removed
     merge_out = os.path.join(tmpdir, outname + '.merged.fq')
     skip_for = os.path.join(tmpdir, outname + '.notmerged.R1.fq')
     report = os.path.join(tmpdir, outname +'.merge_report.txt')
     log.debug("Now merging PE reads")
     cmd = [usearch, '-fastq_mergepairs', pretrim_R1, '-reverse', pretrim_R2, '-fastqout', merge_out, '-fastq_trunctail', '5', '-fastqout_notmerged_fwd', skip_for,'-minhsp', '12','-fastq_maxdiffs', '8', '-report', report, '-fastq_minmergelen', str(minlen)]
-    runSubprocess(cmd, log)
-    #now concatenate files for downstream pre-process_illumina.py script
+    if threads:
+        cmd = cmd + ['-threads', str(threads)]
+    origcount = runStep(cmd, [(pretrim_R1, trimReads(R1)), (pretrim_R2, trimReads(R2))], [])[0]
+
+    #now concatenate files straight into phix removal and count the output as it is written
     final_out = os.path.join(tmpdir, outname)
-    tmp_merge = os.path.join(tmpdir, outname+'.tmp')
-    with open(tmp_merge, 'w') as cat_file:
-        shutil.copyfileobj(open(merge_out,'rU'), cat_file)
-        if rescue == 'on':
-            shutil.copyfileobj(open(skip_for,'rU'), cat_file)
-    #run phix removal
+    parts = [merge_out]
+    if rescue == 'on':
+        parts.append(skip_for)
+    def catReads(handle):
+        for f in parts:
+            if os.path.isfile(f):
+                with open(f, 'rU') as infile:
+                    shutil.copyfileobj(infile, handle)
+    def saveReads(handle):
+        lines = 0
+        with open(final_out, 'w') as outfile:
+            for line in handle:
+                outfile.write(line)
+                lines += 1
+        return lines / 4
     log.debug("Removing phix from %s" % outname)
-    cmd = [usearch, '-filter_phix', tmp_merge, '-output', final_out]
-    runSubprocess(cmd, log)
-    #count output
-    origcount = countfastq(R1)
-    finalcount = countfastq(final_out)
-    pct_out = finalcount / float(origcount) 
+    cmd = [usearch, '-filter_phix', phix_in, '-output', phix_out]
+    if threads:
+        cmd = cmd + ['-threads', str(threads)]
+    finalcount = runStep(cmd, [(phix_in, catReads)], [(phix_out, saveReads)])[1]
+    pct_out = finalcount / float(max(origcount, 1))
     #clean and close up intermediate files
-    os.remove(merge_out)
-    os.remove(pretrim_R1)
-    os.remove(pretrim_R2)
-    os.remove(skip_for)
-    os.remove(tmp_merge)
-    return log.info('{0:,}'.format(finalcount) + ' reads passed ('+'{0:.1%}'.format(pct_out)+')')
+    for f in [merge_out, skip_for]:
+        if os.path.isfile(f):
+            os.remove(f)
+    return log.info(outname.split('.fq')[0] + ': {0:,}'.format(finalcount) + ' reads passed ('+'{0:.1%}'.format(pct_out)+')')
 
 def dictFlip(input):
     #flip the list of dictionaries
@@ -180,35 +610,44 @@ def exactmatch(seq1, seq2):
         return False
 
 
-def barcodes2dict(input, mapDict):
-    from Bio.SeqIO.QualityIO import FastqGeneralIterator
-    #here expecting the index reads from illumina, create dictionary for naming?
-    BCdict = {}
-    for title, seq, qual in FastqGeneralIterator(open(input)):
-        readID = title.split(' ')[0]
+def indexDemux(index, reads, outputs, mapDict, mismatches):
+    #walk the illumina index reads and R1 (and R2) in lockstep so memory stays constant
+    #index barcodes are corrected with a precomputed mismatch table, reads are labeled
+    #with their sample in the header and unassigned reads are dropped
+    import barcode
+    if mapDict:
+        BCindex = barcode.BarcodeIndex(dict((v,k) for k,v in mapDict.items()), mismatches)
+    BCcount = {}
+    total = 0
+    inputs = [fastx.fastq_records(zopen(index))] + [fastx.fastq_records(zopen(x)) for x in reads]
+    handles = [open(x, 'w') for x in outputs]
+    names = [index] + reads
+    for records in itertools.izip_longest(*inputs):
+        if None in records:
+            short = [x for x, rec in zip(names, records) if rec is None]
+            log.error("%s ended before the other reads, files have different numbers of records" % ', '.join(short))
+            sys.exit(1)
+        total += 1
+        readID = records[0][0].split(' ')[0]
+        for title, seq, qual in records[1:]:
+            if title.split(' ')[0] != readID:
+                log.error("Index and reads are not in the same order: %s != %s" % (readID, title.split(' ')[0]))
+                sys.exit(1)
         if mapDict:
-            if seq in mapDict:
-                BC = mapDict.get(seq)
-            else:
-                hit = [None, None, 0, None, None]
-                for k,v in mapDict.items():
-                    alignment = fuzzymatch(k, seq, '2')
-                    if alignment:
-                        if alignment[0] > hit[2]:
-                            hit = [k, v, alignment[0], alignment[1], alignment[2]]
-                    else:
-                        continue
-                if hit[0] != None:
-                    BC = hit[1]
-                else:
-                    continue
+            BC = BCindex.find(records[0][1])[1]
+            if BC == "":
+                continue
         else:
-            BC = seq
-        if not readID in BCdict:
-            BCdict[readID] = BC
+            BC = records[0][1]
+        for (title, seq, qual), out in zip(records[1:], handles):
+            out.write("@%s;barcodelabel=%s;\n%s\n+\n%s\n" % (readID, BC, seq, qual))
+        if not BC in BCcount:
+            BCcount[BC] = 1
         else:
-            print "duplicate read ID found: %s" % readID
-    return BCdict
+            BCcount[BC] += 1
+    for out in handles:
+        out.close()
+    return total, BCcount
 
 def mapping2dict(input):
     #parse a qiime mapping file pull out seqs and ID into dictionary
@@ -282,24 +721,89 @@ def checkRversion():
     dada2 = versions.split(',')[1]
     return (Rvers, dada2)
 
+class WorkerError(Exception):
+    pass
+
+def _runTask(task):
+    #run one task in a worker, errors come back with the worker traceback instead of being raised
+    index, function, input = task
+    start = time.time()
+    try:
+        return index, function(input), time.time() - start, None
+    except Exception:
+        import traceback
+        return index, None, time.time() - start, traceback.format_exc()
+
+class WorkerPool(object):
+    '''
+    Pool of worker processes that can be reused for several stages of a script.
+    imap() yields (input, result, seconds) for each task as it finishes, so the
+    parent gets counters and output paths back from the function directly and
+    progress is redrawn when a task completes rather than on a timer.  An error
+    in a worker stops the pool and is raised here as WorkerError with the
+    worker's traceback.  Workers are forked on the first imap(), so globals the
+    task functions read must be set before then, and functions must be defined
+    at the top level of a module to be sent to the workers.
+    '''
+    def __init__(self, cpus):
+        self.cpus = cpus
+        self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    def imap(self, function, inputList, progress=True):
+        inputList = list(inputList)
+        for index, result, seconds in self._run(function, inputList, progress):
+            yield inputList[index], result, seconds
+
+    def map(self, function, inputList, progress=True):
+        #results of function over inputList, in the same order as inputList
+        inputList = list(inputList)
+        results = [None] * len(inputList)
+        for index, result, seconds in self._run(function, inputList, progress):
+            results[index] = result
+        return results
+
+    def _run(self, function, inputList, progress):
+        if not inputList:
+            return
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.cpus)
+        tasks = [(i, function, x) for i, x in enumerate(inputList)]
+        done = 0
+        for index, result, seconds, error in self.pool.imap_unordered(_runTask, tasks):
+            if error is not None:
+                self.terminate()
+                raise WorkerError("%s failed on %s\n%s" % (function.__name__, inputList[index], error))
+            done += 1
+            if progress:
+                sys.stdout.write("     Progress: %.2f%% \r" % (float(done) / len(tasks) * 100))
+                sys.stdout.flush()
+            yield index, result, seconds
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def terminate(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
 def runMultiProgress(function, inputList, cpus):
-    #setup pool
-    p = multiprocessing.Pool(cpus)
-    #setup results and split over cpus
-    tasks = len(inputList)
-    results = []
-    for i in inputList:
-        results.append(p.apply_async(function, [i]))
-    #refresh pbar every 5 seconds
-    while True:
-        incomplete_count = sum(1 for x in results if not x.ready())
-        if incomplete_count == 0:
-            break
-        sys.stdout.write("     Progress: %.2f%% \r" % (float(tasks - incomplete_count) / tasks * 100))
-        sys.stdout.flush()
-        time.sleep(1)
-    p.close()
-    p.join()
+    #run function over inputList on a pool of cpus, returns the results in input order
+    with WorkerPool(cpus) as pool:
+        return pool.map(function, inputList)
 
 def MemoryCheck():
     import psutil
@@ -339,6 +843,222 @@ def batch_iterator(iterator, batch_size):
         if batch :
             yield batch
 
+def seqFormat(input):
+    #input format from the file extension, a trailing .gz is ignored
+    if input.endswith('.gz'):
+        input = input[:-3]
+    if input.endswith('.sff'):
+        return 'sff'
+    elif input.endswith('.fas') or input.endswith('.fasta') or input.endswith('.fa'):
+        return 'fasta'
+    elif input.endswith('.bam'):
+        return 'bam'
+    elif input.endswith('.reads'):
+        return 'reads'
+    return 'fastq'
+
+def bamRecords(input, cpus=1):
+    #samtools is fastest, then bedtools, pybam batch decoder is slower but always there
+    if which('samtools'):
+        cmd = ['samtools', 'fastq', '-@', str(cpus), input]
+    elif which('bedtools'):
+        cmd = ['bedtools', 'bamtofastq', '-i', input, '-fq', '/dev/stdout']
+    else:
+        import pybam
+        for batch in pybam.fastq_batches(input, cpus=cpus):
+            for rec in batch:
+                yield rec
+        return
+    log.debug(' '.join(cmd))
+    with open(os.devnull, 'w') as devnull:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=devnull, bufsize=-1)
+        for rec in fastx.fastq_records(proc.stdout):
+            yield rec
+        proc.stdout.close()
+        proc.wait()
+
+def fourLineFastq(input, records=1000):
+    #True if the first records of a FASTQ file are 4 lines each, which the line based batching
+    #and fastx need. Wrapped (multi-line) FASTQ is read with FastqGeneralIterator instead
+    with zopen(input) as infile:
+        lines = [x.rstrip('\r\n') for x in itertools.islice(infile, 4*records)]
+    while lines and not lines[-1]:
+        lines.pop()
+    if len(lines) % 4:
+        return False
+    for i in xrange(0, len(lines), 4):
+        if not lines[i].startswith('@') or not lines[i+2].startswith('+') or len(lines[i+1]) != len(lines[i+3]):
+            return False
+    return True
+
+def readRecords(input, qual=None, cpus=1):
+    #stream (title, seq, qual) tuples from FASTQ, SFF, FASTA + QUAL or BAM input, plain
+    #or gzipped, without converting to an intermediate FASTQ file
+    format = seqFormat(input)
+    if format == 'sff':
+        for rec in SeqIO.parse(zopen(input, 'rb'), 'sff-trim'):
+            yield rec.id, str(rec.seq), ''.join([chr(q+33) for q in rec.letter_annotations['phred_quality']])
+    elif format == 'fasta':
+        from Bio.SeqIO.QualityIO import PairedFastaQualIterator
+        for rec in PairedFastaQualIterator(zopen(input), zopen(qual)):
+            Quals = rec.letter_annotations['phred_quality']
+            if Quals and max(Quals) > 93: #can't be written as FASTQ, skipped as before
+                continue
+            yield rec.id, str(rec.seq), ''.join([chr(q+33) for q in Quals])
+    elif format == 'bam':
+        for rec in bamRecords(input, cpus):
+            yield rec
+    elif format == 'reads':
+        import readstore
+        for rec in readstore.ReadStore(input).records():
+            yield rec
+    elif fourLineFastq(input):
+        with zopen(input) as infile:
+            for rec in fastx.fastq_records(infile):
+                yield rec
+    else:
+        with zopen(input) as infile:
+            for rec in FastqGeneralIterator(infile):
+                yield rec
+
+def record_batches(records, batch_size):
+    #yield lists of batch_size (title, seq, qual) tuples
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            break
+        yield batch
+
+class BamRange(object):
+    #alignments of a BAM file between two BGZF virtual offsets, handed to a demux worker in
+    #place of a batch so the worker decompresses and decodes its own part of the file. It
+    #iterates (title, seq, qual) like a list of tuples, len() is the number of reads decoded
+    def __init__(self, input, start, end):
+        self.input = input
+        self.start = start
+        self.end = end
+        self.reads = 0
+
+    def __len__(self):
+        return self.reads
+
+    def __iter__(self):
+        import pybam
+        for batch in pybam.fastq_batches(self.input, start=self.start, end=self.end):
+            self.reads += len(batch)
+            for rec in batch:
+                yield rec
+
+def bamRanges(input, cpus, chunk=4194304):
+    #split a bgzip compressed BAM file into BamRanges of about chunk compressed bytes at
+    #alignment boundaries, at least a few per cpu. None if the BAM can't be read at random
+    import pybam
+    try:
+        reader = pybam.bgzf(input)
+    except pybam.PybamError:
+        return None
+    parts = max(4*cpus, getSize(input) // chunk + 1)
+    return [BamRange(input, start, end) for start, end in reader.split(parts)]
+
+def batch_records(batch):
+    #iterate (title, seq, qual) of a batch, either raw FASTQ text, a list of tuples or a BamRange
+    if isinstance(batch, basestring):
+        return fastx.parse_fastq(batch)
+    return batch
+
+def fastq_batches(input, batch_size):
+    #yield raw FASTQ text of batch_size records at a time, records are not parsed
+    with zopen(input) as infile:
+        while True:
+            lines = list(itertools.islice(infile, 4*batch_size))
+            if not lines:
+                break
+            yield ''.join(lines)
+
+def runStreamingDemux(function, input, output, cpus, batch_size=10000, qual=None, binned=False):
+    #stream batches of raw reads through function(batch) -> (len(batch), demuxed text, [counters])
+    #over a pool, a single writer here collects output and sums the counters. FASTQ input is
+    #passed to the workers as raw text, other formats (SFF, FASTA + QUAL, BAM) and wrapped FASTQ,
+    #which can't be split into batches by lines, are decoded here and passed as lists of
+    #(title, seq, qual), see batch_records(). When BAM input would
+    #be decoded by pybam, each worker is given a BamRange of the file instead. The writer also
+    #renumbers reads R_1..R_n as they are written, so IDs are unique across batches, and builds
+    #the demux index (output.idx). An output ending in .reads is written as a binary readstore
+    #instead, with qualities binned if binned. Returns ([counters], {barcodelabel: count})
+    filesize = float(max(getSize(input), 1))
+    stats = []
+    done = 0
+    count = 0
+    index = DemuxIndex()
+    offset = 0
+    format = seqFormat(input)
+    batches = None
+    if format == 'fastq' and fourLineFastq(input):
+        batches = fastq_batches(input, batch_size)
+    elif format == 'bam' and not which('samtools') and not which('bedtools'):
+        batches = bamRanges(input, cpus)
+    if batches is None:
+        batches = record_batches(readRecords(input, qual, cpus), batch_size)
+    store = None
+    if seqFormat(output) == 'reads':
+        import readstore
+        store = readstore.ReadStoreWriter(output, binned)
+    else:
+        outfile = open(output, 'w')
+    p = multiprocessing.Pool(cpus)
+    try:
+        for size, demux, counts in p.imap_unordered(function, batches):
+            #group the batch by sample so each sample's reads are one block in the index
+            groups = {}
+            lines = demux.split('\n')
+            for i in xrange(0, len(lines)-1, 4):
+                label = lines[i].split(';')[1]
+                ID = label.split('=',1)[-1]
+                if ID not in groups:
+                    groups[ID] = []
+                if store:
+                    groups[ID].append(i)
+                    continue
+                count += 1
+                groups[ID].append('@R_%i;%s;\n%s\n+\n%s\n' % (count, label, lines[i+1], lines[i+3]))
+            for ID, reads in groups.items():
+                if store:
+                    store.add(ID, [lines[i+1] for i in reads], [lines[i+3] for i in reads])
+                    continue
+                block = ''.join(reads)
+                lengths = [len(x.split('\n', 2)[1]) for x in reads]
+                index.add(ID, offset, len(block), len(reads), sum(lengths), min(lengths), max(lengths))
+                outfile.write(block)
+                offset += len(block)
+            if not stats:
+                stats = [0]*len(counts)
+            for x, num in enumerate(counts):
+                stats[x] += num
+            done += size
+            if format != 'fastq': #size is number of reads for decoded batches
+                sys.stdout.write("     Progress: {0:,} reads \r".format(done))
+            elif input.endswith('.gz'): #compressed size says little about how much is left
+                sys.stdout.write("     Progress: %s \r" % convertSize(done))
+            else:
+                sys.stdout.write("     Progress: %.2f%% \r" % (min(done / filesize, 1.0) * 100))
+            sys.stdout.flush()
+    except:
+        #don't leave workers running (and the interpreter waiting on them) if a batch fails
+        p.terminate()
+        p.join()
+        raise
+    finally:
+        if store:
+            store.close()
+        else:
+            outfile.close()
+    p.close()
+    p.join()
+    if store:
+        return stats, store.counts()
+    index.write(output)
+    return stats, index.counts()
+
 def setupLogging(LOGNAME):
     global log
     if 'win32' in sys.platform:
@@ -358,51 +1078,157 @@ def setupLogging(LOGNAME):
     log.addHandler(fhnd)
     
 def FastMaxEEFilter(input, trunclen, maxee, output):
-    from Bio.SeqIO.QualityIO import FastqGeneralIterator
+    #reads truncated to trunclen with expected errors <= maxee, shorter reads are kept as they are
+    import eefilter
     with open(output, 'w') as out:
         with open(input, 'rU') as file:
-            for title, seq, qual in FastqGeneralIterator(file):
-                trunclen = int(trunclen)
-                Seq = seq[:trunclen]
-                Qual = qual[:trunclen]
-                ee = 0
-                for bp, Q in enumerate(Qual):
-                    q = int(ASCII.get(Q))
-                    P = 10**(float(-q)/10)
-                    ee += P
-                if ee <= float(maxee):
-                    out.write("@%s\n%s\n+\n%s\n" % (title, Seq, Qual))
+            with fastx.FastqWriter(out) as writer:
+                for records in fastx.fastq_chunks(file):
+                    writer.writerecords(eefilter.filter_records(records, float(maxee), int(trunclen)))
+
+def qualityFilter(input, maxee, fastqout, fastaout, origfasta):
+    #reads with expected errors <= maxee to fastqout and fastaout, returns the file of all reads
+    #to map back to OTUs. FASTQ goes through vsearch --fastq_filter with all reads to origfasta,
+    #a binary .reads file is filtered here in one pass and returned itself, derepSamples() reads
+    #it as is. Empty reads are dropped as vsearch does (--fastq_minlen 1)
+    if seqFormat(input) != 'reads':
+        cmd = ['vsearch', '--fastq_filter', input, '--fastq_maxee', str(maxee), '--fastqout', fastqout, '--fastaout', fastaout, '--fastq_qmax', '55']
+        runSubprocess(cmd, log)
+        cmd = ['vsearch', '--fastq_filter', input, '--fastaout', origfasta, '--fastq_qmax', '55']
+        runSubprocess(cmd, log)
+        return origfasta
+    import eefilter
+    import readstore
+    store = readstore.ReadStore(input)
+    try:
+        with open(fastqout, 'w') as fq:
+            with open(fastaout, 'w') as fa:
+                with fastx.FastqWriter(fq) as fqwriter:
+                    with fastx.FastaWriter(fa) as fawriter:
+                        for records in record_batches(store.records(), 100000):
+                            passed = eefilter.filter_records([x for x in records if x[1]], float(maxee))
+                            fqwriter.writerecords(passed)
+                            fawriter.writerecords(passed)
+    finally:
+        store.close()
+    return input
 
 def MaxEEFilter(input, maxee):
-    from Bio import SeqIO
+    from Bio.SeqRecord import SeqRecord
+    from Bio.Seq import Seq
+    import eefilter
     with open(input, 'rU') as f:
-        for rec in SeqIO.parse(f, "fastq"):
-            ee = 0
-            for bp, Q in enumerate(rec.letter_annotations["phred_quality"]):
-                P = 10**(float(-Q)/10)
-                ee += P
-            if ee <= float(maxee):
-                rec.name = ""
-                rec.description = ""
-                yield rec
+        for records in fastx.fastq_chunks(f):
+            for title, seq, qual in eefilter.filter_records(records, float(maxee)):
+                yield SeqRecord(Seq(seq), id=title.split(None, 1)[0], name="", description="", letter_annotations={"phred_quality": [ord(x)-33 for x in qual]})
                 
-def dereplicate(input, output):
-    from Bio.SeqIO.QualityIO import FastqGeneralIterator
-    seqs = {}
-    with open(input, 'rU') as file:
-        for title, sequence, qual in FastqGeneralIterator(file):
-            if sequence not in seqs:
-                if title.endswith(';'):
-                    seqs[sequence]=title+'size=1;'
-                else:
-                    seqs[sequence]=title+';size=1;'
-            else:
-                count = int(seqs[sequence].split('=')[-1].rstrip(';')) + 1
-                formated_string = seqs[sequence].rsplit('=', 1)[0]+'='+str(count)+';'
-                seqs[sequence] = formated_string
+def derepBuckets(input, cpus, memory):
+    #number of bucket files so that cpus buckets counted at once fit in memory bytes, a
+    #bucket takes about 3 times its share of the input once counted (gzip ~4x smaller)
+    size = getSize(input) * (4 if input.endswith('.gz') else 1)
+    return min(max(cpus, int(3 * cpus * size // memory) + 1), fdLimit())
+
+def derepUniques(input, cpus=1, memory=2147483648, label=None, tmpdir=None):
+    #dereplicate FASTQ, FASTA or any input readRecords() takes without holding it in memory, see
+    #lib/derep.py. Returns ({sample: reads}, uniques), uniques yields (title, seq, size,
+    #{sample: count}) most abundant first, title is from the first read with that sequence.
+    #label(title) adds a field that has to match as well. Temporary files go in a folder in
+    #tmpdir that is removed when uniques is exhausted or closed
+    import derep
+    folder = tempfile.mkdtemp(prefix='amptk_derep_', dir=tmpdir)
+    try:
+        #about 1 KB per unique held before spilling
+        parts = derep.Partitioner(folder, derepBuckets(input, cpus, memory), label, max(memory // 1024, 1000))
+        format = seqFormat(input)
+        if format == 'fasta':
+            chunks = fastx.fasta_chunks(zopen(input))
+        elif format == 'fastq':
+            chunks = fastx.fastq_chunks(zopen(input))
+        else:
+            chunks = record_batches(readRecords(input, cpus=cpus), 100000)
+        for chunk in chunks:
+            parts.add(chunk)
+        buckets = parts.close()
+        runs = [x[:-len('.bin')] + '.run' for x in buckets]
+        if cpus > 1:
+            with WorkerPool(cpus) as pool:
+                pool.map(derep.count_bucket, zip(buckets, runs), progress=False)
+        else:
+            map(derep.count_bucket, zip(buckets, runs))
+    except:
+        shutil.rmtree(folder)
+        raise
+    def uniques():
+        try:
+            for rec in derep.merge_runs(runs):
+                yield rec
+        finally:
+            shutil.rmtree(folder)
+    return parts.samples, uniques()
+
+def dereplicate(input, output, cpus=1, memory=2147483648, table=None):
+    #unique sequences of input to FASTA output as title;size=N; most abundant first, table
+    #if given gets reads of each unique per sample (barcodelabel)
+    samples, uniques = derepUniques(input, cpus, memory, tmpdir=os.path.dirname(os.path.abspath(output)))
+    samples = natsorted(samples)
+    tab = None
+    if table:
+        tab = open(table, 'w')
+        tab.write('#OTU ID\t%s\n' % '\t'.join(samples))
+    with open(output, 'w') as out:
+        with fastx.FastaWriter(out) as writer:
+            for title, seq, size, counts in uniques:
+                writer.write('%s%ssize=%i;' % (title, '' if title.endswith(';') else ';', size), seq)
+                if tab:
+                    tab.write('%s\t%s\n' % (title.split(';', 1)[0], '\t'.join([str(counts.get(x, 0)) for x in samples])))
+    if tab:
+        tab.close()
+
+def derepSamples(reads, output, cpus=1, tmpdir=None):
+    #write the unique sequences of reads to output FASTA as U_<n>;size=<reads>; and return
+    #(samples, abundances), abundances[n-1] is {sample: reads} of unique n. Searching these with
+    #mapUniques() gives the same OTU table as mapping every read, duplicates are searched once
+    samples, uniques = derepUniques(reads, cpus, tmpdir=tmpdir)
+    abundances = []
     with open(output, 'w') as out:
-        for sequence in seqs:
-            out.write('>'+seqs[sequence]+'\n'+sequence+'\n')
+        with fastx.FastaWriter(out) as writer:
+            for title, seq, size, counts in uniques:
+                abundances.append(counts)
+                writer.write('U_%i;size=%i;' % (len(abundances), size), seq)
+    return sorted(samples), abundances
+
+def mapUniques(uniques, abundances, samples, db, uc, otu_table, identity='0.97'):
+    #map uniques from derepSamples() to db with vsearch and expand the hits to an OTU table in
+    #the --otutabout layout: samples and OTUs in plain sorted (byte) order, as vsearch keeps
+    #them, OTUs without reads left out. Returns the number of reads with a line in the .uc
+    #file, hit or not, which is what line_count() of the .uc gave when every read was mapped
+    cmd = ['vsearch', '--usearch_global', uniques, '--strand', 'plus', '--id', str(identity), '--db', db, '--uc', uc]
+    status = runSubprocess(cmd, log)
+    if status:
+        checkFailed(cmd, status)
+    table = {}
+    searched = 0
+    mapped = 0
+    with open(uc, 'rU') as hits:
+        for line in hits:
+            cols = line.rstrip('\n').split('\t')
+            if cols[0] not in ('H', 'N'):
+                continue
+            counts = abundances[int(cols[8].split(';', 1)[0][2:]) - 1]
+            reads = sum(counts.values())
+            searched += reads
+            if cols[0] == 'N':
+                continue
+            mapped += reads
+            otu = table.setdefault(cols[9], {})
+            for sample, count in counts.items():
+                otu[sample] = otu.get(sample, 0) + count
+    with open(otu_table, 'w') as output:
+        output.write('#OTU ID\t%s\n' % '\t'.join(samples))
+        for otu in sorted(table):
+            output.write('%s\t%s\n' % (otu, '\t'.join([str(table[otu].get(x, 0)) for x in samples])))
+    log.debug('%s: %i OTUs x %i samples, sorted by label; %s of %s reads hit an OTU' % (otu_table, len(table), len(samples), '{0:,}'.format(mapped), '{0:,}'.format(searched)))
+    return searched
 
 def convertSize(num, suffix='B'):
     for unit in ['','K','M','G','T','P','E','Z']:
@@ -411,11 +1237,45 @@ def convertSize(num, suffix='B'):
         num /= 1024.0
     return "%.1f%s%s" % (num, 'Y', suffix) 
 
+def fileDigest(input):
+    #sha1 of the file contents, read in 1 MB blocks. Kept in the count cache (as an integer)
+    #so a rerun only hashes files whose size or mtime changed
+    def digest(path):
+        h = hashlib.sha1()
+        with open(path, 'rb') as infile:
+            for block in iter(lambda: infile.read(1048576), ''):
+                h.update(block)
+        return int(h.hexdigest(), 16)
+    return '%040x' % cachedCount(input, 'sha1', digest)
+
+def cacheKey(*items):
+    #sha1 of input digests and options, any change in these invalidates the cached step
+    return hashlib.sha1('\t'.join([str(x) for x in items])).hexdigest()
+
+def readCache(input):
+    #cache manifest is tab delimited: sample, step, key
+    cache = {}
+    if os.path.isfile(input):
+        with open(input, 'rU') as infile:
+            for line in infile:
+                cols = line.rstrip('\n').split('\t')
+                if len(cols) == 3:
+                    cache[(cols[0], cols[1])] = cols[2]
+    return cache
+
+def writeCache(cache, output):
+    #write to a tmp file and rename so an interrupted run never leaves a partial manifest
+    tmpout = output + '.tmp'
+    with open(tmpout, 'w') as outfile:
+        for sample, step in natsorted(cache.keys()):
+            outfile.write('%s\t%s\t%s\n' % (sample, step, cache[(sample, step)]))
+    os.rename(tmpout, output)
+
 def faqual2fastq(fasta, qual, fastq):
     global skipCount
     from Bio.SeqIO.QualityIO import PairedFastaQualIterator
     with open(fastq, 'w') as output:
-        records = PairedFastaQualIterator(open(fasta), open(qual))
+        records = PairedFastaQualIterator(zopen(fasta), zopen(qual))
         for rec in records:
             try:
                 SeqIO.write(rec, output, 'fastq')
@@ -478,9 +1338,8 @@ def fasta_strip_padding(file, output):
             outputfile.write(">%s\n%s\n" % (record.id, Seq))
 
 def fastq_strip_padding(file, output):
-    from Bio.SeqIO.QualityIO import FastqGeneralIterator
     with open(output, 'w') as outputfile:
-        for title, seq, qual in FastqGeneralIterator(open(file)):
+        for title, seq, qual in readRecords(file):
             Seq = seq.rstrip('N')
             Qual = qual[:len(Seq)]
             assert len(Seq) == len(Qual)    
@@ -0,0 +1,74 @@
+import itertools
+
+#alphabet used to build the mismatch neighborhoods, N is included so that a
+#no-call in the barcode region is treated as a single mismatch
+BASES = 'ACGTN'
+
+def neighborhood(Seq, mismatches):
+    #yield (variant, diffs) for every sequence within N substitutions of Seq
+    yield Seq, 0
+    L = len(Seq)
+    for d in range(1, mismatches+1):
+        for positions in itertools.combinations(range(L), d):
+            choices = [[b for b in BASES if b != Seq[i]] for i in positions]
+            for subs in itertools.product(*choices):
+                variant = list(Seq)
+                for i, b in zip(positions, subs):
+                    variant[i] = b
+                yield ''.join(variant), d
+
+class BarcodeIndex(object):
+    '''
+    Hash index of barcode sequences for demultiplexing.  Barcodes are grouped
+    by length, each length gets a dictionary keyed by barcode sequence and by
+    every sequence in its 1 or 2 mismatch neighborhood, so finding the barcode
+    at the start of a read is one dictionary lookup per barcode length.
+    Neighbors that are equally close to more than one barcode are ambiguous
+    and are dropped from the index.
+    '''
+    def __init__(self, BarcodeDict, mismatches=0):
+        #BarcodeDict is {label: sequence} as returned by fasta.ReadSeqsDict
+        self.mismatches = int(mismatches)
+        self.labels = {}
+        self.tables = {}
+        for BarcodeLabel, Barcode in BarcodeDict.items():
+            Barcode = Barcode.upper()
+            if Barcode in self.labels:
+                continue
+            self.labels[Barcode] = BarcodeLabel
+            table = self.tables.setdefault(len(Barcode), {})
+            for variant, d in neighborhood(Barcode, self.mismatches):
+                hit = table.get(variant)
+                if hit is None or d < hit[2]:
+                    table[variant] = (Barcode, BarcodeLabel, d)
+                elif d == hit[2] and hit[0] != Barcode:
+                    table[variant] = (None, None, d)
+        #longest first, so a longer barcode wins over its own prefix
+        self.lengths = sorted(self.tables.keys(), reverse=True)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def lookup(self, Seq):
+        #return (barcode, label, diffs) for best barcode at start of Seq
+        best = None
+        for L in self.lengths:
+            hit = self.tables[L].get(Seq[:L])
+            if hit is None or hit[0] is None:
+                continue
+            if hit[2] == 0:
+                return hit
+            if best is None or hit[2] < best[2]:
+                best = hit
+        if best is None:
+            return "", "", 0
+        return best
+
+    def find(self, Seq):
+        #drop-in replacement for the old FindBarcode(), returns (barcode, label)
+        Barcode, BarcodeLabel, Diffs = self.lookup(Seq)
+        return Barcode, BarcodeLabel
+
+    def exact(self, Seq):
+        #label of barcode that is exactly Seq, or None
+        return self.labels.get(Seq)
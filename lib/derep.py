@@ -0,0 +1,179 @@
+'''
+Dereplication in a fixed amount of memory.  Reads are counted by sequence in
+memory until a limit and the counts are then spilled to bucket files chosen
+by a hash of the sequence, so every count of a sequence lands in the same
+bucket and buckets can be merged independently (and in parallel), each one
+small enough to fit in memory.  On disk sequences are kept as packed keys,
+two bases per byte with the 4-bit codes of readstore, sequences that are not
+all upper case IUPAC letters are kept as they are behind a NUL byte.  Counting a
+bucket gives one sorted run of (size, first read, title, sequence, sample
+counts), most abundant first, and the runs are merged with heapq so the
+uniques of the whole input come out in order without loading them all.
+'''
+import os, struct, zlib, heapq, mmap
+import numpy as np
+import readstore
+
+#bucket records: size, first read number, key length, label length, title length, samples length
+BUCKET = struct.Struct('<QQIIII')
+#run records: size, first read number, title length, sequence length, samples length
+RUN = struct.Struct('<QQIII')
+IUPAC = readstore.BASES[1:]
+
+def pack_keys(seqs):
+    #keys of seqs, equal keys mean equal sequences
+    if ''.join(seqs).translate(None, IUPAC):
+        packable = [not x.translate(None, IUPAC) for x in seqs]
+    else: #usual case, every sequence packs
+        packable = [True] * len(seqs)
+    even = [x + '=' * (len(x) % 2) for x, p in zip(seqs, packable) if p]
+    ends = np.cumsum([len(x) // 2 for x in even]).tolist()
+    codes = readstore.CODES[np.frombuffer(''.join(even), dtype=np.uint8)]
+    packed = ((codes[0::2] << 4) | codes[1::2]).tostring()
+    keys = [packed[a:b] for a, b in zip([0] + ends, ends)]
+    keys.reverse()
+    return [keys.pop() if p else '\0' + x for x, p in zip(seqs, packable)]
+
+def unpack_key(key):
+    #sequence of a key from pack_keys()
+    if key.startswith('\0'):
+        return key[1:]
+    return readstore.LETTERS[readstore.unpack(key, 2*len(key))].tostring().rstrip('=')
+
+def sample_label(title):
+    #barcodelabel= or sample= of a read title, '' if it has neither
+    for tag in ('barcodelabel=', 'sample='):
+        if tag in title:
+            return title.split(tag, 1)[1].split(';', 1)[0]
+    return ''
+
+def _counts(samples):
+    return '\t'.join(['%s\t%i' % x for x in samples.items()])
+
+def _samples(counts):
+    fields = counts.split('\t') if counts else []
+    return dict(zip(fields[0::2], [int(x) for x in fields[1::2]]))
+
+class Partitioner(object):
+    '''
+    Count reads by sequence, up to limit uniques in memory, and spill the
+    counts to bucket files chosen by a hash of the sequence when the limit is
+    reached.  Amplicon reads repeat a lot so most reads are counted here and
+    only a fraction of them ever reach the disk.  add() takes a list of
+    (title, seq, ...) records, read numbers follow the input order.
+    label(title), if given, is kept with the sequence in the key so reads are
+    only merged when both match.  samples counts the reads of each sample
+    (barcodelabel) seen.
+    '''
+    def __init__(self, folder, buckets, label=None, limit=1000000):
+        self.files = [os.path.join(folder, 'bucket_%i.bin' % i) for i in range(buckets)]
+        self.handles = [open(x, 'wb') for x in self.files]
+        self.label = label
+        self.limit = limit
+        self.uniques = {}
+        self.reads = 0
+        self.samples = {}
+
+    def add(self, records):
+        uniques = self.uniques
+        samples = self.samples
+        for rec in records:
+            self.reads += 1
+            title = rec[0]
+            key = rec[1]
+            if self.label:
+                key = (key, self.label(title))
+            if 'barcodelabel=' in title:
+                sample = title.split('barcodelabel=', 1)[1].split(';', 1)[0]
+            else:
+                sample = sample_label(title)
+            samples[sample] = samples.get(sample, 0) + 1
+            unique = uniques.get(key)
+            if unique is None:
+                uniques[key] = [1, self.reads, title, {sample: 1}]
+                continue
+            unique[0] += 1
+            unique[3][sample] = unique[3].get(sample, 0) + 1
+        if len(uniques) >= self.limit:
+            self.spill()
+
+    def spill(self):
+        buffers = [[] for x in self.files]
+        uniques = self.uniques.items()
+        if self.label:
+            seqs, labels = zip(*[x[0] for x in uniques]) if uniques else ([], [])
+        else:
+            seqs, labels = [x[0] for x in uniques], [''] * len(uniques)
+        for key, label, (size, ordinal, title, samples) in zip(pack_keys(list(seqs)), labels, [x[1] for x in uniques]):
+            counts = _counts(samples)
+            buffers[(zlib.crc32(key + label) & 0xffffffff) % len(buffers)].append(BUCKET.pack(size, ordinal, len(key), len(label), len(title), len(counts)) + key + label + title + counts)
+        for handle, buffer in zip(self.handles, buffers):
+            handle.write(''.join(buffer))
+        self.uniques = {}
+
+    def close(self):
+        self.spill()
+        for handle in self.handles:
+            handle.close()
+        return self.files
+
+def _records(file, layout, fixed):
+    #yield (fixed fields, strings) of the records in file, the fields after the first fixed
+    #ones of layout are the lengths of the strings that follow
+    if not os.path.getsize(file):
+        return
+    with open(file, 'rb') as input:
+        data = mmap.mmap(input.fileno(), 0, access=mmap.ACCESS_READ)
+    offset = 0
+    while offset < len(data):
+        fields = layout.unpack_from(data, offset)
+        offset += layout.size
+        parts = []
+        for length in fields[fixed:]:
+            parts.append(data[offset:offset+length])
+            offset += length
+        yield fields[:fixed], parts
+    data.close()
+
+def count_bucket(files):
+    #merge the counts in a bucket file and write them to a run file, most abundant first,
+    #returns (reads, uniques)
+    bucket, run = files
+    uniques = {}
+    reads = 0
+    for (size, ordinal), (key, label, title, counts) in _records(bucket, BUCKET, 2):
+        reads += size
+        unique = uniques.get((key, label))
+        if unique is None:
+            uniques[(key, label)] = [size, ordinal, title, counts]
+            continue
+        samples = unique[3] if isinstance(unique[3], dict) else _samples(unique[3])
+        for sample, count in _samples(counts).items():
+            samples[sample] = samples.get(sample, 0) + count
+        unique[3] = samples
+        unique[0] += size
+        if ordinal < unique[1]:
+            unique[1:3] = [ordinal, title]
+    entries = sorted(uniques.items(), key=lambda x: (-x[1][0], x[1][1]))
+    with open(run, 'wb') as output:
+        buffer = []
+        for (key, label), (size, ordinal, title, samples) in entries:
+            seq = unpack_key(key)
+            counts = samples if isinstance(samples, str) else _counts(samples)
+            buffer.append(RUN.pack(size, ordinal, len(title), len(seq), len(counts)) + title + seq + counts)
+            if len(buffer) >= 10000:
+                output.write(''.join(buffer))
+                buffer = []
+        output.write(''.join(buffer))
+    os.remove(bucket)
+    return reads, len(entries)
+
+def run_records(run):
+    #yield (-size, read number, title, seq, {sample: count}) of a run file
+    for (size, ordinal), (title, seq, counts) in _records(run, RUN, 2):
+        yield -size, ordinal, title, seq, _samples(counts)
+
+def merge_runs(runs):
+    #yield (title, seq, size, {sample: count}) of all runs, most abundant first, ties in input order
+    for size, ordinal, title, seq, samples in heapq.merge(*[run_records(x) for x in runs]):
+        yield title, seq, -size, samples
@@ -0,0 +1,108 @@
+'''
+Expected errors of FASTQ reads with NumPy.  Quality strings of a block of
+reads are turned into a matrix of error probabilities through a 256 entry
+table (ascii code -> 10**(-Q/10)) and summed along each row, so the expected
+errors of every prefix of every read come from one cumsum.  From that the
+longest prefix passing each of several (maxee, trunclen) thresholds is found
+for all reads in the same pass, which is what is needed to pick truncation
+settings without running the filter once per setting.
+'''
+import numpy as np
+import fastx
+
+def error_table(offset=33):
+    #ascii code -> error probability, scores below 0 count as 1 and NUL (row padding) as 0
+    Q = np.maximum(np.arange(256, dtype=np.float64) - offset, 0)
+    table = np.power(10.0, -Q / 10)
+    table[0] = 0
+    return table
+
+PROBS = error_table()
+
+def parse_thresholds(text):
+    #'1.0:250,0.5:200,2' -> [(1.0, 250), (0.5, 200), (2.0, None)], no trunclen means whole reads
+    thresholds = []
+    for item in text.split(','):
+        if not item.strip():
+            continue
+        maxee, _, trunclen = item.partition(':')
+        thresholds.append((float(maxee), int(trunclen) if trunclen.strip() else None))
+    return thresholds
+
+def cumulative(quals, width=None, table=PROBS):
+    #(ee, lengths): ee[i, j] is the expected errors of the first j+1 bases of read i, reads
+    #longer than width are cut to width, positions past the end of a read repeat its total
+    lengths = np.array([len(x) for x in quals], dtype=np.int64)
+    if width is not None:
+        lengths = np.minimum(lengths, width)
+    width = int(lengths.max()) if len(lengths) else 0
+    if not width:
+        return np.zeros((len(quals), 0)), lengths
+    text = ''.join([x[:width].ljust(width, '\0') for x in quals])
+    codes = np.frombuffer(text, dtype=np.uint8).reshape(len(quals), width)
+    return np.cumsum(table[codes], axis=1), lengths
+
+def expected_errors(quals, table=PROBS):
+    #total expected errors of each quality string
+    ee, lengths = cumulative(quals, table=table)
+    if not ee.shape[1]:
+        return np.zeros(len(quals))
+    return ee[:, -1]
+
+def passing_prefixes(ee, lengths, thresholds):
+    #longest prefix of each read, no longer than trunclen, with expected errors <= maxee, one
+    #column per (maxee, trunclen); expected errors only grow along a read so this is a count
+    prefixes = np.zeros((len(lengths), len(thresholds)), dtype=np.int64)
+    inread = np.arange(ee.shape[1]) < lengths[:, None]
+    for i, (maxee, trunclen) in enumerate(thresholds):
+        end = ee.shape[1] if trunclen is None else min(trunclen, ee.shape[1])
+        prefixes[:, i] = ((ee[:, :end] <= maxee) & inread[:, :end]).sum(axis=1)
+    return prefixes
+
+def scan(handle, thresholds, size=fastx.CHUNK, table=PROBS):
+    #yield (records, lengths, prefixes) for blocks of an open FASTQ file
+    width = None
+    if thresholds and None not in [x[1] for x in thresholds]:
+        width = max([x[1] for x in thresholds])
+    for records in fastx.fastq_chunks(handle, size):
+        ee, lengths = cumulative([x[2] for x in records], width, table)
+        yield records, np.array([len(x[1]) for x in records], dtype=np.int64), passing_prefixes(ee, lengths, thresholds)
+
+class Summary(object):
+    '''
+    Totals of scan() per threshold: reads that pass when truncated to trunclen
+    (shorter reads kept as they are), reads that pass and are at least trunclen
+    long (what usearch/vsearch -fastq_trunclen keep) and the bases kept.
+    '''
+    def __init__(self, thresholds):
+        self.thresholds = thresholds
+        self.reads = 0
+        self.passed = np.zeros(len(thresholds), dtype=np.int64)
+        self.full = np.zeros(len(thresholds), dtype=np.int64)
+        self.bases = np.zeros(len(thresholds), dtype=np.int64)
+
+    def add(self, lengths, prefixes):
+        self.reads += len(lengths)
+        for i, (maxee, trunclen) in enumerate(self.thresholds):
+            target = lengths if trunclen is None else np.minimum(lengths, trunclen)
+            passed = prefixes[:, i] == target
+            self.passed[i] += passed.sum()
+            if trunclen is None:
+                self.full[i] += passed.sum()
+            else:
+                self.full[i] += (prefixes[:, i] == trunclen).sum()
+            self.bases[i] += prefixes[:, i][passed].sum()
+
+    def rows(self):
+        #(maxee, trunclen, passed, full length, bases) per threshold
+        for i, (maxee, trunclen) in enumerate(self.thresholds):
+            yield maxee, trunclen, int(self.passed[i]), int(self.full[i]), int(self.bases[i])
+
+def filter_records(records, maxee, trunclen=None, table=PROBS):
+    #(title, seq, qual) of records whose first trunclen bases have expected errors <= maxee,
+    #truncated to trunclen, shorter reads are kept as they are
+    records = list(records)
+    if trunclen is not None:
+        records = [(x[0], x[1][:trunclen], x[2][:trunclen]) for x in records]
+    ee = expected_errors([x[2] for x in records], table)
+    return [x for x, keep in zip(records, (ee <= maxee).tolist()) if keep]
@@ -1,4 +1,5 @@
 from die import *
+import os
 import subprocess
 import tempfile
 import progress
@@ -28,31 +29,37 @@ def ReadSeqsDict(FileName, Progress = False):
 def ReadSeqsOnSeq(FileName, OnSeq, Progress = False):
 	ReadSeqs3(FileName, OnSeq, Progress)
 
+# Sequence lines are collected in a list and joined once per record,
+# adding each line to a string copies the sequence so far every time.
+
 def ReadSeqsFastFile(File, Progress = False):
 	Seqs = {}
 	Id = ""
+	Parts = None
 	N = 0
-	while 1:
-		if N%10000 == 0 and Progress:
-			sys.stderr.write("%u seqs\r" % (N))
-		Line = File.readline()
-		if len(Line) == 0:
-			if Progress:
-				sys.stderr.write("%u seqs\n" % (N))
-			return Seqs
+	for Line in File:
+		Line = Line.strip()
 		if len(Line) == 0:
 			continue
-		Line = Line.strip()
 		if Line[0] == ">":
+			if Parts is not None:
+				Seqs[Id] = "".join(Parts)
 			N += 1
+			if N%10000 == 0 and Progress:
+				sys.stderr.write("%u seqs\r" % (N))
 			Id = Line[1:]
 			if TRUNC_LABELS:
 				Id = Id.split()[0]
-			Seqs[Id] = ""
+			Parts = []
 		else:
-			if Id == "":
+			if Parts is None:
 				Die("FASTA file does not start with '>'")
-			Seqs[Id] = Seqs[Id] + Line
+			Parts.append(Line)
+	if Parts is not None:
+		Seqs[Id] = "".join(Parts)
+	if Progress:
+		sys.stderr.write("%u seqs\n" % (N))
+	return Seqs
 
 def ReadSeqsFast(FileName, Progress = True):
 	File = open(FileName)
@@ -64,41 +71,48 @@ def ReadSeqs(FileName, toupper=False, stripgaps=False, Progress=False):
 
 	Seqs = {}
 	Id = ""
+	Parts = None
 	File = open(FileName)
-	while 1:
-		Line = File.readline()
-		if len(Line) == 0:
-			return Seqs
+	for Line in File:
 		Line = Line.strip()
 		if len(Line) == 0:
 			continue
 		if Line[0] == ">":
+			if Parts is not None:
+				Seqs[Id] = "".join(Parts)
 			Id = Line[1:]
 			if TRUNC_LABELS:
 				Id = Id.split()[0]
-			if Id in Seqs.keys():
+			if Id in Seqs:
 				Die("Duplicate id '%s' in '%s'" % (Id, FileName))
-			Seqs[Id] = ""
+			Parts = []
 		else:
-			if Id == "":
+			if Parts is None:
 				Die("FASTA file '%s' does not start with '>'" % FileName)
 			if toupper:
 				Line = Line.upper()
 			if stripgaps:
 				Line = Line.replace("-", "")
 				Line = Line.replace(".", "")
-			Seqs[Id] = Seqs[Id] + Line
+			Parts.append(Line)
+	if Parts is not None:
+		Seqs[Id] = "".join(Parts)
+	return Seqs
 
 def ReadSeqs2(FileName, ShowProgress = True):
 	Seqs = []
 	Labels = []
+	Parts = None
 	File = open(FileName)
 	if ShowProgress:
 		progress.InitFile(File, FileName)
 	while 1:
-		progress.File()
+		if ShowProgress:
+			progress.File()
 		Line = File.readline()
 		if len(Line) == 0:
+			if Parts is not None:
+				Seqs.append("".join(Parts))
 			if ShowProgress:
 				print >> sys.stderr, "\n"
 			return Labels, Seqs
@@ -106,26 +120,29 @@ def ReadSeqs2(FileName, ShowProgress = True):
 		if len(Line) == 0:
 			continue
 		if Line[0] == ">":
+			if Parts is not None:
+				Seqs.append("".join(Parts))
 			Id = Line[1:]
 			if TRUNC_LABELS:
 				Id = Id.split()[0]
 			Labels.append(Id)
-			Seqs.append("")
+			Parts = []
 		else:
-			i = len(Seqs)-1
-			Seqs[i] = Seqs[i] + Line
+			if Parts is None:
+				Die("FASTA file '%s' does not start with '>'" % FileName)
+			Parts.append(Line)
 
 def ReadSeqs3(FileName, OnSeq, ShowProgress = True):
 	File = open(FileName)
 	if ShowProgress:
 		progress.InitFile(File, FileName)
 	Label = ""
-	Seq = ""
+	Parts = []
 	while 1:
 		Line = File.readline()
 		if len(Line) == 0:
-			if Seq != "":
-				OnSeq(Label, Seq)
+			if Parts:
+				OnSeq(Label, "".join(Parts))
 			if ShowProgress:
 				print >> sys.stderr, "\n"
 			return
@@ -133,16 +150,167 @@ def ReadSeqs3(FileName, OnSeq, ShowProgress = True):
 		if len(Line) == 0:
 			continue
 		if Line[0] == ">":
-			if Seq != "":
+			if Parts:
 				if ShowProgress:
 					progress.File()
 				if TRUNC_LABELS:
 					Label = Label.split()[0]
-				OnSeq(Label, Seq)
+				OnSeq(Label, "".join(Parts))
 			Label = Line[1:]
-			Seq = ""
+			Parts = []
+		else:
+			Parts.append(Line)
+
+# samtools faidx compatible index, FileName.fai has one line per sequence:
+# name (label up to the first white space), length, byte offset of the
+# first base, bases per line, bytes per line (including the newline).
+
+def FaidxFileName(FileName):
+	return FileName + ".fai"
+
+def BuildFaidx(FileName):
+	# Returns list of (Name, Length, Offset, LineBases, LineWidth), None if the
+	# lines of a sequence are not all the same length so it can't be indexed.
+	Index = []
+	File = open(FileName, "rb")
+	Pos = 0
+	Name = None
+	for Line in File:
+		LineWidth = len(Line)
+		Pos += LineWidth
+		if Line.startswith(">"):
+			if Name is not None:
+				Index.append((Name, Length, Offset, LineBases, Width))
+			Fields = Line[1:].split()
+			Name = Fields[0] if Fields else ""
+			Length = 0
+			Offset = Pos
+			LineBases = 0
+			Width = 0
+			Short = False
+			continue
+		if Name is None:
+			if Line.strip() == "":
+				continue
+			Die("FASTA file '%s' does not start with '>'" % FileName)
+		Bases = len(Line.rstrip("\r\n"))
+		if Bases == 0:
+			Short = True
+			continue
+		if LineBases == 0:
+			LineBases = Bases
+			Width = LineWidth
+		elif Short or Bases > LineBases or (Bases == LineBases and LineWidth != Width):
+			File.close()
+			return None
+		if Bases < LineBases:
+			Short = True
+		Length += Bases
+	File.close()
+	if Name is not None:
+		Index.append((Name, Length, Offset, LineBases, Width))
+	return Index
+
+def ReadFaidxLines(FileName):
+	# Lines of FileName.fai if it is at least as new as FileName, else None.
+	IndexName = FaidxFileName(FileName)
+	if os.path.isfile(IndexName) and os.path.getmtime(IndexName) >= os.path.getmtime(FileName):
+		return open(IndexName).read().splitlines()
+	return None
+
+def ReadFaidx(FileName, Build = True, Save = True):
+	# Index of FileName from FileName.fai, the index is built (and written if
+	# Save) if missing or older than FileName, None if FileName can't be indexed.
+	Lines = ReadFaidxLines(FileName)
+	if Lines is not None:
+		Index = []
+		for Line in Lines:
+			Fields = Line.split("\t")
+			Index.append((Fields[0],) + tuple([int(x) for x in Fields[1:5]]))
+		return Index
+	if not Build:
+		return None
+	Index = BuildFaidx(FileName)
+	if Index is None or not Save:
+		return Index
+	IndexName = FaidxFileName(FileName)
+	try:
+		Tmp = IndexName + ".%u.tmp" % os.getpid()
+		File = open(Tmp, "w")
+		for Entry in Index:
+			File.write("%s\t%u\t%u\t%u\t%u\n" % Entry)
+		File.close()
+		os.rename(Tmp, IndexName)
+	except (IOError, OSError):
+		pass
+	return Index
+
+class FastaIndex(object):
+	"""
+	Dictionary-like random access to the sequences of a FASTA file by label
+	(up to the first white space, same as samtools faidx and SeqIO.index),
+	through the .fai index, so only the sequences asked for are read.  Files
+	that can't be indexed are read into memory instead.  With Save=False a
+	new index is not written next to the file.
+	"""
+	def __init__(self, FileName, Save = True):
+		self.FileName = FileName
+		self.File = open(FileName, "rb")
+		self.Seqs = None
+		# Entries of an existing index are only parsed when looked up
+		Lines = ReadFaidxLines(FileName)
+		if Lines is not None:
+			self.Index = dict([x.split("\t", 1) for x in Lines])
+			self.Labels = [x[:x.find("\t")] for x in Lines]
+			return
+		Index = ReadFaidx(FileName, True, Save)
+		if Index is None:
+			self.Seqs = {}
+			self.Labels = []
+			Labels, Seqs = ReadSeqs2(FileName, False)
+			for Label, Seq in zip(Labels, Seqs):
+				Fields = Label.split()
+				Name = Fields[0] if Fields else ""
+				self.Seqs[Name] = Seq
+				self.Labels.append(Name)
 		else:
-			Seq += Line
+			self.Index = dict([(x[0], "%u\t%u\t%u\t%u" % x[1:]) for x in Index])
+			self.Labels = [x[0] for x in Index]
+
+	def __len__(self):
+		return len(self.Labels)
+
+	def __contains__(self, Label):
+		if self.Seqs is not None:
+			return Label in self.Seqs
+		return Label in self.Index
+
+	def __iter__(self):
+		return iter(self.Labels)
+
+	def keys(self):
+		return list(self.Labels)
+
+	def __getitem__(self, Label):
+		return self.Fetch(Label)
+
+	def Fetch(self, Label, Start = 0, End = None):
+		# Bases Start..End-1 (zero-based) of sequence Label.
+		if self.Seqs is not None:
+			return self.Seqs[Label][Start:End]
+		Length, Offset, LineBases, LineWidth = [int(x) for x in self.Index[Label].split("\t")[:4]]
+		if End is None or End > Length:
+			End = Length
+		if Start >= End:
+			return ""
+		First = Offset + (Start//LineBases)*LineWidth + Start%LineBases
+		Last = Offset + ((End-1)//LineBases)*LineWidth + (End-1)%LineBases
+		self.File.seek(First)
+		Data = self.File.read(Last - First + 1)
+		return Data.replace("\n", "").replace("\r", "")
+
+	def close(self):
+		self.File.close()
 
 def WriteSeq(File, Seq, Label = ""):
 	if Label != "":
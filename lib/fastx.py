@@ -0,0 +1,187 @@
+'''
+Fast FASTQ/FASTA reading and writing on raw bytes.  Files are read in large
+chunks that are split into lines in one go, records come back as
+(title, seq, qual) or (title, seq) tuples of plain strings, the same as
+FastqGeneralIterator and SimpleFastaParser, and a chunk at a time from the
+*_chunks() functions.  FASTQ records have to be four lines each (no wrapped
+sequences), a file that isn't raises ValueError.  Writers collect formatted
+records and hand them to writelines() in large blocks.
+
+python lib/fastx.py [input.fastq] benchmarks these against Biopython.
+'''
+import sys, os, time
+
+CHUNK = 1048576
+
+def parse_fastq(text, strict=True):
+    #list of (title, seq, qual) of FASTQ text that holds whole records
+    if '\r' in text:
+        text = text.replace('\r', '')
+    lines = text.split('\n')
+    while lines and not lines[-1]:
+        lines.pop()
+    return _records(lines, len(lines), strict)
+
+def _records(lines, n, strict):
+    #records of the first n lines, n is a multiple of 4 unless the file is truncated
+    titles = lines[0:n:4]
+    seqs = lines[1:n:4]
+    plus = lines[2:n:4]
+    quals = lines[3:n:4]
+    if strict:
+        if n % 4 or any([x[:1] != '@' for x in titles]) or any([x[:1] != '+' for x in plus]):
+            raise ValueError("FASTQ records must be 4 lines: @title, sequence, +, qualities")
+        if map(len, seqs) != map(len, quals):
+            for title, seq, qual in zip(titles, seqs, quals):
+                if len(seq) != len(qual):
+                    raise ValueError("Lengths of sequence and quality values differs for %s (%i and %i)." % (title[1:], len(seq), len(qual)))
+    return zip([x[1:] for x in titles], seqs, quals)
+
+def fastq_chunks(handle, size=CHUNK, strict=True):
+    #yield lists of (title, seq, qual) from an open FASTQ file, about size bytes at a time
+    tail = ''
+    while True:
+        chunk = handle.read(size)
+        if not chunk:
+            break
+        if '\r' in chunk:
+            chunk = chunk.replace('\r', '')
+        lines = (tail + chunk).split('\n')
+        n = (len(lines) - 1) // 4 * 4
+        tail = '\n'.join(lines[n:])
+        if n:
+            yield _records(lines, n, strict)
+    if tail.strip():
+        yield parse_fastq(tail, strict)
+
+def fastq_records(handle, size=CHUNK, strict=True):
+    #iterate (title, seq, qual) of an open FASTQ file
+    for chunk in fastq_chunks(handle, size, strict):
+        for rec in chunk:
+            yield rec
+
+def fasta_chunks(handle, size=CHUNK):
+    #yield lists of (title, seq) from an open FASTA file, sequences may be wrapped
+    tail = ''
+    while True:
+        chunk = handle.read(size)
+        if not chunk:
+            break
+        parts = (tail + chunk).split('\n>')
+        tail = parts.pop()
+        if parts:
+            yield _fasta(parts)
+    if tail.strip():
+        yield _fasta([tail])
+
+def _fasta(parts):
+    records = []
+    for part in parts:
+        title, _, seq = part.partition('\n')
+        if title.startswith('>'):
+            title = title[1:]
+        elif not records and not title.strip(): #leading blank lines
+            continue
+        records.append((title.rstrip('\r'), seq.replace('\n', '').replace('\r', '')))
+    return records
+
+def fasta_records(handle, size=CHUNK):
+    #iterate (title, seq) of an open FASTA file
+    for chunk in fasta_chunks(handle, size):
+        for rec in chunk:
+            yield rec
+
+class FastqWriter(object):
+    '''
+    Buffered FASTQ writer, write() a record or writerecords() a list of them,
+    the buffer goes to the file with writelines() every size bytes and on
+    flush() or close().  close() leaves the file open.
+    '''
+    format = '@%s\n%s\n+\n%s\n'
+
+    def __init__(self, handle, size=CHUNK):
+        self.handle = handle
+        self.size = size
+        self.buffer = []
+        self.buffered = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def write(self, title, seq, qual):
+        self.buffer.append(self.format % (title, seq, qual))
+        self._added(len(seq))
+
+    def writerecords(self, records):
+        self.buffer.extend([self.format % x for x in records])
+        self._added(sum([len(x[1]) for x in records]))
+
+    def _added(self, bases):
+        self.buffered += 2 * bases
+        if self.buffered >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.handle.writelines(self.buffer)
+            self.buffer = []
+            self.buffered = 0
+
+    def close(self):
+        self.flush()
+
+class FastaWriter(FastqWriter):
+    '''
+    Buffered FASTA writer, records are (title, seq), qualities are ignored.
+    '''
+    format = '>%s\n%s\n'
+
+    def write(self, title, seq, qual=None):
+        self.buffer.append(self.format % (title, seq))
+        self._added(len(seq))
+
+    def writerecords(self, records):
+        self.buffer.extend([self.format % x[:2] for x in records])
+        self._added(sum([len(x[1]) for x in records]))
+
+def benchmark(input, repeat=20):
+    #seconds to read and write input repeat times with Biopython and with this module
+    from cStringIO import StringIO
+    from Bio import SeqIO
+    from Bio.SeqIO.QualityIO import FastqGeneralIterator
+    data = open(input, 'rb').read()
+    def timed(name, function):
+        start = time.time()
+        for i in xrange(repeat):
+            count = function()
+        print '%-34s %8.3f s  %i records' % (name, time.time() - start, count)
+    records = list(FastqGeneralIterator(StringIO(data)))
+    timed('SeqIO.parse', lambda: sum(1 for x in SeqIO.parse(StringIO(data), 'fastq')))
+    timed('FastqGeneralIterator', lambda: sum(1 for x in FastqGeneralIterator(StringIO(data))))
+    timed('fastx.fastq_records', lambda: sum(1 for x in fastq_records(StringIO(data))))
+    timed('fastx.fastq_chunks', lambda: sum(len(x) for x in fastq_chunks(StringIO(data))))
+    seqrecords = list(SeqIO.parse(StringIO(data), 'fastq'))
+    def seqio_write():
+        return SeqIO.write(seqrecords, StringIO(), 'fastq')
+    def format_write():
+        out = StringIO()
+        for rec in records:
+            out.write('@%s\n%s\n+\n%s\n' % rec)
+        return len(records)
+    def fastx_write():
+        out = StringIO()
+        with FastqWriter(out) as writer:
+            writer.writerecords(records)
+        return len(records)
+    timed('SeqIO.write', seqio_write)
+    timed('write per record', format_write)
+    timed('fastx.FastqWriter', fastx_write)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        benchmark(sys.argv[1])
+    else:
+        benchmark(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test_data', 'ion.test.fastq'))
@@ -1,3 +1,4 @@
+import re
 import die
 
 # 	Code	Means				Comp	CompCode
@@ -32,6 +33,138 @@ LetterToSet['B'] = "CGT"
 LetterToSet['X'] = "GATC"
 LetterToSet['N'] = "GATC"
 
+# 4-bit masks A=1 C=2 G=4 T=8, two letters match if their masks share a bit,
+# which is the same test MatchLetter() does with the sets above
+LetterToMask = {}
+for Letter in LetterToSet.keys():
+	Mask = 0
+	for c in LetterToSet[Letter]:
+		Mask |= 1 << "ACGT".index(c)
+	LetterToMask[Letter] = Mask
+
+def MakeTables():
+	# str.translate() tables: letter -> hex digit of its mask, and one table
+	# per base letter -> '1' if the letter includes that base else '0'
+	Hex = ['0']*256
+	Bits = [ ['0']*256 for b in range(0, 4) ]
+	for Letter in LetterToMask.keys():
+		Mask = LetterToMask[Letter]
+		for c in [ Letter, Letter.lower() ]:
+			Hex[ord(c)] = "%x" % Mask
+			for b in range(0, 4):
+				if Mask & (1 << b):
+					Bits[b][ord(c)] = '1'
+	return ''.join(Hex), [ ''.join(x) for x in Bits ]
+
+HexTable, BitTables = MakeTables()
+
+PrimerCache = {}
+
+def CompilePrimer(Primer):
+	# per primer: list of masks, packed hex string of masks, and for each
+	# position the bases it accepts; cached as the same primer is used on
+	# every read
+	try:
+		return PrimerCache[Primer]
+	except KeyError:
+		pass
+	Masks = [ LetterToMask.get(c.upper(), 0) for c in Primer ]
+	Packed = ''.join([ "%x" % m for m in Masks ])
+	Bases = [ [ b for b in range(0, 4) if m & (1 << b) ] for m in Masks ]
+	PrimerCache[Primer] = (Masks, Packed, Bases)
+	return PrimerCache[Primer]
+
+def BitMatchPrefix(Seq, Primer):
+	# MatchPrefix() on packed masks: AND read and primer nibbles, a zero
+	# nibble is a mismatch
+	Masks, Packed, Bases = CompilePrimer(Primer)
+	n = len(Masks)
+	if len(Seq) < n:
+		n = len(Seq)
+	if n == 0:
+		return 0
+	x = int(Seq[:n].translate(HexTable), 16) & int(Packed[:n], 16)
+	x = (x | (x >> 1) | (x >> 2) | (x >> 3)) & int('1'*n, 16)
+	return n - bin(x).count('1')
+
+def BitBestMatch(Seq, Primer, MaxDiffs, NotFound):
+	# Bit-parallel shift-add over all offsets of the read at once: bit j of
+	# each vector is offset j, mismatches are counted in bit-sliced counters
+	# (Count[k] holds bit k of every offset's count) and offsets whose count
+	# overflows MaxDiffs are dropped.  Returns the first offset with the
+	# fewest diffs, exactly as the BestMatch2() scan does.
+	Masks, Packed, Bases = CompilePrimer(Primer)
+	PrimerLength = len(Masks)
+	L = len(Seq)
+	if L < PrimerLength or PrimerLength == 0 or MaxDiffs < 0:
+		return NotFound, PrimerLength
+	Valid = (1 << (L - PrimerLength + 1)) - 1
+	Rev = Seq[::-1]
+	SeqBits = [ int(Rev.translate(t), 2) for t in BitTables ]
+	NBits = max(1, MaxDiffs.bit_length())
+	Count = [0]*NBits
+	Over = 0
+	Cache = {}
+	for i in range(0, PrimerLength):
+		m = Masks[i]
+		try:
+			M = Cache[m]
+		except KeyError:
+			M = 0
+			for b in Bases[i]:
+				M |= SeqBits[b]
+			Cache[m] = M
+		Carry = Valid & ~(M >> i)
+		for k in range(0, NBits):
+			c = Count[k]
+			Count[k] = c ^ Carry
+			Carry &= c
+			if not Carry:
+				break
+		if Carry:
+			Over |= Carry
+			if not Valid & ~Over:
+				return NotFound, PrimerLength
+	Alive = Valid & ~Over
+	for d in range(0, min(MaxDiffs, PrimerLength-1)+1):
+		Eq = Alive
+		for k in range(0, NBits):
+			if (d >> k) & 1:
+				Eq &= Count[k]
+			else:
+				Eq &= ~Count[k]
+		if Eq:
+			return (Eq & -Eq).bit_length() - 1, d
+	return NotFound, PrimerLength
+
+RegexCache = {}
+
+def PrimerRegex(Primer):
+	# compiled regex that matches Primer with no diffs, each primer letter
+	# becomes the class of read letters that MatchLetter() accepts
+	try:
+		return RegexCache[Primer]
+	except KeyError:
+		pass
+	Classes = []
+	for c in Primer:
+		m = LetterToMask.get(c.upper(), 0)
+		Letters = ''.join([ x + x.lower() for x in sorted(LetterToMask.keys()) if LetterToMask[x] & m ])
+		Classes.append('[' + Letters + ']' if Letters else '(?!)')
+	RegexCache[Primer] = re.compile(''.join(Classes))
+	return RegexCache[Primer]
+
+def QuickBestMatch2(Seq, Primer, MaxDiffs):
+	# same result as BestMatch2(Seq, Primer, MaxDiffs).  When the read holds an
+	# exact match, the leftmost one is the best match and the regex finds it
+	# (stopping at the first hit) much faster than BitBestMatch() scores every
+	# offset, so BitBestMatch() only runs for reads without an exact match
+	if MaxDiffs >= 0 and Primer:
+		Hit = PrimerRegex(Primer).search(Seq)
+		if Hit:
+			return Hit.start(), 0
+	return BestMatch2(Seq, Primer, MaxDiffs)
+
 def MergeChars(a, b):
 	global LetterToSet
 	if a == b:
@@ -105,16 +238,7 @@ def MatchLetter(a, b):
 	return False
 
 def MatchPrefix(Seq, Primer):
-	L = len(Seq)
-	PrimerLength = len(Primer)
-	n = PrimerLength
-	if L < n:
-		n = L
-	Diffs = 0
-	for i in range(0, n):
-		if not MatchLetter(Seq[i], Primer[i]):
-			Diffs += 1
-	return Diffs
+	return BitMatchPrefix(Seq, Primer)
 
 def GetDiffs(Primer1, Primer2):
 	assert len(Primer1) == len(Primer2)
@@ -164,41 +288,14 @@ def Match(Seq, Primer):
 	return -1
 
 def BestMatch(Seq, Primer):
-	L = len(Seq)
-	PrimerLength = len(Primer)
-	BestDiffs = PrimerLength
-	BestPos = -1
-	for Pos in range(0, L-PrimerLength+1):
-		d = MatchPrefix(Seq[Pos:], Primer)
-		if d < BestDiffs:
-			BestDiffs = d
-			BestPos = Pos
-	return BestPos, BestDiffs
+	return BitBestMatch(Seq, Primer, len(Primer), -1)
 
 
 def BestMatch2(Seq, Primer, MaxDiffs):
-	L = len(Seq)
-	PrimerLength = len(Primer)
-	BestDiffs = PrimerLength
-	BestPos = -1
-	for Pos in range(0, L-PrimerLength+1):
-		d = MatchPrefix2(Seq[Pos:], Primer, MaxDiffs)
-		if d < BestDiffs and d <= MaxDiffs:
-			BestDiffs = d
-			BestPos = Pos
-	return BestPos, BestDiffs
+	return BitBestMatch(Seq, Primer, MaxDiffs, -1)
 
 def BestMatch3(Seq, Primer, MaxDiffs):
-	L = len(Seq)
-	PrimerLength = len(Primer)
-	BestDiffs = PrimerLength
-	BestPos = -2
-	for Pos in range(0, L-PrimerLength+1):
-		d = MatchPrefix2(Seq[Pos:], Primer, MaxDiffs)
-		if d < BestDiffs and d <= MaxDiffs:
-			BestDiffs = d
-			BestPos = Pos
-	return BestPos, BestDiffs
+	return BitBestMatch(Seq, Primer, MaxDiffs, -2)
 
 def GetDegen(Primer):
 	Degen = 1
@@ -18,11 +18,13 @@ import time
 import tempfile
 import subprocess
 from array import array
-from struct import unpack
+from struct import unpack, unpack_from
+from itertools import chain
 
 CtoPy       = { 'A':'<c', 'c':'<b', 'C':'<B', 's':'<h', 'S':'<H', 'i':'<i', 'I':'<I', 'f':'<f' }
 py4py       = { 'A':  1 , 'c':  1 , 'C':  1 , 's':  2 , 'S':  2 , 'i':  4 , 'I':  4 , 'f':  4  }
 dna_codes   = '=ACMGRSVTWYHKDBN'
+qname_codes = ''.join([chr(x) for x in range(33,127)])
 cigar_codes = 'MIDNSHP=X'
 parse_codes = {
     'sam':                     ' The current alignment in SAM format.',
@@ -379,6 +381,7 @@ class read:
                 p = p + 4 + self.sam_block_size
                 yield self
         self._new_entry = new_entry(header_cache)
+        self._header_cache = header_cache # start of the alignments, for the batch decoder in fastq_batches()
 
         def compile_parser(self,fields):
             temp_code = ''
@@ -729,5 +732,276 @@ class read:
         self._file.close()
 
 
+def _bam_header(cache):
+    ## returns (length of the binary BAM header, chromosome names) if cache holds all of it, else None
+    if len(cache) < 8: return None
+    if cache[:4] != 'BAM\1': raise PybamError('\n\nInput file does not appear to be a BAM file.\n')
+    p = 8 + unpack_from('<i',cache,4)[0]
+    if len(cache) < p + 4: return None
+    number_of_reference_sequences = unpack_from('<i',cache,p)[0]
+    p += 4
+    chromosomes = []
+    for _ in range(number_of_reference_sequences):
+        if len(cache) < p + 4: return None
+        l_name = unpack_from('<i',cache,p)[0]
+        if len(cache) < p + 8 + l_name: return None
+        chromosomes.append(cache[p+4:p+3+l_name])
+        p += 8 + l_name
+    return p,chromosomes
+
+def _inflate(job):
+    ## Worker for bgzf.chunks(), reads a run of whole BGZF blocks from disk in one go and inflates each of them.
+    ## Kept at the module level so that multiprocessing can pickle it.
+    path,start,blocks = job
+    with open(path,'rb') as fh:
+        fh.seek(start)
+        raw = fh.read(sum([size for _,size in blocks]))
+    out = []
+    p = 0
+    for coffset,size in blocks:
+        xlen = unpack('<H',raw[p+10:p+12])[0]
+        out.append((coffset,zlib.decompress(raw[p+12+xlen:p+size-8],-15)))
+        p += size
+    return out
+
+class bgzf:
+    """
+    [ Parallel BGZF Reader ]
+    my_bgzf = pybam.bgzf('/my/data.bam',cpus=4)
+    for data in my_bgzf.read():                          # all decompressed data, in file order
+        print len(data)
+    for data in my_bgzf.read(my_bgzf.first_alignment()): # from a virtual offset
+        print len(data)
+    for start,end in my_bgzf.split(8):                   # 8 runs of alignments, as virtual offsets
+        for batch in pybam.fastq_batches('/my/data.bam',start=start,end=end):
+            print len(batch)
+
+    BGZF blocks are independent gzip members, so they can be inflated on a pool of processes and put back
+    in order. A virtual offset is the offset of a block in the compressed file << 16 | the offset within
+    that block's decompressed data, as used by BAM indexes. Input must be a path to a bgzip compressed file.
+    """
+    def __init__(self,f,cpus=1,blocks_per_job=64):
+        if type(f) is not str: raise PybamError('\n\nThe parallel BGZF reader needs a file path so that blocks can be read at random. It was: "' + str(f) + '"\n')
+        self.file_name = f
+        self.cpus = cpus
+        self.blocks_per_job = blocks_per_job
+        self.file_chromosomes = []
+        self._first_alignment = False
+        try:
+            with open(f,'rb') as fh: magic = fh.read(4)
+        except IOError: raise PybamError('\n\nCould not open "' + f + '" for reading!\n')
+        if magic != "\x1f\x8b\x08\x04": raise PybamError('\n\nThe input file is not bgzip compressed. First four bytes: ' + repr(magic) + '\n')
+
+    def blocks(self,start=0,end=None):
+        ## yields (offset,size) of every block starting between compressed offsets start and end, only block headers are read
+        with open(self.file_name,'rb') as fh:
+            offset = start
+            while end is None or offset < end:
+                fh.seek(offset)
+                header = fh.read(12)
+                if not header: break
+                if len(header) < 12 or header[:4] != "\x1f\x8b\x08\x04": raise PybamError('\n\nInvalid BGZF block at offset ' + str(offset) + ' in "' + self.file_name + '"\n')
+                xlen = unpack('<H',header[10:12])[0]
+                extra = fh.read(xlen)
+                p = 0; size = None
+                while p + 4 <= len(extra):
+                    subfield_len = unpack('<H',extra[p+2:p+4])[0]
+                    if extra[p:p+2] == 'BC': size = unpack('<H',extra[p+4:p+6])[0] + 1
+                    p += 4 + subfield_len
+                if size is None: raise PybamError('\n\nBGZF block at offset ' + str(offset) + ' in "' + self.file_name + '" has no BC (block size) field.\n')
+                yield offset,size
+                offset += size
+
+    def chunks(self,start=0,end=None):
+        ## yields (offset,decompressed data) for every block starting between compressed offsets start and end, in file order
+        def jobs():
+            group = []
+            for block in self.blocks(start,end):
+                group.append(block)
+                if len(group) == self.blocks_per_job:
+                    yield self.file_name,group[0][0],group
+                    group = []
+            if group: yield self.file_name,group[0][0],group
+        if self.cpus > 1:
+            ## a window of jobs in flight keeps the order and stops decompressed data piling up ahead of the reader
+            import multiprocessing
+            from collections import deque
+            pool = multiprocessing.Pool(self.cpus)
+            pending = deque()
+            try:
+                for job in jobs():
+                    pending.append(pool.apply_async(_inflate,(job,)))
+                    if len(pending) > 2*self.cpus:
+                        for block in pending.popleft().get(): yield block
+                while pending:
+                    for block in pending.popleft().get(): yield block
+            finally:
+                pool.close() # terminate() can hang on python 2 with jobs in flight, there are only a few to finish
+                pool.join()
+        else:
+            for job in jobs():
+                for block in _inflate(job): yield block
+
+    def read(self,start=0,end=None):
+        ## yields the decompressed data from virtual offset start up to (not including) virtual offset end
+        start_block,start_within = start >> 16, start & 0xFFFF
+        if end is None: last_block = None
+        else:
+            end_block,end_within = end >> 16, end & 0xFFFF
+            last_block = end_block + 1 if end_within else end_block
+        for offset,data in self.chunks(start_block,last_block):
+            if end is not None and offset == end_block: data = data[:end_within]
+            if offset == start_block: data = data[start_within:]
+            if data: yield data
+
+    def first_alignment(self):
+        ## parses the BAM header and returns the virtual offset of the first alignment, or None if there are none
+        if self._first_alignment is not False: return self._first_alignment
+        self._first_alignment = None
+        cache = ''
+        for block in self.blocks():
+            offset,data = _inflate((self.file_name,block[0],[block]))[0] # the header is only a few blocks, no pool needed
+            before = len(cache)
+            cache += data
+            header = _bam_header(cache)
+            if header is None: continue
+            p,self.file_chromosomes = header
+            if p - before < len(data):
+                self._first_alignment = offset << 16 | (p - before)
+                break
+        return self._first_alignment
+
+    def _alignment_at(self,cache,q):
+        ## checks that the fixed fields and read name at cache[q] look like the start of an alignment
+        block_size,refID,pos,l_read_name,_,_,n_cigar_op,flag,l_seq,next_refID,pnext,_ = unpack_from('<iiiBBHHHiiii',cache,q)
+        n_ref = len(self.file_chromosomes)
+        if not -1 <= refID < n_ref or not -1 <= next_refID < n_ref: return False
+        if pos < -1 or pnext < -1 or l_seq < 0 or l_read_name < 2 or flag > 0xFFF: return False
+        if 32 + l_read_name + 4*n_cigar_op + (l_seq+1)//2 + l_seq > block_size: return False
+        name = cache[q+36:q+36+l_read_name]
+        if len(name) == l_read_name:
+            if name[-1] != '\0': return False
+            name = name[:-1]
+        return name.translate(None,qname_codes) == ''
+
+    def _next_alignment(self,offset):
+        ## virtual offset of the first alignment starting in or after the block at compressed offset offset.
+        ## Blocks do not line up with alignments, so each position in the block is tried until one starts a
+        ## run of alignments that all look valid (the same idea as Hadoop-BAM's split guesser)
+        blocks = self.blocks(offset)
+        loaded = [] # (offset,data) of the block being searched and of the blocks after it
+        while True:
+            ## keep ~256Kb of data after the block being searched to follow the runs into
+            while not loaded or sum([len(data) for _,data in loaded[1:]]) < 262144:
+                try: block = next(blocks)
+                except StopIteration: break
+                loaded.extend(_inflate((self.file_name,block[0],[block])))
+            if not loaded: return None
+            cache = ''.join([data for _,data in loaded])
+            for u in xrange(len(loaded[0][1])):
+                q = u; run = 0
+                while run < 8 and q + 36 <= len(cache):
+                    if not self._alignment_at(cache,q): break
+                    q += 4 + unpack_from('<i',cache,q)[0]
+                    run += 1
+                else:
+                    if run: return loaded[0][0] << 16 | u
+            loaded.pop(0)
+
+    def split(self,parts):
+        ## splits the alignments into about equal runs of blocks, returns [(start,end),..] as virtual offsets,
+        ## the end of the last run is None. Each run can be read with pybam.fastq_batches(f,start=start,end=end)
+        first = self.first_alignment()
+        if first is None: return []
+        offsets = [offset for offset,_ in self.blocks(first >> 16)]
+        step = max(1,-(-len(offsets)//parts))
+        starts = [first]
+        for i in range(step,len(offsets),step):
+            start = self._next_alignment(offsets[i])
+            if start is None: break
+            if start > starts[-1]: starts.append(start)
+        return zip(starts,starts[1:] + [None])
+
+
+def fastq_batches(f,batch_size=10000,decompressor=False,cpus=1,start=None,end=None):
+    '''
+    [ Batch FASTQ Decoder ]
+    for batch in pybam.fastq_batches('/my/data.bam'):
+        for name,seq,qual in batch:
+            print name
+
+    [ Parallel Decompression / Part of a File ]
+    for batch in pybam.fastq_batches('/my/data.bam',cpus=4):
+    for batch in pybam.fastq_batches('/my/data.bam',start=start,end=end): # virtual offsets from pybam.bgzf().split()
+
+    Decodes many alignments at once with NumPy lookup tables rather than one alignment at a time, and
+    yields lists of (name, seq, qual) tuples the same as "samtools fastq" would give: secondary and
+    supplementary alignments are skipped, and reverse strand alignments are reverse complemented.
+    Uses the decompressed data of a pybam.read object directly, or of a pybam.bgzf reader when cpus > 1
+    or a start/end virtual offset is given.
+    '''
+    import numpy
+    if cpus > 1 or start is not None or end is not None:
+        reader = bgzf(f,cpus=cpus)
+        if start is None: start = reader.first_alignment()
+        source = reader.read(start,end) if start is not None else []
+    else:
+        bam = read(f,decompressor=decompressor)
+        source = chain([bam._header_cache],bam._generator)
+    dna_table  = numpy.frombuffer(dna_codes,dtype=numpy.uint8)
+    complement = dict(zip('=ACMGRSVTWYHKDBN','=TGKCYSBAWRDMHVN'))
+    pending = []
+    pending_size = 0
+    batch = []
+    for data in chain(source,['']):
+        if data:
+            pending.append(data)
+            pending_size += len(data)
+            if pending_size < 4194304: continue # decode in ~4Mb chunks
+        cache = ''.join(pending)
+        p = 0
+        ## walk the alignment boundaries, this is the only per-alignment loop over the chunk
+        names = []; seq_starts = []; seq_lens = []; flags = []
+        while len(cache) >= p + 36:
+            block_size, l_read_name, n_cigar_op, flag, l_seq = unpack_from('<i8xB3xHHi',cache,p)
+            if len(cache) < p + 4 + block_size: break
+            end_of_qname = p + 36 + l_read_name
+            names.append(cache[p+36:end_of_qname-1])
+            seq_starts.append(end_of_qname + 4*n_cigar_op)
+            seq_lens.append(l_seq)
+            flags.append(flag)
+            p += 4 + block_size
+        pending = [cache[p:]]
+        pending_size = len(pending[0])
+        if not names: continue
+        ## gather the packed sequence and the quality bytes of every alignment into two flat arrays
+        buf        = numpy.frombuffer(cache,dtype=numpy.uint8)
+        seq_starts = numpy.array(seq_starts,dtype=numpy.int64)
+        seq_lens   = numpy.array(seq_lens,dtype=numpy.int64)
+        seq_bytes  = (seq_lens + 1) // 2
+        def gather(starts,lengths):
+            offsets = numpy.cumsum(lengths) - lengths
+            return buf[numpy.repeat(starts - offsets,lengths) + numpy.arange(lengths.sum())], offsets
+        packed, seq_offsets   = gather(seq_starts,seq_bytes)
+        quals, qual_offsets   = gather(seq_starts + seq_bytes,seq_lens)
+        seqs = numpy.empty(2*len(packed),dtype=numpy.uint8)
+        seqs[0::2] = dna_table[packed >> 4]
+        seqs[1::2] = dna_table[packed & 15]
+        seqs  = seqs.tostring()
+        quals = (numpy.minimum(quals,93) + 33).astype(numpy.uint8).tostring() # 0xFF (no quality) is capped
+        for i,name in enumerate(names):
+            if flags[i] & 0x900: continue
+            s = 2*seq_offsets[i]; q = qual_offsets[i]; l = seq_lens[i]
+            seq  = seqs[s:s+l]
+            qual = quals[q:q+l]
+            if flags[i] & 16:
+                seq  = ''.join([complement[x] for x in reversed(seq)])
+                qual = qual[::-1]
+            batch.append((name,seq,qual))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch: yield batch
+
 class PybamWarn(Exception): pass
 class PybamError(Exception):  """ Carlsburg doesn't do errors, but if it did, they'd probably be the best errors in the world """
\ No newline at end of file
@@ -0,0 +1,126 @@
+import numpy as np
+import primer
+
+def MaskTable():
+    #read letter -> primer.LetterToMask bits, 0 (never matches) for anything else
+    table = np.zeros(256, dtype=np.uint8)
+    for Letter, Mask in primer.LetterToMask.items():
+        table[ord(Letter)] = Mask
+        table[ord(Letter.lower())] = Mask
+    return table
+
+MASKS = MaskTable()
+
+def spans(starts, lengths):
+    #flat index of every position in the runs starts[i]:starts[i]+lengths[i]
+    offsets = np.cumsum(lengths) - lengths
+    return np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+
+class ReadBatch(object):
+    '''
+    Block of reads stored as fixed width uint8 sequence and quality matrices,
+    one row per read, plus start and end vectors that mark the part of each
+    row that is still the read.  Trimming and truncation only move start and
+    end, padding writes into the matrices, primer prefixes are scored for all
+    reads at once and length filtering is a boolean select, so each step is
+    one array operation over the whole batch instead of string slicing and
+    concatenation per read.  Offsets and lengths given to the trimming
+    methods follow python slicing of the current read, they are clipped to
+    the read and can be a number or one value per read.
+    '''
+    def __init__(self, seqs, quals, names=None, width=None):
+        #seqs and quals are equal length lists of strings, reads longer than width are cut to width
+        self.names = names
+        lens = np.array([len(x) for x in seqs], dtype=np.int64)
+        if width is not None:
+            lens = np.minimum(lens, width)
+        width = int(lens.max()) if len(lens) else 0
+        self.seq = self._matrix(seqs, width)
+        self.qual = self._matrix(quals, width)
+        self.start = np.zeros(len(lens), dtype=np.int64)
+        self.end = lens
+
+    @staticmethod
+    def _matrix(strings, width):
+        #rows of strings padded with zeros to width
+        if not width:
+            return np.zeros((len(strings), 0), dtype=np.uint8)
+        text = ''.join([x[:width].ljust(width, '\0') for x in strings])
+        return np.frombuffer(text, dtype=np.uint8).reshape(len(strings), width).copy()
+
+    @classmethod
+    def from_records(cls, records):
+        #batch from (title, seq, qual) tuples
+        records = list(records)
+        return cls([x[1] for x in records], [x[2] for x in records], [x[0] for x in records])
+
+    def __len__(self):
+        return len(self.start)
+
+    def lengths(self):
+        return self.end - self.start
+
+    def trim_left(self, n):
+        #drop the first n bases, read[n:]
+        self.start = np.minimum(self.start + n, self.end)
+
+    def truncate(self, n):
+        #keep the first n bases, read[:n]
+        self.end = np.minimum(self.end, self.start + np.maximum(n, 0))
+
+    def pad(self, n, rows=None, seqchar='N', qualchar='J'):
+        #pad reads shorter than n up to n bases, only in rows (boolean vector) if given
+        target = self.start + n
+        short = self.end < target
+        if rows is not None:
+            short &= rows
+        if not short.any():
+            return
+        width = int(target[short].max())
+        if width > self.seq.shape[1]:
+            extra = width - self.seq.shape[1]
+            self.seq = np.pad(self.seq, ((0, 0), (0, extra)), 'constant')
+            self.qual = np.pad(self.qual, ((0, 0), (0, extra)), 'constant')
+        rows = np.flatnonzero(short)
+        fill = spans(rows * self.seq.shape[1] + self.end[rows], target[rows] - self.end[rows])
+        self.seq.ravel()[fill] = ord(seqchar)
+        self.qual.ravel()[fill] = ord(qualchar)
+        self.end = np.where(short, target, self.end)
+
+    def prefix_diffs(self, Primer):
+        #mismatches of the start of every read against Primer, same as primer.MatchPrefix()
+        #so only the bases a short read has are compared
+        Masks = np.array(primer.CompilePrimer(Primer)[0], dtype=np.uint8)
+        if not len(Masks) or not self.seq.size:
+            return np.zeros(len(self), dtype=np.int64)
+        cols = self.start[:, None] + np.arange(len(Masks))
+        inread = cols < self.end[:, None]
+        cols = np.minimum(cols, self.seq.shape[1] - 1)
+        bases = MASKS[self.seq[np.arange(len(self))[:, None], cols]]
+        return (inread & ((bases & Masks) == 0)).sum(axis=1)
+
+    def select(self, keep):
+        #new batch of the rows where keep (boolean vector) is True
+        batch = ReadBatch.__new__(ReadBatch)
+        batch.seq = self.seq[keep]
+        batch.qual = self.qual[keep]
+        batch.start = self.start[keep]
+        batch.end = self.end[keep]
+        batch.names = None
+        if self.names is not None:
+            batch.names = [x for x, k in zip(self.names, keep) if k]
+        return batch
+
+    def records(self, names=None):
+        #yield (title, seq, qual) of each read, names replaces the batch names if given
+        if names is None:
+            names = self.names
+        seqs = self.seq.tostring()
+        quals = self.qual.tostring()
+        rows = np.arange(len(self), dtype=np.int64) * self.seq.shape[1]
+        for name, a, b in zip(names, (rows + self.start).tolist(), (rows + self.end).tolist()):
+            yield name, seqs[a:b], quals[a:b]
+
+    def fastq(self, names=None):
+        #batch as FASTQ text
+        return ''.join(["@%s\n%s\n+\n%s\n" % x for x in self.records(names)])
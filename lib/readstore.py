@@ -0,0 +1,178 @@
+'''
+Compact binary container for demuxed reads (.reads).  Reads are stored in
+blocks, every block holds reads of one sample: a uint32 length per read, the
+sequences packed two bases per byte (4-bit codes, same order as BAM so IUPAC
+codes survive, other letters are stored as N) and the qualities, either one
+byte per base or binned to 8 levels and packed two per byte.  Read names are
+not stored, reads are numbered in file order and named R_<n>;barcodelabel=<sample>;
+on export.  An index of the blocks is written after the last block, followed
+by its offset and the magic string, so reads of a sample can be read without
+touching the rest of the file and the file can be memory mapped by any number
+of processes at once.
+'''
+import os, struct, mmap
+import numpy as np
+
+MAGIC = 'AMPTKRD1'
+BASES = '=ACMGRSVTWYHKDBN'
+#illumina 8 level quality binning, bin code -> phred score stored for the bin
+BINS = [2, 6, 15, 22, 27, 33, 37, 40]
+BINEDGES = [2, 10, 20, 25, 30, 35, 40]
+
+class ReadStoreError(Exception):
+    pass
+
+def _codes():
+    table = np.zeros(256, dtype=np.uint8) + BASES.index('N')
+    for i, Letter in enumerate(BASES):
+        table[ord(Letter)] = i
+        table[ord(Letter.lower())] = i
+    return table
+
+CODES = _codes()
+LETTERS = np.frombuffer(BASES, dtype=np.uint8)
+
+def pack(codes):
+    #array of 4-bit codes -> bytes, two codes per byte, high nibble first
+    if len(codes) % 2:
+        codes = np.append(codes, np.uint8(0))
+    return ((codes[0::2] << 4) | codes[1::2]).tostring()
+
+def unpack(data, n):
+    #bytes -> first n 4-bit codes
+    packed = np.frombuffer(data, dtype=np.uint8)
+    codes = np.empty(2*len(packed), dtype=np.uint8)
+    codes[0::2] = packed >> 4
+    codes[1::2] = packed & 15
+    return codes[:n]
+
+def bin_quality(quals, offset=33):
+    #FASTQ quality string -> array of bin codes
+    return np.searchsorted(BINEDGES, np.frombuffer(quals, dtype=np.uint8) - offset, side='right').astype(np.uint8)
+
+class ReadStoreWriter(object):
+    '''
+    Write a .reads file, add() reads one sample at a time.  With binned=True
+    qualities are reduced to 8 levels, which halves their size but does not
+    give back the original FASTQ on export.
+    '''
+    def __init__(self, output, binned=False):
+        self.output = output
+        self.binned = binned
+        self.handle = open(output, 'wb')
+        self.handle.write(MAGIC)
+        self.offset = len(MAGIC)
+        self.reads = 0
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def add(self, sample, seqs, quals):
+        #seqs and quals are equal length lists of strings, all from sample
+        if not seqs:
+            return
+        lengths = np.array([len(x) for x in seqs], dtype=np.uint32)
+        bases = int(lengths.sum())
+        seq = pack(CODES[np.frombuffer(''.join(seqs), dtype=np.uint8)])
+        if self.binned:
+            qual = pack(bin_quality(''.join(quals)))
+        else:
+            qual = ''.join(quals)
+        data = lengths.astype('<u4').tostring() + seq + qual
+        self.handle.write(data)
+        self.blocks.append((sample, self.offset, len(seqs), bases, int(lengths.min()), int(lengths.max()), self.reads+1))
+        self.offset += len(data)
+        self.reads += len(seqs)
+
+    def counts(self):
+        #reads per sample written so far
+        counts = {}
+        for block in self.blocks:
+            counts[block[0]] = counts.get(block[0], 0) + block[2]
+        return counts
+
+    def close(self):
+        if self.handle is None:
+            return
+        index = ['#amptk-reads\t%s' % ('binned' if self.binned else 'raw')]
+        for block in self.blocks:
+            index.append('%s\t%i\t%i\t%i\t%i\t%i\t%i' % block)
+        self.handle.write('\n'.join(index) + '\n')
+        self.handle.write(struct.pack('<Q', self.offset) + MAGIC)
+        self.handle.close()
+        self.handle = None
+
+class ReadStore(object):
+    '''
+    Memory mapped reader of a .reads file.  blocks is the list of
+    (sample, offset, reads, bases, minlen, maxlen, first read number), in file
+    order.  records() and the exporters take an optional list of samples.
+    '''
+    def __init__(self, input):
+        self.input = input
+        with open(input, 'rb') as infile:
+            size = os.fstat(infile.fileno()).st_size
+            if size < 2*len(MAGIC)+8:
+                raise ReadStoreError("%s is not an amptk reads file" % input)
+            self.data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(MAGIC)] != MAGIC or self.data[-len(MAGIC):] != MAGIC:
+            raise ReadStoreError("%s is not an amptk reads file" % input)
+        start = struct.unpack('<Q', self.data[-len(MAGIC)-8:-len(MAGIC)])[0]
+        lines = self.data[start:-len(MAGIC)-8].rstrip('\n').split('\n')
+        self.binned = lines[0].split('\t')[1] == 'binned'
+        self.blocks = []
+        for line in lines[1:]:
+            cols = line.split('\t')
+            self.blocks.append(tuple([cols[0]] + [int(x) for x in cols[1:]]))
+
+    def close(self):
+        self.data.close()
+
+    def total(self):
+        return sum([x[2] for x in self.blocks])
+
+    def counts(self):
+        #reads per sample
+        counts = {}
+        for block in self.blocks:
+            counts[block[0]] = counts.get(block[0], 0) + block[2]
+        return counts
+
+    def read_block(self, block):
+        #(lengths, seqs, quals) of a block, seqs and quals are the concatenated reads
+        sample, offset, reads, bases = block[:4]
+        seqstart = offset + 4*reads
+        qualstart = seqstart + (bases+1)//2
+        lengths = np.frombuffer(self.data[offset:seqstart], dtype='<u4')
+        seqs = LETTERS[unpack(self.data[seqstart:qualstart], bases)].tostring()
+        if self.binned:
+            quals = (np.array(BINS, dtype=np.uint8)[unpack(self.data[qualstart:qualstart+(bases+1)//2], bases)] + 33).tostring()
+        else:
+            quals = self.data[qualstart:qualstart+bases]
+        return lengths, seqs, quals
+
+    def records(self, samples=None):
+        #yield (title, seq, qual) of the reads, of samples only if given
+        for block in self.blocks:
+            if samples is not None and block[0] not in samples:
+                continue
+            lengths, seqs, quals = self.read_block(block)
+            ends = np.cumsum(lengths).tolist()
+            start = 0
+            for i, end in enumerate(ends):
+                yield 'R_%i;barcodelabel=%s;' % (block[6]+i, block[0]), seqs[start:end], quals[start:end]
+                start = end
+
+    def fastq(self, output, samples=None):
+        with open(output, 'w') as outfile:
+            for title, seq, qual in self.records(samples):
+                outfile.write('@%s\n%s\n+\n%s\n' % (title, seq, qual))
+
+    def fasta(self, output, samples=None):
+        with open(output, 'w') as outfile:
+            for title, seq, qual in self.records(samples):
+                outfile.write('>%s\n%s\n' % (title, seq))
@@ -0,0 +1,407 @@
+import os, sys, shutil, tempfile, hashlib, gzip, random, unittest
+from Bio import bgzf
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+from Bio.SeqIO.SffIO import SffWriter
+from Bio.SeqIO.QualityIO import FastqGeneralIterator
+currentdir = os.path.dirname(os.path.abspath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import lib.amptklib as amptklib
+import lib.readstore as readstore
+
+TESTFASTQ = os.path.join(parentdir, 'test_data', 'ion.test.fastq')
+
+#usearch_global stand-in for vsearch: best hit of the same length at >= id identity, H and N
+#lines in the .uc file and --otutabout of the hits, samples sorted, OTUs sorted by label
+FAKEVSEARCH = """import sys
+args = sys.argv[1:]
+def opt(name):
+    return args[args.index(name) + 1] if name in args else None
+def fasta(name):
+    records = []
+    for line in open(name):
+        line = line.rstrip('\\n')
+        if line.startswith('>'):
+            records.append([line[1:], ''])
+        elif line:
+            records[-1][1] += line
+    return records
+db = fasta(opt('--db'))
+identity = float(opt('--id'))
+table = {}
+samples = set()
+uc = open(opt('--uc'), 'w')
+for title, seq in fasta(opt('--usearch_global')):
+    best = None
+    for label, ref in db:
+        if len(ref) == len(seq):
+            same = sum([x == y for x, y in zip(seq, ref)]) / float(len(seq))
+            if same >= identity and (best is None or same > best[0]):
+                best = (same, label.split()[0])
+    sample = title.split('barcodelabel=')[1].split(';')[0] if 'barcodelabel=' in title else ''
+    samples.add(sample)
+    if best:
+        uc.write('H\\t0\\t%i\\t%.1f\\t+\\t0\\t0\\t%iM\\t%s\\t%s\\n' % (len(seq), best[0] * 100, len(seq), title, best[1]))
+        table.setdefault(best[1], {})
+        table[best[1]][sample] = table[best[1]].get(sample, 0) + 1
+    else:
+        uc.write('N\\t*\\t%i\\t*\\t*\\t*\\t*\\t*\\t%s\\t*\\n' % (len(seq), title))
+uc.close()
+if opt('--otutabout'):
+    with open(opt('--otutabout'), 'w') as output:
+        output.write('#OTU ID\\t%s\\n' % '\\t'.join(sorted(samples)))
+        for otu in sorted(table):
+            output.write('%s\\t%s\\n' % (otu, '\\t'.join([str(table[otu].get(x, 0)) for x in sorted(samples)])))
+"""
+
+def wrap(text, width=60):
+    return '\n'.join([text[i:i+width] for i in range(0, len(text), width)])
+
+class TempFolder(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+class WrappedFastqTest(TempFolder):
+    def setUp(self):
+        TempFolder.setUp(self)
+        with open(TESTFASTQ) as input:
+            self.records = list(FastqGeneralIterator(input))[:300]
+        with open(self.path('plain.fq'), 'w') as output:
+            for rec in self.records:
+                output.write('@%s\n%s\n+\n%s\n' % rec)
+        with open(self.path('wrapped.fq'), 'w') as output:
+            for title, seq, qual in self.records:
+                output.write('@%s\n%s\n+\n%s\n' % (title, wrap(seq), wrap(qual)))
+
+    def test_four_lines(self):
+        self.assertTrue(amptklib.fourLineFastq(self.path('plain.fq')))
+        self.assertFalse(amptklib.fourLineFastq(self.path('wrapped.fq')))
+
+    def test_read_records(self):
+        #wrapped FASTQ is read with FastqGeneralIterator, as SeqIO did before
+        self.assertEqual(list(amptklib.readRecords(self.path('plain.fq'))), self.records)
+        self.assertEqual(list(amptklib.readRecords(self.path('wrapped.fq'))), self.records)
+
+class DemuxIndexTest(TempFolder):
+    def setUp(self):
+        TempFolder.setUp(self)
+        self.fastq = self.path('demux.fq')
+        self.samples = {'S1': [('R_1;barcodelabel=S1;', 'ACGT', 'IIII'), ('R_2;barcodelabel=S1;', 'AC', 'II')],
+                        'S2': [('R_3;barcodelabel=S2;', 'ACGTA', 'IIIII')]}
+        index = amptklib.DemuxIndex()
+        offset = 0
+        with open(self.fastq, 'w') as output:
+            for sample in ['S2', 'S1']:
+                block = ''.join(['@%s\n%s\n+\n%s\n' % x for x in self.samples[sample]])
+                lengths = [len(x[1]) for x in self.samples[sample]]
+                index.add(sample, offset, len(block), len(lengths), sum(lengths), min(lengths), max(lengths))
+                output.write(block)
+                offset += len(block)
+        os.utime(self.fastq, (1000000, 1000000))
+        index.write(self.fastq)
+
+    def test_load(self):
+        index = amptklib.loadDemuxIndex(self.fastq)
+        self.assertEqual(index.counts(), {'S1': 2, 'S2': 1})
+        self.assertEqual(index.total(), 3)
+        self.assertEqual(index.samples['S1'][:4], [2, 6, 2, 4])
+        self.assertEqual(list(index.records(self.fastq, ['S1', 'S3', 'S2'])), self.samples['S1'] + self.samples['S2'])
+        self.assertEqual(amptklib.getBarcodeCounts(self.fastq), {'S1': 2, 'S2': 1})
+        self.assertEqual(amptklib.countfastq(self.fastq), 3)
+
+    def test_stale(self):
+        #rewritten with the same size, only the mtime tells the index is stale
+        with open(self.fastq) as input:
+            text = input.read()
+        with open(self.fastq, 'w') as output:
+            output.write(text.replace('barcodelabel=S2;', 'barcodelabel=S3;'))
+        os.utime(self.fastq, (1000000, 1000001))
+        self.assertEqual(amptklib.loadDemuxIndex(self.fastq), None)
+        self.assertEqual(amptklib.getBarcodeCounts(self.fastq), {'S1': 2, 'S3': 1})
+        os.utime(self.fastq, (1000000, 1000000))
+        self.assertNotEqual(amptklib.loadDemuxIndex(self.fastq), None)
+        with open(self.fastq, 'a') as output:
+            output.write('@R_4;barcodelabel=S1;\nA\n+\nI\n')
+        os.utime(self.fastq, (1000000, 1000000))
+        self.assertEqual(amptklib.loadDemuxIndex(self.fastq), None)
+        os.remove(self.fastq)
+        self.assertEqual(amptklib.loadDemuxIndex(self.fastq), None)
+
+class SffTest(TempFolder):
+    def setUp(self):
+        #two reads, the first with quality clipping, the second with only the key clipped
+        TempFolder.setUp(self)
+        records = []
+        for name, seq, quals, right in [('R_1', 'TCAGACGTTGCA', range(20, 32), 10), ('R_2', 'TCAGGGAT', [30]*8, 0)]:
+            rec = SeqRecord(Seq(seq), id=name, description='')
+            rec.letter_annotations['phred_quality'] = quals
+            rec.annotations.update({'flow_chars': 'TACG'*10, 'flow_key': 'TCAG', 'flow_values': [100]*40, 'flow_index': [1]*len(seq),
+                                    'clip_qual_left': 4, 'clip_qual_right': right, 'clip_adapter_left': 0, 'clip_adapter_right': 0})
+            records.append(rec)
+        with open(self.path('reads.sff'), 'wb') as output:
+            SffWriter(output).write_file(records)
+        with open(self.path('reads.sff'), 'rb') as input:
+            data = input.read()
+        with gzip.open(self.path('reads.sff.gz'), 'wb') as output:
+            output.write(data)
+        self.expected = [('R_1', 'ACGTTG', '9:;<=>'), ('R_2', 'GGAT', '????')]
+
+    def test_read_records(self):
+        #the SFF parser needs tell(), which the helper process pipe counts itself
+        self.assertEqual(list(amptklib.readRecords(self.path('reads.sff'))), self.expected)
+        self.assertEqual(list(amptklib.readRecords(self.path('reads.sff.gz'))), self.expected)
+
+    def test_tell(self):
+        with open(self.path('reads.sff'), 'rb') as input:
+            data = input.read()
+        handle = amptklib.DecompressPipe(['gzip', '-dc', self.path('reads.sff.gz')])
+        self.assertEqual(handle.tell(), 0)
+        self.assertEqual(handle.read(10), data[:10])
+        self.assertEqual(handle.tell(), 10)
+        self.assertEqual(handle.readline(), data[10:data.index('\n', 10)+1])
+        self.assertEqual(handle.tell(), data.index('\n', 10)+1)
+        handle.read()
+        self.assertEqual(handle.tell(), len(data))
+        handle.close()
+
+class MultiWriterTest(TempFolder):
+    def chunks(self, n=2000, seed=1):
+        #(file, data) written in random order to 7 files
+        rand = random.Random(seed)
+        return [('S%i.fq' % rand.randint(1, 7), '@R_%i\n%s\n+\n%s\n' % (i, 'A' * rand.randint(1, 50), 'I')) for i in range(n)]
+
+    def expected(self, chunks):
+        #what one plain write per file gives
+        files = {}
+        for name, data in chunks:
+            files[name] = files.get(name, '') + data
+        return files
+
+    def check(self, compress, maxopen, bufsize):
+        chunks = self.chunks()
+        #files from an earlier run are replaced, not appended to
+        with open(self.path('S1.fq'), 'w') as output:
+            output.write('old\n')
+        with amptklib.MultiWriter(compress, maxopen, bufsize) as writer:
+            for name, data in chunks:
+                writer.write(self.path(name), data)
+                self.assertTrue(len(writer.handles) <= maxopen)
+        for name, text in self.expected(chunks).items():
+            if compress:
+                with gzip.open(self.path(name), 'rb') as input:
+                    self.assertEqual(input.read(), text)
+            else:
+                with open(self.path(name), 'rb') as input:
+                    self.assertEqual(input.read(), text)
+        return self.expected(chunks).keys()
+
+    def test_plain(self):
+        for maxopen, bufsize in [(2, 10), (1, 1), (100, 65536)]:
+            self.check(False, maxopen, bufsize)
+
+    def test_gzip(self):
+        self.check('gzip', 2, 100)
+
+    def test_bgzf(self):
+        #one EOF block at the very end, none left mid-file by re-opening
+        for name in self.check('bgzf', 2, 100):
+            with open(self.path(name), 'rb') as input:
+                data = input.read()
+                input.seek(0)
+                blocks = list(bgzf.BgzfBlocks(input))
+            self.assertTrue(data.endswith(amptklib.BGZF_EOF))
+            self.assertEqual(data.count(amptklib.BGZF_EOF), 1)
+            self.assertEqual([x[3] for x in blocks[:-1]].count(0), 0)
+            text = self.expected(self.chunks())[name]
+            with bgzf.BgzfReader(self.path(name), 'rb') as input:
+                self.assertEqual(input.read(len(text) + 1), text)
+
+class CachedTest(TempFolder):
+    #tests that use the count cache start and end with an empty one
+    def setUp(self):
+        TempFolder.setUp(self)
+        amptklib.CountCache.clear()
+        amptklib.CountCacheFile = None
+
+    def tearDown(self):
+        amptklib.CountCache.clear()
+        amptklib.CountCacheFile = None
+        TempFolder.tearDown(self)
+
+class CountCacheTest(CachedTest):
+    def write(self, name, text, mtime=1000000):
+        with open(self.path(name), 'w') as output:
+            output.write(text)
+        os.utime(self.path(name), (mtime, mtime))
+        return self.path(name)
+
+    def test_count_lines(self):
+        #same as counting lines one at a time, across 1 MB block boundaries and in gzip files
+        rand = random.Random(1)
+        big = ''.join(['>%i\n%s\n' % (i, 'A' * rand.randint(0, 200)) for i in range(30000)])
+        for text in ['', '\n', 'A', '>a', '>a\nAC\n>b\nGT', '\n\n>\n', big, big + 'ACGT', big[:1048576] + '>x\n']:
+            for name in [self.write('seqs.fa', text), self.path('seqs.fa.gz')]:
+                if name.endswith('.gz'):
+                    with gzip.open(name, 'wb') as output:
+                        output.write(text)
+                self.assertEqual(amptklib.countLines(name), len(text.splitlines()))
+                self.assertEqual(amptklib.countLinesStarting(name, '>'), len([x for x in text.splitlines() if x.startswith('>')]))
+
+    def test_counts(self):
+        with open(TESTFASTQ) as input:
+            records = list(FastqGeneralIterator(input))
+        self.assertEqual(amptklib.countfastq(TESTFASTQ), len(records))
+        self.assertEqual(amptklib.line_count(TESTFASTQ), 4 * len(records))
+        name = self.write('seqs.fa', ''.join(['>%s\n%s\n' % x[:2] for x in records]))
+        self.assertEqual(amptklib.countfasta(name), len(records))
+
+    def test_cached(self):
+        calls = []
+        def counter(input):
+            calls.append(input)
+            return len(open(input).read())
+        name = self.write('seqs.fa', 'ACGT')
+        self.assertEqual(amptklib.cachedCount(name, 'chars', counter), 4)
+        self.assertEqual(amptklib.cachedCount(name, 'chars', counter), 4)
+        self.assertEqual(len(calls), 1)
+        #a different kind is counted separately, a change in size or mtime is counted again
+        self.assertEqual(amptklib.cachedCount(name, 'other', counter), 4)
+        self.write('seqs.fa', 'ACGTA')
+        self.assertEqual(amptklib.cachedCount(name, 'chars', counter), 5)
+        self.write('seqs.fa', 'ACGTT', 1000001)
+        self.assertEqual(amptklib.cachedCount(name, 'chars', counter), 5)
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(calls[0], os.path.abspath(name))
+
+    def test_persistent(self):
+        cache = self.path('amptk.counts.txt')
+        one = self.write('one.fa', '>a\nA\n')
+        two = self.write('two.fa', '>a\nA\n>b\nC\n')
+        amptklib.setCountCache(cache)
+        self.assertEqual(amptklib.countfasta(one), 1)
+        self.assertEqual(amptklib.countfasta(two), 2)
+        with open(cache) as input:
+            self.assertEqual(input.read(), '%s\tfasta\t5\t1000000000000\t1\n%s\tfasta\t10\t1000000000000\t2\n' % (one, two))
+        #a later run loads the counts without counting, bad lines are skipped
+        with open(cache, 'a') as output:
+            output.write('bad line\n%s\tfasta\t1\t2\tx\n' % one)
+        os.remove(two)
+        amptklib.CountCache.clear()
+        amptklib.setCountCache(cache)
+        self.assertEqual(amptklib.cachedCount(one, 'fasta', None), 1)
+        self.assertEqual(sorted(amptklib.CountCache.keys()), [(one, 'fasta'), (two, 'fasta')])
+        #files that are gone are dropped when the cache is written again
+        self.assertEqual(amptklib.countfasta(self.write('three.fa', '')), 0)
+        with open(cache) as input:
+            self.assertEqual([x.split('\t')[0] for x in input], [one, self.path('three.fa')])
+        self.assertEqual([x for x in os.listdir(self.folder) if x.endswith('.tmp')], [])
+
+class FileDigestTest(CachedTest):
+    def test_digest(self):
+        name = self.path('reads.fq')
+        with open(name, 'w') as output:
+            output.write('@R_1\nACGT\n+\nIIII\n')
+        os.utime(name, (1000000, 1000000))
+        expected = hashlib.sha1('@R_1\nACGT\n+\nIIII\n').hexdigest()
+        self.assertEqual(amptklib.fileDigest(name), expected)
+        #same size and mtime is not hashed again
+        with open(name, 'w') as output:
+            output.write('@R_1\nTTTT\n+\nIIII\n')
+        os.utime(name, (1000000, 1000000))
+        self.assertEqual(amptklib.fileDigest(name), expected)
+        os.utime(name, (1000000, 1000001))
+        self.assertEqual(amptklib.fileDigest(name), hashlib.sha1('@R_1\nTTTT\n+\nIIII\n').hexdigest())
+        #leading zeros are kept
+        with open(name, 'w') as output:
+            output.write('127')
+        self.assertEqual(amptklib.fileDigest(name), '008451a05e1e7aa32c75119df950d405265e0904')
+
+    def test_persistent(self):
+        name = self.path('reads.fq')
+        with open(name, 'w') as output:
+            output.write('@R_1\nACGT\n+\nIIII\n')
+        amptklib.setCountCache(self.path('counts.txt'))
+        expected = amptklib.fileDigest(name)
+        #a later run reads the digest back from the cache file
+        amptklib.CountCache.clear()
+        amptklib.setCountCache(self.path('counts.txt'))
+        self.assertEqual(amptklib.CountCache.keys(), [(os.path.abspath(name), 'sha1')])
+        self.assertEqual(amptklib.fileDigest(name), expected)
+
+class QualityFilterTest(TempFolder):
+    def test_reads(self):
+        #a .reads file is filtered in place and returned to map from, same reads as vsearch
+        #--fastq_filter --fastq_maxee keeps: expected errors <= maxee and not empty
+        with open(TESTFASTQ) as input:
+            records = list(FastqGeneralIterator(input))
+        name = self.path('demux.reads')
+        with readstore.ReadStoreWriter(name) as writer:
+            writer.add('S1', [x[1] for x in records[:500]] + [''], [x[2] for x in records[:500]] + [''])
+            writer.add('S2', [x[1] for x in records[500:]], [x[2] for x in records[500:]])
+        reads = list(readstore.ReadStore(name).records())
+        for maxee in ['0.5', '1.0', '3']:
+            passed = [x for x in reads if x[1] and sum([10 ** (-(ord(q) - 33) / 10.0) for q in x[2]]) <= float(maxee)]
+            self.assertTrue(0 < len(passed) < len(reads) - 1)
+            fastq = self.path('filter.fq')
+            fasta = self.path('filter.fa')
+            self.assertEqual(amptklib.qualityFilter(name, maxee, fastq, fasta, self.path('orig.fa')), name)
+            self.assertFalse(os.path.isfile(self.path('orig.fa')))
+            with open(fastq) as input:
+                self.assertEqual(input.read(), ''.join(['@%s\n%s\n+\n%s\n' % x for x in passed]))
+            with open(fasta) as input:
+                self.assertEqual(input.read(), ''.join(['>%s\n%s\n' % x[:2] for x in passed]))
+
+class MapUniquesTest(TempFolder):
+    def setUp(self):
+        TempFolder.setUp(self)
+        os.makedirs(self.path('bin'))
+        with open(self.path('bin/vsearch'), 'w') as output:
+            output.write('#!%s\n%s' % (sys.executable, FAKEVSEARCH))
+        os.chmod(self.path('bin/vsearch'), 0o755)
+        self.PATH = os.environ['PATH']
+        os.environ['PATH'] = self.path('bin') + os.pathsep + self.PATH
+        amptklib.setupLogging(self.path('amptk.log'))
+
+    def tearDown(self):
+        os.environ['PATH'] = self.PATH
+        for handler in amptklib.log.handlers[:]:
+            handler.close()
+            amptklib.log.removeHandler(handler)
+        TempFolder.tearDown(self)
+
+    def test_same_as_per_read(self):
+        #searching each unique once and expanding by abundance gives the .uc line count and the
+        #--otutabout table of searching every read
+        rand = random.Random(1)
+        otus = [''.join([rand.choice('ACGT') for x in range(40)]) for i in range(20)]
+        with open(self.path('otus.fa'), 'w') as output:
+            output.write(''.join(['>OTU%i\n%s\n' % (i + 1, x) for i, x in enumerate(otus)]))
+        with open(self.path('reads.fa'), 'w') as output:
+            for i in range(1500):
+                seq = rand.choice(otus)
+                seq = ''.join([rand.choice('ACGT') if rand.random() < 0.02 else x for x in seq])
+                if rand.random() < 0.1:
+                    seq = seq[:rand.randint(20, 39)]
+                output.write('>R_%i;barcodelabel=S%i;\n%s\n' % (i + 1, rand.choice([1, 2, 3, 10, 11]), seq))
+        samples, abundances = amptklib.derepSamples(self.path('reads.fa'), self.path('uniques.fa'), 1, self.folder)
+        self.assertTrue(len(abundances) < 1000)
+        total = amptklib.mapUniques(self.path('uniques.fa'), abundances, samples, self.path('otus.fa'), self.path('uniques.uc'), self.path('otu_table.txt'))
+        cmd = ['vsearch', '--usearch_global', self.path('reads.fa'), '--strand', 'plus', '--id', '0.97', '--db', self.path('otus.fa'), '--uc', self.path('reads.uc'), '--otutabout', self.path('reads_table.txt')]
+        self.assertEqual(amptklib.runSubprocess(cmd, amptklib.log), 0)
+        self.assertEqual(total, 1500)
+        self.assertEqual(total, amptklib.line_count(self.path('reads.uc')))
+        with open(self.path('otu_table.txt')) as input:
+            table = input.read()
+        with open(self.path('reads_table.txt')) as input:
+            self.assertEqual(table, input.read())
+        self.assertTrue(table.count('\n') > 15)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+import os, sys, random, unittest
+currentdir = os.path.dirname(os.path.abspath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import lib.amptklib as amptklib
+import lib.barcode as barcode
+import lib.fasta as fasta
+
+BARCODES = fasta.ReadSeqsDict(os.path.join(parentdir, 'DB', 'pgm_barcodes.fa'))
+
+def FindBarcode(Seq, BarcodeDict):
+    #startswith() scan that BarcodeIndex replaced
+    for BarcodeLabel in BarcodeDict.keys():
+        Barcode = BarcodeDict[BarcodeLabel]
+        if Seq.startswith(Barcode):
+            return Barcode, BarcodeLabel
+    return "", ""
+
+def hamming_lookup(Seq, BarcodeDict, mismatches):
+    #closest barcode by substitutions at the start of Seq, longest barcodes first, a tie
+    #between two barcodes of one length is ambiguous and gives no hit for that length
+    best = None
+    for L in sorted(set([len(x) for x in BarcodeDict.values()]), reverse=True):
+        if len(Seq) < L:
+            continue
+        hits = sorted([(sum([a != b for a, b in zip(Seq[:L], v)]), v, k) for k, v in BarcodeDict.items() if len(v) == L])
+        if hits[0][0] > mismatches or (len(hits) > 1 and hits[1][0] == hits[0][0]):
+            continue
+        if hits[0][0] == 0:
+            return hits[0][1], hits[0][2], 0
+        if best is None or hits[0][0] < best[2]:
+            best = (hits[0][1], hits[0][2], hits[0][0])
+    return best or ("", "", 0)
+
+def mutate(rand, Seq, n, letters='ACGT'):
+    Seq = list(Seq)
+    for i in rand.sample(range(len(Seq)), n):
+        Seq[i] = rand.choice([x for x in letters if x != Seq[i]])
+    return ''.join(Seq)
+
+def reads(rand, n, errors, letters='ACGT'):
+    #(label, read) of barcodes with errors substitutions followed by 30 random bases
+    records = []
+    for i in range(n):
+        label, bc = rand.choice(sorted(BARCODES.items()))
+        records.append((label, mutate(rand, bc, errors, letters) + ''.join([rand.choice('ACGT') for x in range(30)])))
+    return records
+
+class NeighborhoodTest(unittest.TestCase):
+    def test_neighborhood(self):
+        variants = list(barcode.neighborhood('ACG', 2))
+        self.assertEqual(variants[0], ('ACG', 0))
+        #3 positions x 4 other letters, then 3 pairs x 4 x 4
+        self.assertEqual(len(variants), 1 + 12 + 48)
+        self.assertEqual(len(set([x[0] for x in variants])), len(variants))
+        for variant, d in variants:
+            self.assertEqual(sum([a != b for a, b in zip(variant, 'ACG')]), d)
+
+class BarcodeIndexTest(unittest.TestCase):
+    def test_exact(self):
+        #mismatches=0 is the old startswith() scan
+        rand = random.Random(1)
+        index = barcode.BarcodeIndex(BARCODES)
+        self.assertEqual(len(index), len(BARCODES))
+        for label, read in reads(rand, 300, 0) + reads(rand, 300, 1):
+            self.assertEqual(index.find(read), FindBarcode(read, BARCODES))
+        self.assertEqual(index.find(''), ('', ''))
+        self.assertEqual(index.exact(BARCODES['BC.1']), 'BC.1')
+        self.assertEqual(index.exact(BARCODES['BC.1'] + 'A'), None)
+
+    def test_mismatches(self):
+        #same as the closest barcode by substitutions, N counts as a mismatch
+        rand = random.Random(2)
+        for mismatches in [1, 2]:
+            index = barcode.BarcodeIndex(BARCODES, mismatches)
+            for errors in range(4):
+                for label, read in reads(rand, 200, errors, 'ACGTN'):
+                    self.assertEqual(index.lookup(read), hamming_lookup(read, BARCODES, mismatches))
+
+    def test_ambiguous(self):
+        #AAAT and AATA are 1 substitution from both AAAA and AATT, neighbors of one only are kept
+        index = barcode.BarcodeIndex({'one': 'AAAA', 'two': 'AATT', 'three': 'CCCC'}, 2)
+        self.assertEqual(index.find('AAATGG'), ('', ''))
+        self.assertEqual(index.find('AAAAGG'), ('AAAA', 'one'))
+        self.assertEqual(index.find('AATAGG'), ('', ''))
+        self.assertEqual(index.find('ATTTGG'), ('AATT', 'two'))
+        self.assertEqual(index.find('CCCAGG'), ('CCCC', 'three'))
+        self.assertEqual(index.find('GGGGGG'), ('', ''))
+
+    def test_longest_first(self):
+        index = barcode.BarcodeIndex({'short': 'ACGT', 'long': 'ACGTAC'}, 1)
+        self.assertEqual(index.find('ACGTACGG'), ('ACGTAC', 'long'))
+        self.assertEqual(index.find('ACGTTTGG'), ('ACGT', 'short'))
+        #an exact short barcode beats a long one with mismatches
+        self.assertEqual(index.find('ACGTAAGG'), ('ACGT', 'short'))
+        self.assertEqual(index.find('ACCTACGG'), ('ACGTAC', 'long'))
+
+    def test_fuzzymatch(self):
+        #reads that the old pairwise2 search put in their own sample, with no other barcode
+        #scoring as well, are put there by the index too unless two barcodes are equally close
+        rand = random.Random(3)
+        index = barcode.BarcodeIndex(BARCODES, 2)
+        checked = 0
+        for errors in [1, 2]:
+            for label, read in reads(rand, 60, errors):
+                hits = sorted([(x[0], k) for k, x in [(k, amptklib.fuzzymatch(v, read, '2')) for k, v in BARCODES.items()] if x], reverse=True)
+                if not hits or hits[0][1] != label or (len(hits) > 1 and hits[1][0] == hits[0][0]):
+                    continue
+                if hamming_lookup(read, BARCODES, 2)[1] == '':
+                    continue
+                self.assertEqual(index.find(read)[1], label)
+                checked += 1
+        self.assertTrue(checked > 80)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,179 @@
+import os, sys, shutil, tempfile, random, unittest
+currentdir = os.path.dirname(os.path.abspath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import lib.amptklib as amptklib
+import lib.derep as derep
+import lib.fastx as fastx
+
+def old_dereplicate(input):
+    #in-memory dereplicate() that lib/derep.py replaced, {seq: title;size=N;}
+    from Bio.SeqIO.QualityIO import FastqGeneralIterator
+    seqs = {}
+    with open(input, 'rU') as file:
+        for title, sequence, qual in FastqGeneralIterator(file):
+            if sequence not in seqs:
+                if title.endswith(';'):
+                    seqs[sequence] = title+'size=1;'
+                else:
+                    seqs[sequence] = title+';size=1;'
+            else:
+                count = int(seqs[sequence].split('=')[-1].rstrip(';')) + 1
+                seqs[sequence] = seqs[sequence].rsplit('=', 1)[0]+'='+str(count)+';'
+    return seqs
+
+def fixture(seed=1):
+    #(title, seq) of reads from 3 samples: sequences repeated up to 12 times, the rare ones
+    #first so input order is the reverse of abundance order, plus N, IUPAC and odd lengths
+    rand = random.Random(seed)
+    seqs = [''.join([rand.choice('ACGT') for i in range(rand.randint(20, 31))]) for x in range(40)]
+    seqs += ['ACGTNNACGT', 'ACRYSWKMBDHVN', 'ACGTA', 'acgtacgt', 'ACGT-ACGT']
+    reads = []
+    for i, seq in enumerate(seqs):
+        reads += [seq] * (1 + i % 12)
+    reverse = reads[::-1]
+    rand.shuffle(reads)
+    return [('R_%i;barcodelabel=S%i;' % (i+1, i % 3), seq) for i, seq in enumerate(reverse + reads)]
+
+def counted(reads, label=None):
+    #expected uniques, most abundant first and ties in order of the first read
+    uniques = {}
+    for n, (title, seq) in enumerate(reads):
+        key = (seq, label(title) if label else None)
+        sample = derep.sample_label(title)
+        if key not in uniques:
+            uniques[key] = [0, n, title, {}]
+        uniques[key][0] += 1
+        uniques[key][3][sample] = uniques[key][3].get(sample, 0) + 1
+    order = sorted(uniques.items(), key=lambda x: (-x[1][0], x[1][1]))
+    return [(title, key[0], size, samples) for key, (size, n, title, samples) in order]
+
+class PackTest(unittest.TestCase):
+    def test_round_trip(self):
+        seqs = ['', 'A', 'AC', 'ACG', 'ACGTACGTACGTACGTA', 'NNNN', 'ACGTN', 'ACMGRSVTWYHKDBN',
+            'acgt', 'ACgt', 'AC-GT', 'AC=GT', 'ACXGT', 'ACGT\n']
+        keys = derep.pack_keys(seqs)
+        self.assertEqual([derep.unpack_key(x) for x in keys], seqs)
+        self.assertEqual(len(set(keys)), len(seqs))
+
+    def test_packed_keys(self):
+        #upper case IUPAC packs two bases per byte, anything else is kept behind a NUL
+        keys = derep.pack_keys(['ACGTA', 'ACGTN', 'acgta', 'AC-GT'])
+        self.assertEqual([len(x) for x in keys[:2]], [3, 3])
+        self.assertEqual(keys[2], '\0acgta')
+        self.assertEqual(keys[3], '\0AC-GT')
+        self.assertNotEqual(keys[0], derep.pack_keys(['ACGTA='])[0])
+
+    def test_equal_keys(self):
+        seqs = ['ACGTACGTA', 'ACGTACGTA', 'ACGTACGTAC', 'acgtacgta']
+        keys = derep.pack_keys(seqs)
+        self.assertEqual(keys[0], keys[1])
+        self.assertNotEqual(keys[0], keys[2])
+        self.assertNotEqual(keys[0], keys[3])
+        self.assertEqual(keys[0], derep.pack_keys(['ACGTACGTA', 'acgt'])[0])
+
+    def test_sample_label(self):
+        self.assertEqual(derep.sample_label('R_1;barcodelabel=S1;'), 'S1')
+        self.assertEqual(derep.sample_label('R_1;sample=S2;size=3;'), 'S2')
+        self.assertEqual(derep.sample_label('R_1'), '')
+
+class PartitionTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def uniques(self, reads, buckets, limit, label=None, chunk=7):
+        parts = derep.Partitioner(self.folder, buckets, label, limit)
+        for i in range(0, len(reads), chunk):
+            parts.add(reads[i:i+chunk])
+        files = parts.close()
+        self.assertEqual(len(files), buckets)
+        runs = [x[:-len('.bin')] + '.run' for x in files]
+        totals = map(derep.count_bucket, zip(files, runs))
+        self.assertEqual(sum([x[0] for x in totals]), len(reads))
+        return parts, runs, list(derep.merge_runs(runs))
+
+    def test_in_memory(self):
+        reads = fixture()
+        parts, runs, uniques = self.uniques(reads, 1, 1000000)
+        self.assertEqual(uniques, counted(reads))
+        self.assertEqual(parts.reads, len(reads))
+        samples = {}
+        for title, seq in reads:
+            samples[derep.sample_label(title)] = samples.get(derep.sample_label(title), 0) + 1
+        self.assertEqual(parts.samples, samples)
+
+    def test_spill(self):
+        #limit 5 spills every few chunks, the same sequence ends up in a bucket many times
+        reads = fixture()
+        parts, runs, uniques = self.uniques(reads, 13, 5)
+        self.assertEqual(uniques, counted(reads))
+        self.assertTrue(len([x for x in runs if os.path.getsize(x)]) > 1)
+
+    def test_merge_order(self):
+        reads = fixture(2)
+        parts, runs, uniques = self.uniques(reads, 9, 3)
+        sizes = [x[2] for x in uniques]
+        self.assertEqual(sizes, sorted(sizes, reverse=True))
+        first = dict([(seq, n) for n, (title, seq) in reversed(list(enumerate(reads)))])
+        for a, b in zip(uniques, uniques[1:]):
+            if a[2] == b[2]:
+                self.assertTrue(first[a[1]] < first[b[1]])
+        #each run on its own is sorted the same way
+        for run in runs:
+            records = [x[:2] for x in derep.run_records(run)]
+            self.assertEqual(records, sorted(records))
+
+    def test_label(self):
+        label = lambda title: derep.sample_label(title)
+        reads = fixture()
+        parts, runs, uniques = self.uniques(reads, 5, 4, label)
+        self.assertEqual(uniques, counted(reads, label))
+        self.assertTrue(len(uniques) > len(counted(reads)))
+        for title, seq, size, samples in uniques:
+            self.assertEqual(samples.keys(), [derep.sample_label(title)])
+
+class DereplicateTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.input = os.path.join(self.folder, 'reads.fq')
+        with open(self.input, 'w') as output:
+            for title, seq in fixture():
+                output.write('@%s\n%s\n+\n%s\n' % (title, seq, 'I' * len(seq)))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def dereplicated(self, output):
+        with open(output, 'rU') as input:
+            return list(fastx.fasta_records(input))
+
+    def test_same_as_old(self):
+        #memory of 1 KB gives a few dozen buckets and spills every 1000 uniques
+        old = old_dereplicate(self.input)
+        output = os.path.join(self.folder, 'uniques.fa')
+        for cpus, memory in [(1, 2147483648), (1, 1024), (2, 1024)]:
+            amptklib.dereplicate(self.input, output, cpus, memory)
+            new = self.dereplicated(output)
+            self.assertEqual(dict([(seq, title) for title, seq in new]), old)
+            sizes = [int(x[0].split('size=')[1].rstrip(';')) for x in new]
+            self.assertEqual(sizes, sorted(sizes, reverse=True))
+        self.assertEqual(sorted(os.listdir(self.folder)), ['reads.fq', 'uniques.fa'])
+
+    def test_table(self):
+        output = os.path.join(self.folder, 'uniques.fa')
+        table = os.path.join(self.folder, 'uniques.txt')
+        amptklib.dereplicate(self.input, output, table=table)
+        with open(table, 'rU') as input:
+            lines = [x.rstrip('\n').split('\t') for x in input]
+        self.assertEqual(lines[0], ['#OTU ID', 'S0', 'S1', 'S2'])
+        expected = counted(fixture())
+        self.assertEqual(len(lines) - 1, len(expected))
+        for cols, (title, seq, size, samples) in zip(lines[1:], expected):
+            self.assertEqual(cols[0], title.split(';', 1)[0])
+            self.assertEqual([int(x) for x in cols[1:]], [samples.get(x, 0) for x in ['S0', 'S1', 'S2']])
+
+if __name__ == "__main__":
+    unittest.main()
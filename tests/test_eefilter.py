@@ -0,0 +1,97 @@
+import os, sys, random, unittest
+from cStringIO import StringIO
+import numpy as np
+currentdir = os.path.dirname(os.path.abspath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import lib.eefilter as eefilter
+
+def ee(qual):
+    #expected errors of a quality string, one base at a time
+    return sum([10 ** (-max(ord(x) - 33, 0) / 10.0) for x in qual])
+
+def reads(n=300, seed=1):
+    rand = random.Random(seed)
+    records = []
+    for i in range(n):
+        length = rand.randint(0, 60)
+        qual = ''.join([chr(33 + rand.choice([2, 10, 20, 30, 35, 40, 41])) for x in range(length)])
+        records.append(('R_%i' % (i+1), 'A' * length, qual))
+    return records
+
+def passing(qual, maxee, trunclen):
+    #longest prefix, up to trunclen, with expected errors <= maxee
+    qual = qual if trunclen is None else qual[:trunclen]
+    n = 0
+    while n < len(qual) and ee(qual[:n+1]) <= maxee + 1e-9:
+        n += 1
+    return n
+
+class EETest(unittest.TestCase):
+    def test_error_table(self):
+        self.assertEqual(eefilter.PROBS[0], 0)
+        self.assertAlmostEqual(eefilter.PROBS[ord('!')], 1.0)
+        self.assertAlmostEqual(eefilter.PROBS[ord('+')], 0.1)
+        self.assertAlmostEqual(eefilter.PROBS[ord('I')], 0.0001)
+        self.assertAlmostEqual(eefilter.PROBS[ord(' ')], 1.0)
+        self.assertAlmostEqual(eefilter.error_table(64)[ord('h')], 0.0001)
+
+    def test_parse_thresholds(self):
+        self.assertEqual(eefilter.parse_thresholds('1.0:250,0.5:200,2'), [(1.0, 250), (0.5, 200), (2.0, None)])
+        self.assertEqual(eefilter.parse_thresholds('1:,, 0.25 : 100 '), [(1.0, None), (0.25, 100)])
+
+    def test_expected_errors(self):
+        quals = [x[2] for x in reads()]
+        got = eefilter.expected_errors(quals)
+        for value, qual in zip(got.tolist(), quals):
+            self.assertAlmostEqual(value, ee(qual))
+        self.assertEqual(eefilter.expected_errors(['', '']).tolist(), [0, 0])
+        self.assertEqual(eefilter.expected_errors([]).tolist(), [])
+
+    def test_cumulative(self):
+        quals = [x[2] for x in reads(50)]
+        cum, lengths = eefilter.cumulative(quals, 30)
+        self.assertEqual(lengths.tolist(), [min(len(x), 30) for x in quals])
+        self.assertEqual(cum.shape, (50, 30))
+        for row, qual in zip(cum, quals):
+            for j in range(30):
+                self.assertAlmostEqual(row[j], ee(qual[:j+1]))
+
+    def test_passing_prefixes(self):
+        thresholds = [(1.0, 50), (0.5, 20), (2.0, None), (0.0, None)]
+        quals = [x[2] for x in reads()]
+        cum, lengths = eefilter.cumulative(quals)
+        prefixes = eefilter.passing_prefixes(cum, lengths, thresholds)
+        for row, qual in zip(prefixes.tolist(), quals):
+            self.assertEqual(row, [passing(qual, maxee, trunclen) for maxee, trunclen in thresholds])
+
+    def test_scan_summary(self):
+        thresholds = [(1.0, 50), (0.5, 20)]
+        records = reads()
+        text = ''.join(['@%s\n%s\n+\n%s\n' % x for x in records])
+        summary = eefilter.Summary(thresholds)
+        scanned = []
+        for block, lengths, prefixes in eefilter.scan(StringIO(text), thresholds, size=500):
+            scanned += block
+            summary.add(lengths, prefixes)
+        self.assertEqual(scanned, records)
+        self.assertEqual(summary.reads, len(records))
+        for maxee, trunclen, passed, full, bases in summary.rows():
+            kept = [x for x in records if ee(x[2][:trunclen]) <= maxee + 1e-9]
+            self.assertEqual(passed, len(kept))
+            self.assertEqual(full, len([x for x in kept if len(x[1]) >= trunclen]))
+            self.assertEqual(bases, sum([min(len(x[1]), trunclen) for x in kept]))
+
+    def test_filter_records(self):
+        records = reads()
+        for maxee, trunclen in [(1.0, None), (0.5, 25), (0.0, 10)]:
+            expected = []
+            for title, seq, qual in records:
+                if trunclen is not None:
+                    seq, qual = seq[:trunclen], qual[:trunclen]
+                if ee(qual) <= maxee:
+                    expected.append((title, seq, qual))
+            self.assertEqual(eefilter.filter_records(iter(records), maxee, trunclen), expected)
+
+if __name__ == "__main__":
+    unittest.main()
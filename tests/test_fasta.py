@@ -0,0 +1,110 @@
+import os, sys, shutil, tempfile, random, unittest
+from Bio import SeqIO
+currentdir = os.path.dirname(os.path.abspath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import lib.fasta as fasta
+
+def records(rand, n):
+	#(title, seq) with a description after the name on some, empty and single base sequences
+	recs = []
+	for i in range(n):
+		length = rand.choice([0, 1, 59, 60, 61, 80, rand.randint(0, 500)])
+		seq = ''.join([rand.choice('ACGTNacgt') for x in range(length)])
+		title = 'OTU_%i;size=%i;' % (i, rand.randint(1, 1000))
+		if rand.random() < 0.3:
+			title += ' some description %i' % i
+		recs.append((title, seq))
+	return recs
+
+def wrapped(recs, width, newline='\n'):
+	#every sequence wrapped at width, as samtools faidx can index
+	text = []
+	for title, seq in recs:
+		text.append('>' + title + newline)
+		for i in range(0, len(seq), width):
+			text.append(seq[i:i+width] + newline)
+	return ''.join(text)
+
+def irregular(rand, recs):
+	#lines of random length and blank lines, faidx can't index these
+	text = []
+	for title, seq in recs:
+		text.append('>' + title + '\n')
+		p = 0
+		while p < len(seq):
+			size = rand.randint(1, 100)
+			text.append(seq[p:p+size] + '\n')
+			p += size
+			if rand.random() < 0.1:
+				text.append('\n')
+	return ''.join(text)
+
+class FastaIndexTest(unittest.TestCase):
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.input = os.path.join(self.folder, 'otus.fa')
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def write(self, text):
+		with open(self.input, 'wb') as output:
+			output.write(text)
+		return self.input
+
+	def check(self, text, rand, indexed=True, Save=True):
+		#Fetch of whole sequences and of slices is the same as SeqIO.index
+		index = fasta.FastaIndex(self.write(text), Save)
+		expected = SeqIO.index(self.input, 'fasta')
+		self.assertEqual(index.Seqs is None, indexed)
+		self.assertEqual(index.keys(), list(expected.keys()))
+		self.assertEqual(len(index), len(expected))
+		for Label in expected:
+			Seq = str(expected[Label].seq)
+			self.assertTrue(Label in index)
+			self.assertEqual(index[Label], Seq)
+			for i in range(5):
+				Start = rand.randint(0, len(Seq) + 2)
+				End = rand.randint(Start, len(Seq) + 5)
+				self.assertEqual(index.Fetch(Label, Start, End), Seq[Start:End])
+			self.assertEqual(index.Fetch(Label, min(3, len(Seq))), Seq[3:])
+		self.assertFalse('OTU_missing' in index)
+		index.close()
+		expected.close()
+
+	def test_wrapped(self):
+		rand = random.Random(1)
+		recs = records(rand, 200)
+		for width in [1, 7, 60, 80, 1000]:
+			self.check(wrapped(recs, width), rand)
+			self.assertTrue(os.path.isfile(self.input + '.fai'))
+			os.remove(self.input + '.fai')
+		self.check(wrapped(recs, 60, '\r\n'), rand)
+
+	def test_saved_index(self):
+		#an index written by the first FastaIndex is read back by the next, Save=False writes none
+		rand = random.Random(2)
+		recs = records(rand, 100)
+		self.check(wrapped(recs, 60), rand, Save=False)
+		self.assertFalse(os.path.isfile(self.input + '.fai'))
+		self.check(wrapped(recs, 60), rand)
+		with open(self.input + '.fai') as input:
+			self.assertEqual(len(input.read().splitlines()), 100)
+		os.utime(self.input + '.fai', (os.path.getmtime(self.input) + 10,) * 2)
+		self.check(wrapped(recs, 60), rand)
+
+	def test_irregular(self):
+		#files faidx can't index are read into memory and give the same sequences
+		rand = random.Random(3)
+		recs = records(rand, 200)
+		text = irregular(rand, recs)
+		self.assertEqual(fasta.BuildFaidx(self.write(text)), None)
+		self.check(text, rand, indexed=False)
+		self.assertFalse(os.path.isfile(self.input + '.fai'))
+		#a longer line after a short one, and a blank line inside a sequence
+		self.check('>a\nACG\nACGT\n>b\nAC\n', rand, indexed=False)
+		self.check('>a\nACGT\n\nACGT\n>b\nAC\n', rand, indexed=False)
+
+if __name__ == "__main__":
+	unittest.main()
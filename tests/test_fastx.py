@@ -0,0 +1,85 @@
+import os, sys, unittest
+from cStringIO import StringIO
+from Bio.SeqIO.QualityIO import FastqGeneralIterator
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+currentdir = os.path.dirname(os.path.abspath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import lib.fastx as fastx
+
+TESTFASTQ = os.path.join(parentdir, 'test_data', 'ion.test.fastq')
+
+def fastq_text(n=50):
+    return ''.join(['@R_%i;barcodelabel=S%i; extra\n%s\n+\n%s\n' % (i, i % 3, 'ACGT' * (i % 9 + 1), '#I' * (2 * (i % 9 + 1))) for i in range(n)])
+
+class FastqTest(unittest.TestCase):
+    def test_same_as_biopython(self):
+        with open(TESTFASTQ, 'rb') as input:
+            data = input.read()
+        expected = list(FastqGeneralIterator(StringIO(data)))
+        self.assertEqual(list(fastx.fastq_records(StringIO(data))), expected)
+        #records split across chunk boundaries
+        data = data[:data.index('\n@', 20000)+1]
+        expected = list(FastqGeneralIterator(StringIO(data)))
+        for size in [1, 7, 100, 4096]:
+            self.assertEqual(list(fastx.fastq_records(StringIO(data), size)), expected)
+
+    def test_chunks(self):
+        text = fastq_text()
+        expected = list(FastqGeneralIterator(StringIO(text)))
+        for size in [1, 5, 37, 100, 1000000]:
+            chunks = list(fastx.fastq_chunks(StringIO(text), size))
+            self.assertEqual([x for chunk in chunks for x in chunk], expected)
+            self.assertTrue(all(chunks))
+
+    def test_line_endings(self):
+        text = fastq_text(10)
+        expected = list(FastqGeneralIterator(StringIO(text)))
+        self.assertEqual(list(fastx.fastq_records(StringIO(text.replace('\n', '\r\n')), 13)), expected)
+        self.assertEqual(list(fastx.fastq_records(StringIO(text.rstrip('\n')))), expected)
+        self.assertEqual(fastx.parse_fastq(text + '\n\n'), expected)
+        self.assertEqual(list(fastx.fastq_records(StringIO(''))), [])
+
+    def test_bad_records(self):
+        self.assertRaises(ValueError, list, fastx.fastq_records(StringIO('@R_1\nACGT\n+\nIII\n')))
+        self.assertRaises(ValueError, list, fastx.fastq_records(StringIO('@R_1\nACGT\n+\nIIII\n@R_2\nACGT\n')))
+        self.assertRaises(ValueError, list, fastx.fastq_records(StringIO('>R_1\nACGT\n+\nIIII\n')))
+        self.assertRaises(ValueError, list, fastx.fastq_records(StringIO('@R_1\nACGT\nACGT\n+\nIIIIIIII\n')))
+        #strict=False leaves checking to the caller
+        self.assertEqual(fastx.parse_fastq('@R_1\nACGT\n+\nIII\n', strict=False), [('R_1', 'ACGT', 'III')])
+
+class FastaTest(unittest.TestCase):
+    TEXT = '\n>OTU1;size=5;\nACGT\nACGT\n>OTU2 description\nAC\r\nGG\r\n>OTU3\n\n>OTU4\nTTTT\n'
+
+    def test_same_as_biopython(self):
+        expected = list(SimpleFastaParser(StringIO(self.TEXT.replace('\r', ''))))
+        self.assertEqual(expected[2], ('OTU3', ''))
+        for size in [1, 3, 10, 1000000]:
+            self.assertEqual(list(fastx.fasta_records(StringIO(self.TEXT), size)), expected)
+
+    def test_no_newline(self):
+        self.assertEqual(list(fastx.fasta_records(StringIO('>a\nAC\nGT'))), [('a', 'ACGT')])
+        self.assertEqual(list(fastx.fasta_records(StringIO(''))), [])
+
+class WriterTest(unittest.TestCase):
+    def test_fastq_writer(self):
+        records = list(FastqGeneralIterator(StringIO(fastq_text())))
+        output = StringIO()
+        with fastx.FastqWriter(output, size=64) as writer:
+            writer.write(*records[0])
+            writer.writerecords(records[1:])
+        self.assertEqual(output.getvalue(), ''.join(['@%s\n%s\n+\n%s\n' % x for x in records]))
+
+    def test_fasta_writer(self):
+        records = list(FastqGeneralIterator(StringIO(fastq_text())))
+        output = StringIO()
+        writer = fastx.FastaWriter(output)
+        writer.write(*records[0][:2])
+        writer.writerecords(records[1:])
+        self.assertEqual(output.getvalue(), '')
+        writer.close()
+        self.assertEqual(output.getvalue(), ''.join(['>%s\n%s\n' % x[:2] for x in records]))
+        self.assertFalse(output.closed)
+
+if __name__ == "__main__":
+    unittest.main()
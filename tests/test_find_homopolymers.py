@@ -0,0 +1,61 @@
+import os, sys, shutil, tempfile, random, subprocess, unittest
+from Bio import SeqIO
+from Bio.SeqUtils import GC
+currentdir = os.path.dirname(os.path.abspath(__file__))
+parentdir = os.path.dirname(currentdir)
+SCRIPT = os.path.join(parentdir, 'util', 'find_homopolymers.py')
+
+def old_report(fasta, num_homo):
+    #run list per record and GC() of Bio.SeqUtils, what the script did before the numpy scan
+    lines = ["SeqID\tLength (bp)\tGC Content (%)\tHomopolymers (Len(nuc):start-stop)\n"]
+    for record in SeqIO.parse(open(fasta, 'rU'), 'fasta'):
+        runs = []
+        for x in str(record.seq):
+            if runs and runs[-1][0] == x:
+                runs[-1][1] += 1
+            else:
+                runs.append([x, 1])
+        found = []
+        start = 0
+        for base, run in runs:
+            if run >= num_homo and base != 'N':
+                found.append("%i(%s):%i-%i;" % (run, base, start, start + run))
+            start += run
+        homo_out = ' '.join(found) if found else 'None found'
+        lines.append("%s\t%s\t%.2f\t%s\n" % (record.id, len(record.seq), GC(record.seq), homo_out))
+    return ''.join(lines)
+
+def sequences(rand, n):
+    #runs of random length in mixed case with N and S runs, some empty sequences, wrapped at 60
+    text = []
+    for i in range(n):
+        seq = ''.join([rand.choice('ACGTNSacgt') * rand.choice([1, 1, 2, 3, 5, 6, 7, 12]) for x in range(rand.randint(0, 80))])
+        text.append('>OTU_%i%s\n' % (i, rand.choice(['', ';size=4;', ' description here'])))
+        text.extend([seq[p:p+60] + '\n' for p in range(0, len(seq), 60)])
+    return ''.join(text)
+
+class FindHomopolymersTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.fasta = os.path.join(self.folder, 'otus.fa')
+        with open(self.fasta, 'w') as output:
+            output.write('>first\n\n>second\nNNNNNNNNAAAAAAaaaaaa\n' + sequences(random.Random(1), 3000))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def run_script(self, *args):
+        output = os.path.join(self.folder, 'out.txt')
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call([sys.executable, SCRIPT, '-i', self.fasta, '-o', output] + list(args), stdout=devnull)
+        with open(output) as input:
+            return input.read()
+
+    def test_report(self):
+        for num_homo in ['3', '6']:
+            expected = old_report(self.fasta, int(num_homo))
+            self.assertEqual(self.run_script('-n', num_homo), expected)
+            self.assertEqual(self.run_script('-n', num_homo, '--cpus', '3'), expected)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+import os, sys, random, unittest
+currentdir = os.path.dirname(os.path.abspath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import lib.primer as primer
+
+PRIMERS = ['GTGARTCATCGAATCTTTG', 'TCCTCCGCTTATTGATATGC', 'ACGT', 'NNNNACGT', 'A', 'GGACTACNVGGGTWTCTAAT']
+
+#letter by letter scans that the bit-parallel versions replaced
+def OldMatchPrefix(Seq, Primer):
+	n = min(len(Seq), len(Primer))
+	Diffs = 0
+	for i in range(0, n):
+		if not primer.MatchLetter(Seq[i], Primer[i]):
+			Diffs += 1
+	return Diffs
+
+def OldBestMatch2(Seq, Primer, MaxDiffs, NotFound=-1):
+	PrimerLength = len(Primer)
+	BestDiffs = PrimerLength
+	BestPos = NotFound
+	for Pos in range(0, len(Seq)-PrimerLength+1):
+		d = primer.MatchPrefix2(Seq[Pos:], Primer, MaxDiffs)
+		if d < BestDiffs and d <= MaxDiffs:
+			BestDiffs = d
+			BestPos = Pos
+	return BestPos, BestDiffs
+
+def mutate(rand, Seq, n):
+	Seq = list(Seq)
+	for i in rand.sample(range(len(Seq)), min(n, len(Seq))):
+		Seq[i] = rand.choice([x for x in 'ACGT' if not primer.MatchLetter(x, Seq[i])] or ['N'])
+	return ''.join(Seq)
+
+def concrete(rand, Primer):
+	#a read version of Primer, IUPAC letters replaced by one of their bases
+	return ''.join([rand.choice(primer.LetterToSet[x]) for x in Primer])
+
+def reads(rand, Primer, n, maxerrors=3):
+	#random reads holding 0, 1 or 2 copies of Primer with up to maxerrors mismatches each
+	records = []
+	for i in range(n):
+		parts = [''.join([rand.choice('ACGTACGTN') for x in range(rand.randint(0, 40))])]
+		for copy in range(rand.randint(0, 2)):
+			parts.append(mutate(rand, concrete(rand, Primer), rand.randint(0, maxerrors)))
+			parts.append(''.join([rand.choice('ACGT') for x in range(rand.randint(0, 30))]))
+		Seq = ''.join(parts)
+		records.append(Seq.lower() if i % 10 == 0 else Seq)
+	return records
+
+class BitMatchTest(unittest.TestCase):
+	def test_match_prefix(self):
+		rand = random.Random(1)
+		for Primer in PRIMERS:
+			for Seq in reads(rand, Primer, 100):
+				for Pos in range(0, len(Seq), 7):
+					self.assertEqual(primer.BitMatchPrefix(Seq[Pos:], Primer), OldMatchPrefix(Seq[Pos:], Primer))
+		self.assertEqual(primer.BitMatchPrefix('', 'ACGT'), 0)
+		self.assertEqual(primer.BitMatchPrefix('ACG', 'ACGT'), 0)
+		self.assertEqual(primer.BitMatchPrefix('AZ-T', 'ACGT'), OldMatchPrefix('AZ-T', 'ACGT'))
+
+	def test_best_match(self):
+		rand = random.Random(2)
+		for Primer in PRIMERS:
+			for Seq in reads(rand, Primer, 150):
+				for MaxDiffs in [0, 1, 2, 3, 5]:
+					self.assertEqual(primer.BestMatch2(Seq, Primer, MaxDiffs), OldBestMatch2(Seq, Primer, MaxDiffs))
+					self.assertEqual(primer.BestMatch3(Seq, Primer, MaxDiffs), OldBestMatch2(Seq, Primer, MaxDiffs, -2))
+				self.assertEqual(primer.BestMatch(Seq, Primer), OldBestMatch2(Seq, Primer, len(Primer)))
+
+	def test_short_reads(self):
+		self.assertEqual(primer.BestMatch2('ACG', 'ACGT', 2), (-1, 4))
+		self.assertEqual(primer.BestMatch2('', 'ACGT', 2), (-1, 4))
+		self.assertEqual(primer.BestMatch2('ACGT', 'ACGT', 0), (0, 0))
+		self.assertEqual(primer.BestMatch2('ACGT', 'ACGT', -1), (-1, 4))
+		self.assertEqual(primer.BestMatch2('TTTT', 'ACGT', 4), OldBestMatch2('TTTT', 'ACGT', 4))
+
+class QuickBestMatchTest(unittest.TestCase):
+	def test_same_as_best_match(self):
+		#reads with 0, 1 or 2 primer copies, each with 0-2 mismatches
+		rand = random.Random(3)
+		for Primer in PRIMERS:
+			for Seq in reads(rand, Primer, 300, 2):
+				for MaxDiffs in [-1, 0, 1, 2, 3]:
+					self.assertEqual(primer.QuickBestMatch2(Seq, Primer, MaxDiffs), primer.BestMatch2(Seq, Primer, MaxDiffs))
+					self.assertEqual(primer.QuickBestMatch2(Seq, Primer, MaxDiffs), OldBestMatch2(Seq, Primer, MaxDiffs))
+
+	def test_exact_and_fuzzy(self):
+		#an exact copy wins over an earlier one with mismatches, the leftmost of two exact copies wins
+		Primer = 'TCCTCCGCTTATTGATATGC'
+		Fuzzy = 'TCCTCCGCTTATAGATATGC'
+		self.assertEqual(primer.QuickBestMatch2('AA' + Fuzzy + 'GG' + Primer + 'T', Primer, 2), (24, 0))
+		self.assertEqual(primer.QuickBestMatch2('AA' + Fuzzy + 'GG' + Fuzzy + 'T', Primer, 2), (2, 1))
+		self.assertEqual(primer.QuickBestMatch2('A' + Primer + Primer, Primer, 2), (1, 0))
+		self.assertEqual(primer.QuickBestMatch2('A' + Primer, Primer, -1), (-1, 20))
+		self.assertEqual(primer.QuickBestMatch2('ACGT', '', 2), primer.BestMatch2('ACGT', '', 2))
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,146 @@
+import os, sys, shutil, tempfile, gzip, random, unittest
+from struct import pack
+from Bio import bgzf
+currentdir = os.path.dirname(os.path.abspath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import lib.pybam as pybam
+
+CODES = '=ACMGRSVTWYHKDBN'
+COMPLEMENT = dict(zip(CODES, '=TGKCYSBAWRDMHVN'))
+REFERENCES = [('chr1', 5000), ('chr2', 300)]
+
+def alignment(name, flag, seq, quals, refID=-1, pos=-1, cigar=[], tags=''):
+    #one BAM alignment record, SAM specification section 4.2
+    packed = ''.join([chr(CODES.index(a) << 4 | CODES.index(b)) for a, b in zip(seq[0::2], (seq + '=')[1::2])])
+    body = pack('<iiBBHHHiiii', refID, pos, len(name) + 1, 60, 4680, len(cigar), flag, len(seq), refID, pos, 0)
+    body += name + '\0' + ''.join([pack('<I', x) for x in cigar]) + packed + ''.join([chr(x) for x in quals]) + tags
+    return pack('<i', len(body)) + body
+
+def header():
+    #text and binary header, pybam.read checks that both list the same references
+    text = '@HD\tVN:1.5\n' + ''.join(['@SQ\tSN:%s\tLN:%i\n' % x for x in REFERENCES])
+    data = 'BAM\1' + pack('<i', len(text)) + text + pack('<i', len(REFERENCES))
+    for name, length in REFERENCES:
+        data += pack('<i', len(name) + 1) + name + '\0' + pack('<i', length)
+    return data
+
+def alignments(rand, n):
+    #random reads, a mix of unmapped, reverse strand, secondary and supplementary
+    records = []
+    for i in range(n):
+        length = rand.randint(0, 300)
+        seq = ''.join([rand.choice('ACGTACGTACGTN') for x in range(length)])
+        quals = [rand.randint(0, 93) for x in range(length)]
+        flag = rand.choice([0, 4, 16, 16, 0x100, 0x800, 0x810, 0x1 | 0x40 | 0x10])
+        name = 'R_%i:%s' % (i, rand.choice(['a', 'long.read/name|x', 'y' * rand.randint(1, 60)]))
+        refID = -1 if flag & 4 else rand.randint(0, len(REFERENCES) - 1)
+        cigar = [] if flag & 4 else [length << 4]
+        tags = rand.choice(['', 'NMC\x01', 'RGZgroup1\0'])
+        records.append((name, flag, seq, quals, alignment(name, flag, seq, quals, refID, rand.randint(0, 100), cigar, tags)))
+    return records
+
+def write_bam(filename, data, rand):
+    #BGZF blocks end at random points, inside the header and inside alignments
+    with open(filename, 'wb') as handle:
+        writer = bgzf.BgzfWriter(fileobj=handle)
+        p = 0
+        while p < len(data):
+            size = rand.choice([7, 100, 3000, 20000, 70000])
+            writer.write(data[p:p+size])
+            p += size
+            if rand.random() < 0.5:
+                writer.flush()
+        writer.close()
+
+def old_fastq(filename):
+    #the per-alignment pybam.read parser, with the read selection of samtools fastq
+    records = []
+    with open(filename, 'rb') as input:
+        for name, seq, qual, flag in pybam.read(input, ['sam_qname', 'sam_seq', 'sam_qual', 'sam_flag']):
+            if flag & 0x900:
+                continue
+            if flag & 16:
+                seq = ''.join([COMPLEMENT[x] for x in reversed(seq)])
+                qual = qual[::-1]
+            records.append((name, seq, qual))
+    return records
+
+class BamTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.bam = os.path.join(self.folder, 'reads.bam')
+        rand = random.Random(1)
+        self.records = alignments(rand, 3000)
+        self.data = header() + ''.join([x[4] for x in self.records])
+        write_bam(self.bam, self.data, rand)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def batches(self, *args, **kwargs):
+        return [x for batch in pybam.fastq_batches(self.bam, *args, **kwargs) for x in batch]
+
+    def test_fastq_batches(self):
+        expected = old_fastq(self.bam)
+        self.assertEqual(len(expected), len([x for x in self.records if not x[1] & 0x900]))
+        self.assertEqual(self.batches(), expected)
+        self.assertEqual(self.batches(batch_size=7), expected)
+        self.assertTrue(all([len(batch) <= 7 for batch in pybam.fastq_batches(self.bam, batch_size=7)]))
+        self.assertEqual(self.batches(cpus=2), expected)
+
+    def test_missing_quality(self):
+        #0xFF (no quality) is capped the same as samtools, at '~'
+        data = header() + alignment('R_1', 0, 'ACG', [0xFF] * 3) + alignment('R_2', 16, 'ACGTN', [0, 10, 20, 30, 93])
+        write_bam(self.bam, data, random.Random(2))
+        self.assertEqual(self.batches(), [('R_1', 'ACG', '~~~'), ('R_2', 'NACGT', '~?5+!')])
+
+    def test_read(self):
+        reader = pybam.bgzf(self.bam)
+        with gzip.open(self.bam, 'rb') as input:
+            self.assertEqual(input.read(), self.data)
+        self.assertEqual(''.join(reader.read()), self.data)
+        self.assertEqual(''.join(pybam.bgzf(self.bam, cpus=2, blocks_per_job=3).read()), self.data)
+        #virtual offsets of every block start and a few points inside blocks
+        starts = []
+        p = 0
+        for offset, data in reader.chunks():
+            starts += [(offset << 16 | x, p + x) for x in [0, len(data) // 3]]
+            p += len(data)
+        for start, p in starts[::5]:
+            for end, q in starts[::7]:
+                if q >= p:
+                    self.assertEqual(''.join(reader.read(start, end)), self.data[p:q])
+        first = reader.first_alignment()
+        self.assertEqual(''.join(reader.read(first)), self.data[len(header()):])
+        self.assertEqual(reader.file_chromosomes, [x[0] for x in REFERENCES])
+
+    def test_split(self):
+        expected = old_fastq(self.bam)
+        reader = pybam.bgzf(self.bam)
+        for parts in [1, 2, 3, 8, 50, 1000]:
+            runs = reader.split(parts)
+            self.assertTrue(len(runs) <= parts)
+            self.assertEqual(runs[0][0], reader.first_alignment())
+            self.assertEqual(runs[-1][1], None)
+            self.assertEqual([x[1] for x in runs[:-1]], [x[0] for x in runs[1:]])
+            got = []
+            for start, end in runs:
+                got += self.batches(start=start, end=end)
+            self.assertEqual(got, expected)
+        self.assertTrue(len(reader.split(8)) > 1)
+
+    def test_no_alignments(self):
+        write_bam(self.bam, header(), random.Random(3))
+        self.assertEqual(pybam.bgzf(self.bam).first_alignment(), None)
+        self.assertEqual(pybam.bgzf(self.bam).split(4), [])
+        self.assertEqual(self.batches(), [])
+        self.assertEqual(self.batches(cpus=2), [])
+
+    def test_not_bgzf(self):
+        with open(self.bam, 'wb') as output:
+            output.write(self.data)
+        self.assertRaises(pybam.PybamError, pybam.bgzf, self.bam)
+
+if __name__ == "__main__":
+    unittest.main()
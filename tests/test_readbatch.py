@@ -0,0 +1,97 @@
+import os, sys, random, unittest
+import numpy as np
+currentdir = os.path.dirname(os.path.abspath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import lib.primer as primer
+from lib.readbatch import ReadBatch, spans
+
+def reads(n=60, seed=1):
+    #(title, seq, qual) of reads from 0 to 40 bases, with some IUPAC and lower case letters
+    rand = random.Random(seed)
+    records = []
+    for i in range(n):
+        seq = ''.join([rand.choice('ACGTACGTACGTNRYacgt') for x in range(rand.randint(0, 40))])
+        qual = ''.join([chr(rand.randint(35, 73)) for x in seq])
+        records.append(('R_%i' % (i+1), seq, qual))
+    return records
+
+class ReadBatchTest(unittest.TestCase):
+    def test_spans(self):
+        self.assertEqual(spans(np.array([2, 10, 20]), np.array([3, 0, 2])).tolist(), [2, 3, 4, 20, 21])
+
+    def test_round_trip(self):
+        records = reads()
+        batch = ReadBatch.from_records(records)
+        self.assertEqual(len(batch), len(records))
+        self.assertEqual(list(batch.records()), records)
+        self.assertEqual(batch.lengths().tolist(), [len(x[1]) for x in records])
+        self.assertEqual(batch.fastq(), ''.join(['@%s\n%s\n+\n%s\n' % x for x in records]))
+
+    def test_empty(self):
+        batch = ReadBatch([], [], [])
+        self.assertEqual(len(batch), 0)
+        self.assertEqual(batch.prefix_diffs('ACGT').tolist(), [])
+        self.assertEqual(list(batch.records()), [])
+        batch = ReadBatch(['', ''], ['', ''], ['a', 'b'])
+        self.assertEqual(list(batch.records()), [('a', '', ''), ('b', '', '')])
+
+    def test_width(self):
+        records = reads()
+        batch = ReadBatch([x[1] for x in records], [x[2] for x in records], [x[0] for x in records], width=25)
+        self.assertEqual(list(batch.records()), [(x[0], x[1][:25], x[2][:25]) for x in records])
+
+    def test_trim_truncate(self):
+        #same as slicing each read, per read offsets or one for all, clipped to the read
+        records = reads()
+        cuts = np.array([i % 7 for i in range(len(records))])
+        batch = ReadBatch.from_records(records)
+        batch.trim_left(cuts)
+        batch.trim_left(3)
+        batch.truncate(20)
+        batch.truncate(cuts * 4 - 5)
+        expected = []
+        for (title, seq, qual), cut in zip(records, cuts.tolist()):
+            seq, qual = seq[cut:][3:][:20], qual[cut:][3:][:20]
+            end = max(cut * 4 - 5, 0)
+            expected.append((title, seq[:end], qual[:end]))
+        self.assertEqual(list(batch.records()), expected)
+
+    def test_pad(self):
+        records = reads()
+        rows = np.array([i % 2 == 0 for i in range(len(records))])
+        batch = ReadBatch.from_records(records)
+        batch.trim_left(2)
+        batch.pad(45, rows)
+        expected = []
+        for i, (title, seq, qual) in enumerate(records):
+            seq, qual = seq[2:], qual[2:]
+            if i % 2 == 0 and len(seq) < 45:
+                seq, qual = seq + 'N' * (45 - len(seq)), qual + 'J' * (45 - len(qual))
+            expected.append((title, seq, qual))
+        self.assertEqual(list(batch.records()), expected)
+        batch.pad(10, seqchar='A', qualchar='#')
+        for got, want in zip(batch.records(), expected):
+            self.assertEqual(got[1], want[1].ljust(10, 'A'))
+            self.assertEqual(got[2], want[2].ljust(10, '#'))
+
+    def test_prefix_diffs(self):
+        #same as primer.MatchPrefix() on each read, short reads only compare the bases they have
+        records = reads(200)
+        batch = ReadBatch.from_records(records)
+        batch.trim_left(np.array([i % 3 for i in range(len(records))]))
+        for Primer in ['ACGTACGT', 'GTGARTCATCGAATCTTTG', 'NNNN', 'A']:
+            expected = [primer.MatchPrefix(x[1], Primer) for x in batch.records()]
+            self.assertEqual(batch.prefix_diffs(Primer).tolist(), expected)
+
+    def test_select(self):
+        records = reads()
+        batch = ReadBatch.from_records(records)
+        keep = batch.lengths() >= 20
+        selected = batch.select(keep)
+        self.assertEqual(list(selected.records()), [x for x in records if len(x[1]) >= 20])
+        names = ['S_%i' % i for i in range(len(selected))]
+        self.assertEqual([x[0] for x in selected.records(names)], names)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+import os, sys, shutil, tempfile, unittest
+import numpy as np
+currentdir = os.path.dirname(os.path.abspath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import lib.readstore as readstore
+
+SAMPLES = [
+    ('S1', ['ACGTACGTAC', 'ACG', 'NNACGTRYKM', 'acgtx']),
+    ('S2', ['A', 'ACGTACGTACGTACGTACGTACGT']),
+    ('S1', ['GGGGG']),
+]
+
+def quals(seqs):
+    return [''.join([chr(33 + (i * 7) % 42) for i in range(len(x))]) for x in seqs]
+
+class PackTest(unittest.TestCase):
+    def test_round_trip(self):
+        for n in [0, 1, 2, 15, 16]:
+            codes = np.arange(n, dtype=np.uint8) % 16
+            self.assertEqual(readstore.unpack(readstore.pack(codes), n).tolist(), codes.tolist())
+
+    def test_codes(self):
+        #IUPAC letters keep their code in either case, anything else becomes N
+        seq = 'ACGTRYN-xacgt'
+        letters = readstore.LETTERS[readstore.CODES[np.frombuffer(seq, dtype=np.uint8)]].tostring()
+        self.assertEqual(letters, 'ACGTRYNNNACGT')
+
+    def test_bin_quality(self):
+        #illumina bins: Q0-1, 2-9, 10-19, 20-24, 25-29, 30-34, 35-39, 40+
+        binned = np.array(readstore.BINS)[readstore.bin_quality('"#*+4:?DIJ')].tolist()
+        self.assertEqual(binned, [2, 6, 6, 15, 15, 27, 33, 37, 40, 40])
+
+class ReadStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.output = os.path.join(self.folder, 'test.reads')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, binned=False):
+        with readstore.ReadStoreWriter(self.output, binned) as writer:
+            for sample, seqs in SAMPLES:
+                writer.add(sample, seqs, quals(seqs))
+            writer.add('S3', [], [])
+            self.assertEqual(writer.counts(), {'S1': 5, 'S2': 2})
+        return readstore.ReadStore(self.output)
+
+    def expected(self, samples=None):
+        records = []
+        for sample, seqs in SAMPLES:
+            for seq, qual in zip(seqs, quals(seqs)):
+                records.append(('R_%i;barcodelabel=%s;' % (len(records)+1, sample), seq.upper().replace('X', 'N'), qual))
+        return [x for x in records if samples is None or x[0].split('=')[1][:-1] in samples]
+
+    def test_records(self):
+        store = self.write()
+        self.assertFalse(store.binned)
+        self.assertEqual(store.total(), 7)
+        self.assertEqual(store.counts(), {'S1': 5, 'S2': 2})
+        #(sample, offset, reads, bases, minlen, maxlen, first read), blocks are lengths + seqs + quals
+        self.assertEqual(store.blocks, [('S1', 8, 4, 28, 3, 10, 1), ('S2', 66, 2, 25, 1, 24, 5), ('S1', 112, 1, 5, 5, 5, 7)])
+        self.assertEqual(list(store.records()), self.expected())
+        self.assertEqual(list(store.records(['S2'])), self.expected(['S2']))
+        store.close()
+
+    def test_binned(self):
+        store = self.write(binned=True)
+        self.assertTrue(store.binned)
+        for got, want in zip(store.records(), self.expected()):
+            self.assertEqual(got[:2], want[:2])
+            scores = np.array(readstore.BINS)[readstore.bin_quality(want[2])] + 33
+            self.assertEqual(got[2], scores.astype(np.uint8).tostring())
+        store.close()
+
+    def test_export(self):
+        store = self.write()
+        fastq = os.path.join(self.folder, 'test.fq')
+        fasta = os.path.join(self.folder, 'test.fa')
+        store.fastq(fastq, ['S1'])
+        store.fasta(fasta)
+        store.close()
+        with open(fastq) as input:
+            self.assertEqual(input.read(), ''.join(['@%s\n%s\n+\n%s\n' % x for x in self.expected(['S1'])]))
+        with open(fasta) as input:
+            self.assertEqual(input.read(), ''.join(['>%s\n%s\n' % x[:2] for x in self.expected()]))
+
+    def test_not_a_store(self):
+        with open(self.output, 'w') as output:
+            output.write('@R_1\nACGT\n+\nIIII\n' * 4)
+        self.assertRaises(readstore.ReadStoreError, readstore.ReadStore, self.output)
+        with open(self.output, 'w') as output:
+            output.write('')
+        self.assertRaises(readstore.ReadStoreError, readstore.ReadStore, self.output)
+
+if __name__ == "__main__":
+    unittest.main()
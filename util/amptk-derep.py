@@ -1,29 +1,18 @@
 #!/usr/bin/env python
 
-#script to reformat green-genes fasta file for UTAX compatibility
+#script to dereplicate a FASTA or FASTQ file, keeps the first ID of every unique sequence
 
-import sys
-from Bio import SeqIO
+import sys, os, inspect, multiprocessing
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir)
+import lib.amptklib as amptklib
 
 def dereplicate(input, output):
-    seqs = {}
-    in_file = open(input, 'rU')
-    if input.endswith('.fa') or input.endswith('.fasta'):
-        filetype = 'fasta'
-    elif input.endswith('.fq') or input.endswith('.fastq'):
-        filtype = 'fastq'
-    else:
-        print("Could not detect file type, must be FASTA or FASTQ")
-        sys.exit
-    for rec in SeqIO.parse(in_file, filetype):
-        sequence = str(rec.seq)
-        if sequence not in seqs:
-            seqs[sequence] = rec.id
+    samples, uniques = amptklib.derepUniques(input, multiprocessing.cpu_count(), tmpdir=os.path.dirname(os.path.abspath(output)))
     with open(output, 'w') as out:
-        for sequence in seqs:
-            out.write('>'+seqs[sequence]+'\n'+sequence+'\n')
+        for title, sequence, size, counts in uniques:
+            out.write('>'+(title.split(None, 1) or [''])[0]+'\n'+sequence+'\n')
 
 
 dereplicate(sys.argv[1], sys.argv[2])
-
-
@@ -1,8 +1,13 @@
 #!/usr/bin/env python
 
-import sys, os, itertools, multiprocessing, glob, shutil, argparse
+import sys, os, itertools, argparse, inspect
 from natsort import natsorted
 from Bio import SeqIO
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir)
+import lib.amptklib as amptklib
+import lib.eefilter as eefilter
 
 
 class MyFormatter(argparse.ArgumentDefaultsHelpFormatter):
@@ -19,65 +24,33 @@ parser.add_argument('--quality_trim', action='store_true', help='Quality trim da
 parser.add_argument('-e','--maxee', default=1.0, type=float, help='MaxEE Q-trim threshold')
 parser.add_argument('-l','--trunclen', default=250, type=int, help='Read truncation length')
 parser.add_argument('-o','--out', help='Output for quality trimmed data')
+parser.add_argument('--ee_scan', help='Report reads passing maxEE:trunclen pairs, e.g. 1.0:250,0.5:200,1.0')
+parser.add_argument('--ee_reads', help='With --ee_scan, write longest passing prefix of every read (TSV)')
 args=parser.parse_args()
 
 
-def countfastq(input):
-    lines = sum(1 for line in open(input))
-    count = int(lines) / 4
-    return count
-
-def batch_iterator(iterator, batch_size):
-    entry = True #Make sure we loop once
-    while entry :
-        batch = []
-        while len(batch) < batch_size :
-            try :
-                entry = iterator.next()
-            except StopIteration :
-                entry = None
-            if entry is None :
-                #End of file
-                break
-            batch.append(entry)
-        if batch :
-            yield batch
-
-def MaxEEFilter(records):
-    for rec in records:
-        trunclen = args.trunclen
-        maxee = args.maxee
-        rec = rec[:trunclen]
-        ee = 0
-        for bp, Q in enumerate(rec.letter_annotations["phred_quality"]):
-            P = 10**(float(-Q)/10)
-            ee += P
-        if ee <= maxee:
-            rec.name = ""
-            rec.description = ""
-            yield rec
-
-def worker(file):
-    name = file.split(".")[0]
-    filter_out = name + '.filter.fq'
-    with open(filter_out, 'w') as output:
-        with open(file, 'rU') as input:
-            SeqRecords = SeqIO.parse(file, 'fastq')
-            SeqIO.write(MaxEEFilter(SeqRecords), output, 'fastq')
+def eeScan(file, thresholds):
+    #longest prefix passing every maxEE/trunclen pair from a single pass over the reads
+    summary = eefilter.Summary(thresholds)
+    output = open(args.ee_reads, 'w') if args.ee_reads else None
+    if output:
+        output.write('Read\tLength\t%s\n' % '\t'.join(['EE%s:%s' % (x, y or 'full') for x, y in thresholds]))
+    with open(file, 'rU') as input:
+        for records, lengths, prefixes in eefilter.scan(input, thresholds):
+            summary.add(lengths, prefixes)
+            if output:
+                output.writelines(['%s\t%i\t%s\n' % (rec[0], length, '\t'.join(map(str, row))) for rec, length, row in zip(records, lengths.tolist(), prefixes.tolist())])
+    if output:
+        output.close()
+    table = "%8s %9s %12s %12s %14s" % ('maxEE', 'trunclen', 'Passed', 'Full length', 'Bases kept')
+    for maxee, trunclen, passed, full, bases in summary.rows():
+        table += "\n%8s %9s %12s %12s %14s" % (maxee, trunclen or 'full', '{0:,}'.format(passed), '{0:,}'.format(full), '{0:,}'.format(bases))
+    print("Expected errors of %s reads\n%s" % ('{0:,}'.format(summary.reads), table))
 
 def countBarcodes(file):
     global BarcodeCount
-    #now loop through data and find barcoded samples, counting each.....
-    BarcodeCount = {}
-    with open(file, 'rU') as input:
-        header = itertools.islice(input, 0, None, 4)
-        for line in header:
-            ID = line.split("=")[-1].split(";")[0]
-            if ID not in BarcodeCount:
-                BarcodeCount[ID] = 1
-            else:
-                BarcodeCount[ID] += 1
-            
+    #counts come from the demux index if there is one, otherwise the file is scanned
+    BarcodeCount = amptklib.getBarcodeCounts(file)
 
     #now let's count the barcodes found and count the number of times they are found.
     barcode_counts = "%20s:  %s" % ('Sample', 'Count')
@@ -86,6 +59,20 @@ def countBarcodes(file):
     print("Found %i barcoded samples\n%s" % (len(BarcodeCount), barcode_counts))
 
 def getSeqLength(file):
+    index = amptklib.loadDemuxIndex(file)
+    if index and index.samples:
+        #only totals and the length range are kept in the demux index
+        stats = index.samples.values()
+        count = sum(x[0] for x in stats)
+        minlen = min(x[2] for x in stats)
+        maxlen = max(x[3] for x in stats)
+        print "Read count: %i" % count
+        if minlen == maxlen:
+            print "Read Length: %i bp" % minlen
+        else:
+            print "Read length average: %i" % (sum(x[1] for x in stats) / max(count, 1))
+            print "Read length range: %i - %i bp" % (minlen, maxlen)
+        return
     seqlength = {}
     with open(file, 'rU') as input:
         header = itertools.islice(input, 1, None, 4)
@@ -116,63 +103,27 @@ def filterSeqs(file, lst):
             if bc in lst:
                 yield rec
 
-if args.quality_trim and not args.output:
-    print "Error, to run quality trimming you must provide -o, --output"
+if args.quality_trim and not args.out:
+    print "Error, to run quality trimming you must provide -o, --out"
     os._exit(1)
+if args.ee_scan:
+    try:
+        EEThresholds = eefilter.parse_thresholds(args.ee_scan)
+    except ValueError:
+        print "Error, --ee_scan takes maxEE:trunclen pairs separated by commas, e.g. 1.0:250,0.5:200"
+        os._exit(1)
 
 #main start here
-cpus = multiprocessing.cpu_count()
 print "----------------------------------"
 countBarcodes(args.input)
 print "----------------------------------"
 getSeqLength(args.input)
 print "----------------------------------"
-if args.quality_trim:
-    #split the input FASTQ file into chunks to process
-    with open(args.input, 'rU') as input:
-        SeqCount = countfastq(args.input)
-        print('{0:,}'.format(SeqCount) + ' records loaded')
-        SeqRecords = SeqIO.parse(input, 'fastq')
-        chunks = SeqCount / cpus + 1
-        print("Using %i cpus to process data" % cpus)
-        #divide into chunks, store in tmp file
-        pid = os.getpid()
-        folder = 'amptk_tmp_' + str(pid)
-        if not os.path.exists(folder):
-            os.makedirs(folder)
-        for i, batch in enumerate(batch_iterator(SeqRecords, chunks)) :
-            filename = "chunk_%i.fq" % (i+1)
-            tmpout = os.path.join(folder, filename)
-            handle = open(tmpout, "w")
-            count = SeqIO.write(batch, handle, "fastq")
-            handle.close()
-
-    #now get file list from tmp folder
-    file_list = []
-    for file in os.listdir(folder):
-        if file.endswith(".fq"):
-            file = os.path.join(folder, file)
-            file_list.append(file)
-
-    p = multiprocessing.Pool(cpus)
-    for f in file_list:
-        #worker(f)
-        p.apply_async(worker, [f])
-    p.close()
-    p.join()
-
-    #get filtered results
-    catDemux = args.output
-    with open(catDemux, 'w') as outfile:
-        for filename in glob.glob(os.path.join(folder,'*.filter.fq')):
-            if filename == catDemux:
-                continue
-            with open(filename, 'rU') as readfile:
-                shutil.copyfileobj(readfile, outfile)
-    shutil.rmtree(folder)
+if args.ee_scan:
+    eeScan(args.input, EEThresholds)
     print "----------------------------------"
-    countBarcodes(args.output)
+if args.quality_trim:
+    amptklib.FastMaxEEFilter(args.input, args.trunclen, args.maxee, args.out)
+    countBarcodes(args.out)
     print "----------------------------------"
-    print "Script finished, output in %s" % args.output
-
-
+    print "Script finished, output in %s" % args.out
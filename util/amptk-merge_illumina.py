@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 
 #This script is a wrapper for -fastq_mergepairs from USEARCH8
-import os, sys, argparse, shutil, subprocess, gzip, logging
+import os, sys, argparse, shutil, subprocess, logging, inspect, tempfile
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir)
+import lib.amptklib as amptklib
     
 class MyFormatter(argparse.ArgumentDefaultsHelpFormatter):
     def __init__(self,prog):
@@ -65,32 +69,48 @@ except OSError:
 log.info("USEARCH version: %s" % usearch_test)
 
 
-#check extension and decompress if ending in .gz
-extension = os.path.splitext(args.fastq_forward_reads)[1]
-f1_name = os.path.splitext(args.fastq_forward_reads)[0]
-f2_name = os.path.splitext(args.fastq_reverse_reads)[0]
-if extension == ".gz":
-    log.info("Extracting compressed input files")
-    R1_file = gzip.open(args.fastq_forward_reads, 'rb')
-    forward = R1_file.read()
-    R1_file.close()
-    R1_tmp = file(f1_name, 'wb')
-    R1_tmp.write(forward)
-    R1_tmp.close()
-    for_reads = f1_name
-    R2_file = gzip.open(args.fastq_reverse_reads, 'rb')
-    rev = R2_file.read()
-    R2_file.close()
-    R2_tmp = file(f2_name, 'wb')
-    R2_tmp.write(rev)
-    R2_tmp.close()
-    rev_reads = f2_name
-else:
-    for_reads = args.fastq_forward_reads
-    rev_reads = args.fastq_reverse_reads
+#usearch8 cannot read gzipped FASTQ, each step streams it decompressed through a named pipe.
+#If usearch cannot read a pipe the inputs are extracted once to temp files and the step rerun
+for_reads = args.fastq_forward_reads
+rev_reads = args.fastq_reverse_reads
+tmp_names = {for_reads: args.out + '.R1.tmp.fq', rev_reads: args.out + '.R2.tmp.fq'}
+tmp_files = {}
+pipedir = tempfile.mkdtemp(prefix=os.path.basename(args.out)+'.', dir=os.path.dirname(os.path.abspath(args.out)))
+
+def feedReads(input):
+    def work(handle):
+        with amptklib.zopen(input) as infile:
+            shutil.copyfileobj(infile, handle)
+    return work
+
+def usearchStep(cmd):
+    cmd = [tmp_files.get(x, x) for x in cmd]
+    gz = [i for i, x in enumerate(cmd) if x in tmp_names and x.endswith('.gz')]
+    if gz:
+        streamed = list(cmd)
+        workers = []
+        for i in gz:
+            streamed[i] = os.path.join(pipedir, 'R%i.fq' % i)
+            os.mkfifo(streamed[i])
+            workers.append(amptklib.FifoWorker(streamed[i], 'w', feedReads(cmd[i])))
+        for t in workers:
+            t.start()
+        status = subprocess.call(streamed, stdout = FNULL, stderr = FNULL)
+        for t in workers:
+            t.finish(check=False)
+        for i in gz:
+            os.remove(streamed[i])
+        if not status and all(t.error is None for t in workers):
+            return
+        for i in gz:
+            log.info("Extracting compressed input file %s" % cmd[i])
+            tmp_files[cmd[i]] = tmp_names[cmd[i]]
+            amptklib.zcopy(cmd[i], tmp_files[cmd[i]])
+        cmd = [tmp_files.get(x, x) for x in cmd]
+    subprocess.call(cmd, stdout = FNULL, stderr = FNULL)
 
 #get read length
-fp = open(for_reads)
+fp = amptklib.zopen(for_reads)
 for i, line in enumerate(fp):
     if i == 1:
         read_length = len(line)
@@ -107,8 +127,8 @@ pretrim_R2 = args.out + 'pretrim_R2.fq'
 log.info("Pre-Processing Reads")
 log.debug("%s -fastq_filter %s -fastq_trunclen %s -fastqout %s\n" % (usearch, for_reads, str(read_length), pretrim_R1))
 log.debug("%s -fastq_filter %s -fastq_trunclen %s -fastqout %s\n" % (usearch, rev_reads, str(read_length), pretrim_R2))
-subprocess.call([usearch, '-fastq_filter', for_reads, '-fastq_trunclen', str(read_length), '-fastqout', pretrim_R1], stdout = FNULL, stderr = FNULL)
-subprocess.call([usearch, '-fastq_filter', rev_reads, '-fastq_trunclen', str(read_length), '-fastqout', pretrim_R2], stdout = FNULL, stderr = FNULL)
+usearchStep([usearch, '-fastq_filter', for_reads, '-fastq_trunclen', str(read_length), '-fastqout', pretrim_R1])
+usearchStep([usearch, '-fastq_filter', rev_reads, '-fastq_trunclen', str(read_length), '-fastqout', pretrim_R2])
 
 #next run USEARCH8 mergepe
 merge_out = args.out + 'merged.fq'
@@ -116,7 +136,7 @@ skip_for = args.out + 'notmerged.R1.fq'
 skip_rev = args.out + 'notmerged.R2.fq'
 log.info("Merging Overlapping Pairs")
 log.debug("%s -fastq_mergepairs %s -reverse %s -fastqout %s -fastqout_notmerged_fwd %s -fastqout_notmerged_rev %s -fastq_truncqual 5 -fastq_allowmergestagger -minhsp 12\n" % (usearch, pretrim_R1, pretrim_R2, merge_out, skip_for, skip_rev))
-subprocess.call([usearch, '-fastq_mergepairs', for_reads, '-reverse', rev_reads, '-fastqout', merge_out, '-fastqout_notmerged_fwd', skip_for, '-fastqout_notmerged_rev', skip_rev, '-fastq_truncqual', '5','-fastq_allowmergestagger','-minhsp', '12'], stdout = FNULL, stderr = FNULL)
+usearchStep([usearch, '-fastq_mergepairs', for_reads, '-reverse', rev_reads, '-fastqout', merge_out, '-fastqout_notmerged_fwd', skip_for, '-fastqout_notmerged_rev', skip_rev, '-fastq_truncqual', '5','-fastq_allowmergestagger','-minhsp', '12'])
 
 #now concatenate files for downstream pre-process_illumina.py script
 log.info("Concatenating output files")
@@ -132,3 +152,6 @@ os.remove(pretrim_R1)
 os.remove(pretrim_R2)
 os.remove(skip_for)
 os.remove(skip_rev)
+for f in tmp_files.values():
+    os.remove(f)
+shutil.rmtree(pipedir)
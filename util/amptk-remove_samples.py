@@ -1,11 +1,12 @@
 #!/usr/bin/env python
 
 import sys, argparse, os, inspect, itertools
-from Bio.SeqIO.QualityIO import FastqGeneralIterator
+from natsort import natsorted
 currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0,parentdir)
 import lib.amptklib as amptklib
+import lib.readstore as readstore
 
 class MyFormatter(argparse.ArgumentDefaultsHelpFormatter):
     def __init__(self,prog):
@@ -25,23 +26,28 @@ parser.add_argument('--format', default='fastq', choices=['fastq','fasta'], help
 args=parser.parse_args()
 
 def countBarcodes(file):
-    #now loop through data and find barcoded samples, counting each.....
-    BarcodeCount = {}
-    with open(file, 'rU') as input:
-        header = itertools.islice(input, 0, None, 4)
-        for line in header:
-            ID = line.split("=")[-1].split(";")[0]
-            if ID not in BarcodeCount:
-                BarcodeCount[ID] = 1
-            else:
-                BarcodeCount[ID] += 1
-    return BarcodeCount
+    #counts come from the demux index if there is one, otherwise the file is scanned
+    return amptklib.getBarcodeCounts(file)
 
 def filter_sample(file, output):
     global keep_count, total_count
+    #with a demux index or a binary .reads file only the blocks of the samples not removed are read
+    index = amptklib.loadDemuxIndex(file)
+    scan = False
+    if amptklib.seqFormat(file) == 'reads':
+        store = readstore.ReadStore(file)
+        total_count = store.total()
+        records = store.records([x for x in natsorted(store.counts().keys()) if not x in keep_list])
+    elif index:
+        total_count = index.total()
+        records = index.records(file, [x for x in natsorted(index.samples.keys()) if not x in keep_list])
+    else:
+        scan = True
+        records = amptklib.readRecords(file)
     with open(output, 'w') as out:
-        for title, seq, qual in FastqGeneralIterator(open(file)):
-            total_count += 1
+        for title, seq, qual in records:
+            if scan:
+                total_count += 1
             sample = title.split('=',1)[1].split(';')[0]
             if not sample in keep_list:
                 keep_count += 1
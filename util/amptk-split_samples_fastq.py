@@ -8,7 +8,7 @@ import lib.fasta as fasta
 import lib.primer as primer
 import lib.revcomp_lib as revcomp_lib
 import lib.amptklib as amptklib
-from Bio.SeqIO.QualityIO import FastqGeneralIterator
+import lib.barcode as barcode
 
 class MyFormatter(argparse.ArgumentDefaultsHelpFormatter):
     def __init__(self,prog):
@@ -52,14 +52,6 @@ ReverseCompRev = revcomp_lib.RevComp(RevPrimer)
 if args.platform == 'ion':
     FwdPrimer = 'A' + FwdPrimer
 
-def FindBarcode(Seq):
-    global Barcodes
-    for BarcodeLabel in Barcodes.keys():
-        Barcode = Barcodes[BarcodeLabel]
-        if Seq.startswith(Barcode):
-            return Barcode, BarcodeLabel
-    return "", ""
-
 def MatchesPrimer(Seq, Primer):
     return primer.MatchPrefix(Seq, Primer)
 
@@ -101,6 +93,7 @@ with open(args.barcodes, 'rU') as input:
             name = line[1:-1] + ".fastq"
             continue
         Barcodes[name]=line.strip()
+BarcodeIdx = barcode.BarcodeIndex(Barcodes)
 
 amptklib.log.info("Looking for %i barcodes and trimming primers\nFwdPrimer: %s\nRevPrimer: %s" % (len(Barcodes), FwdPrimer, RevPrimer))
 
@@ -110,9 +103,10 @@ badPrimer = 0
 noBC = 0
 BC = 0
 trim = len(FwdPrimer)
-with open(args.FASTQ, 'rU') as input:
-    for title, seq, qual in FastqGeneralIterator(input):
-        Barcode, BarcodeLabel = FindBarcode(seq)
+#per-sample files are written through a pool of buffered handles
+with amptklib.MultiWriter() as output:
+    for title, seq, qual in amptklib.readRecords(args.FASTQ):
+        Barcode, BarcodeLabel = BarcodeIdx.find(seq)
         if Barcode == "": #if not found, move onto next record
             noBC += 1
             continue
@@ -138,8 +132,7 @@ with open(args.FASTQ, 'rU') as input:
             continue
         runningTotal += 1
         fileout = os.path.join(args.out, BarcodeLabel)
-        with open(fileout, 'ab') as output:
-            output.write("@%s\n%s\n+\n%s\n" % (title, seq, qual))    
+        output.write(fileout, "@%s\n%s\n+\n%s\n" % (title, seq, qual))
 amptklib.log.info('{0:,}'.format(runningTotal) + ' total reads with valid barcode')
 amptklib.log.info('{0:,}'.format(BC) + ' barcode found')
 amptklib.log.info('{0:,}'.format(noBC) + ' no barcode found')
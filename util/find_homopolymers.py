@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 
-import re
-import argparse
-from Bio import SeqIO
-from Bio.SeqUtils import GC
+import sys, os, re, argparse, inspect
+from cStringIO import StringIO
+import numpy as np
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir)
+import lib.amptklib as amptklib
+import lib.fastx as fastx
 
 class MyFormatter(argparse.ArgumentDefaultsHelpFormatter):
     def __init__(self,prog):
@@ -16,8 +20,71 @@ parser=argparse.ArgumentParser(
 parser.add_argument('-i', '--fasta', dest='fasta', required=True, help='FASTA file')
 parser.add_argument('-o','--out', dest='out', default='out', help='output file')
 parser.add_argument('-n','--num_homopolymers', dest='homo', default='6', help='Number of homopolymers')
+parser.add_argument('--cpus', type=int, default=1, help='Number of CPUs, split large FASTA files between processes')
 args=parser.parse_args()
 
+#G, C and S count towards GC content, same as Bio.SeqUtils.GC
+GCBASES = np.zeros(256, dtype=np.int64)
+for x in 'GCSgcs':
+    GCBASES[ord(x)] = 1
+
+def scanRecords(records, num_homo):
+    #report lines of (title, seq) records and the number without homopolymers, all sequences
+    #are joined into one array (NUL between them) and run length encoded in one go
+    ids = [(x[0].split(None, 1) or [''])[0] for x in records]
+    seqs = [x[1] for x in records]
+    lengths = np.array([len(x) for x in seqs], dtype=np.int64)
+    offsets = np.cumsum(lengths + 1) - (lengths + 1)
+    data = np.frombuffer('\0'.join(seqs), dtype=np.uint8)
+    gc = np.concatenate(([0], np.cumsum(GCBASES[data])))
+    gc = gc[offsets + lengths] - gc[offsets]
+    found = [[] for x in records]
+    if len(data):
+        starts = np.concatenate(([0], np.flatnonzero(data[1:] != data[:-1]) + 1))
+        runs = np.diff(np.append(starts, len(data)))
+        bases = data[starts]
+        keep = (runs >= num_homo) & (bases != ord('N')) & (bases != 0)
+        starts, runs, bases = starts[keep], runs[keep], bases[keep]
+        rec = np.searchsorted(offsets, starts, side='right') - 1
+        for i, start, run, base in zip(rec.tolist(), (starts - offsets[rec]).tolist(), runs.tolist(), bases.tolist()):
+            found[i].append("%i(%s):%i-%i" % (run, chr(base), start, start + run))
+    lines = []
+    none_count = 0
+    for ID, length, GC_count, homo in zip(ids, lengths.tolist(), gc.tolist(), found):
+        if homo:
+            homo_out = '; '.join(homo) + ';'
+        else:
+            homo_out = "None found"
+            none_count += 1
+        GC_calc = GC_count * 100.0 / length if length else 0.0
+        lines.append("%s\t%s\t%.2f\t%s\n" % (ID, length, GC_calc, homo_out))
+    return ''.join(lines), len(records), none_count
+
+def splitFasta(file, parts):
+    #byte ranges of file that start at a '>' line, about size/parts each
+    size = os.path.getsize(file)
+    bounds = [0]
+    with open(file, 'rb') as input:
+        for i in range(1, parts):
+            input.seek(max(size * i / parts, bounds[-1]))
+            input.readline()
+            while True:
+                offset = input.tell()
+                line = input.readline()
+                if not line or line.startswith('>'):
+                    break
+            if offset > bounds[-1]:
+                bounds.append(offset)
+    bounds.append(size)
+    return [(file, a, b) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+def scanRange(span):
+    file, start, end = span
+    with open(file, 'rb') as input:
+        input.seek(start)
+        text = input.read(end - start)
+    return scanRecords(list(fastx.fasta_records(StringIO(text))), int(args.homo))
+
 #make default output from splitting input fasta name
 if args.out == "out":
     out_base = re.split(r'\.fa', args.fasta)
@@ -28,49 +95,18 @@ else:
 out_file = open(out_name, "w")
 
 #print header
-header_name = "SeqID"
 out_file.write ("SeqID\tLength (bp)\tGC Content (%)\tHomopolymers (Len(nuc):start-stop)\n")
 record_count = 0
 none_count = 0
-for record in SeqIO.parse(open(args.fasta, "rU"), "fasta"):
-    record_count = record_count + 1
-    GC_calc = GC(record.seq)
-    lis = []
-    for x in record.seq:
-        if len(lis) != 0:
-            if lis[-1][0] == x:
-                lis[-1][1] += 1
-            else:
-                lis.append([x, 1])
-        else:
-            lis.append([x, 1])
-    #now try to get index of those greater than argparse num_homopolymer
-    num_homo = int(args.homo)
-    count = 0  #keep track of index as you go through the list
-    homo_out = ''
-    for item in lis:
-        count = count + 1
-        temp_lis = []
-        if item[1] >= num_homo:
-            #get index from the count
-            count_index = count - 1
-            temp_list = lis[:count_index]
-            start = sum([item[1] for item in temp_list])
-            stop = start + lis[count_index][1]
-            nucleotide = str(lis[count_index][0])
-            if nucleotide == 'N':
-                continue
-            length = str(lis[count_index][1])
-            homopolymers = "%s(%s):%i-%i;" % (length, nucleotide, start, stop)
-            #now append to the variable
-            homo_out = homo_out + homopolymers
-    if homo_out == '':
-        homo_out = "None found"
-        none_count = none_count + 1
-    else:
-        homo_out = re.sub(";", "; ", homo_out)
-        homo_out = re.sub("; $", ";", homo_out)
-    out_file.write("%s\t%s\t%.2f\t%s\n" % (record.id, len(record.seq), GC_calc, homo_out))
+if args.cpus > 1:
+    with amptklib.WorkerPool(args.cpus) as pool:
+        results = pool.map(scanRange, splitFasta(args.fasta, args.cpus * 4), progress=False)
+else:
+    results = (scanRecords(chunk, int(args.homo)) for chunk in fastx.fasta_chunks(open(args.fasta, 'rb')))
+for lines, count, missing in results:
+    out_file.write(lines)
+    record_count += count
+    none_count += missing
 
 homo_count = record_count - none_count
 homo_pct = float(homo_count) / float(record_count) * 100
@@ -78,4 +114,4 @@ pct = "%"
 print "Input Sequences: %i" % record_count
 print "Seqs with homopolymers > %s: %i (%.02f%%)" % (args.homo, homo_count, homo_pct)
 print "Results located here: %s" % out_name
-out_file.close()
\ No newline at end of file
+out_file.close()